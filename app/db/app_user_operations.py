@@ -1,7 +1,8 @@
 import json
-import psycopg2
-from decouple import config
-from utils.debank_utils import to_decimal
+from db.connection import execute_query, execute_query_with_result, transaction
+from db.snapshot_writer import save_wallet_snapshot
+from db.portfolio_materializer import materialize_portfolio, refresh_chain_aggregates
+from utils.debank_utils import to_decimal, normalize_address
 import logging
 import pandas as pd
 from datetime import datetime
@@ -9,30 +10,38 @@ timestamp = datetime.utcfromtimestamp(1633341217.0).strftime('%Y-%m-%d %H:%M:%S'
 logging.basicConfig(level=logging.INFO)
 
 
-# Load environment variables from .env file
-DATABASE_URL = config('DATABASE_URL').replace("postgresql+psycopg2://", "postgresql://")
-
-# Utility functions for database operations
+# Per-user portfolio queries (also EXPLAINed by db.index_check).
+# One user's rows of the user_chain_aggregates view, computed live so that a
+# link/unlink shows up without refreshing the view for every user.
+USER_CHAIN_AGGREGATES_QUERY = """
+    WITH user_portfolio_aggregation AS (
+        SELECT chain AS chain_id, SUM(total_usd_value) AS aggregated_usd_value
+        FROM UserPortfolio
+        WHERE user_id = %s
+        GROUP BY chain
+    ),
+    wallet_chain_data AS (
+        SELECT wcb.chain_id, SUM(wcb.usd_value) AS reported_usd_value
+        FROM WalletChainBalances wcb
+        JOIN UserWallets uw ON wcb.wallet_address = uw.wallet_address
+        WHERE uw.user_id = %s
+        GROUP BY wcb.chain_id
+    )
+    SELECT upa.chain_id, upa.aggregated_usd_value, wcd.reported_usd_value
+    FROM user_portfolio_aggregation upa
+    LEFT JOIN wallet_chain_data wcd ON upa.chain_id = wcd.chain_id;
+    """
 
-def execute_query(query, values=None):
-    try:
-        with psycopg2.connect(DATABASE_URL) as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(query, values)
-                conn.commit()
-    except Exception as e:
-        print(f"Error executing query: {e}")
+USER_TOKENS_QUERY = """
+    SELECT 
+        up.user_id, up.token_id, up.wallet_address, up.chain, up.name, up.total_token_amount, 
+        up.total_usd_value, up.timestamp, up.updated_at, t.is_verified, t.is_core, t.is_wallet 
+    FROM UserPortfolio up
+    JOIN TokenCatalog t ON t.chain = up.chain AND t.token_id = up.token_id
+    WHERE up.user_id = %s;
+    """
 
 
-def execute_query_with_result(query, values=None):
-    try:
-        with psycopg2.connect(DATABASE_URL) as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(query, values)
-                return cursor.fetchall()
-    except Exception as e:
-        print(f"Error executing query: {e}")
-        return []
 # User ID Management functions
 
 def fetch_user_ids():
@@ -55,20 +64,24 @@ DO UPDATE SET addresses = EXCLUDED.addresses;
 
 def delete_user(user_id):
     """Deletes a user by ID and their associated wallets."""
-    # Deleting wallet associations first
+    # Deleting portfolio rows and wallet associations first
+    execute_query('DELETE FROM UserPortfolio WHERE user_id = %s', (user_id,))
     execute_query('DELETE FROM UserWallets WHERE user_id = %s', (user_id,))
     execute_query('DELETE FROM users WHERE user_id = %s', (user_id,))
 
 def add_address_to_user(user_id, address):
     """Adds a new address to a given user."""
+    address = normalize_address(address)
     # First ensure address exists in Wallets table.
     execute_query('INSERT INTO Wallets (address) VALUES (%s) ON CONFLICT (address) DO NOTHING;', (address,))
     # Then associate the user with the address in UserWallets
     execute_query('INSERT INTO UserWallets (user_id, wallet_address) VALUES (%s, %s) ON CONFLICT (user_id, wallet_address) DO NOTHING;', (user_id, address))
 
 def remove_address_from_user(user_id, address):
-    """Removes an address association from a given user."""
-    execute_query('DELETE FROM UserWallets WHERE user_id = %s AND wallet_address = %s', (user_id, address))
+    """Removes an address association from a given user, along with its portfolio rows."""
+    with transaction() as cursor:
+        cursor.execute('DELETE FROM UserPortfolio WHERE user_id = %s AND wallet_address = %s', (user_id, address))
+        cursor.execute('DELETE FROM UserWallets WHERE user_id = %s AND wallet_address = %s', (user_id, address))
 
 
 def fetch_addresses_for_user(user_id):
@@ -80,201 +93,54 @@ def fetch_addresses_for_user(user_id):
     
 
 def save_raw_data_to_db(wallet_address, raw_balance_data, raw_token_data):
-   
-    
-   
-    # 1. Insert or Update Wallet's data
-    execute_query('''
-        INSERT INTO Wallets (address, total_usd_value)
-        VALUES (%s, %s)
-        ON CONFLICT (address)
-        DO UPDATE SET total_usd_value = EXCLUDED.total_usd_value;
-    ''', (wallet_address, to_decimal(raw_balance_data['total_usd_value'])))
-
-    # 2. Insert or Update Chains
-
-    for chain in raw_balance_data['chain_list']:
-        
-        execute_query('''
-            INSERT INTO Chains (id, wallet_address, name, logo_url, wrapped_token_id, community_id, native_token_id, is_support_pre_exec, usd_value)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (id, wallet_address)
-            DO UPDATE SET 
-                name = EXCLUDED.name, 
-                logo_url = EXCLUDED.logo_url, 
-                wrapped_token_id = EXCLUDED.wrapped_token_id,
-                community_id = EXCLUDED.community_id,
-                native_token_id = EXCLUDED.native_token_id,
-                is_support_pre_exec = EXCLUDED.is_support_pre_exec,
-                usd_value = EXCLUDED.usd_value;
-        ''', (chain['id'], wallet_address, chain['name'], chain['logo_url'], chain['wrapped_token_id'], chain.get('community_id'), chain.get('native_token_id'), chain.get('is_support_pre_exec'), to_decimal(chain['usd_value'])))
-
-        # 3. Insert or Update WalletChainBalances
-
-        execute_query('''
-            INSERT INTO WalletChainBalances (wallet_address, chain_id, usd_value)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (wallet_address, chain_id)
-            DO UPDATE SET usd_value = EXCLUDED.usd_value;
-        ''', (wallet_address, chain['id'], to_decimal(chain['usd_value'])))
-        
-
-    # 4. Insert or Update Tokens
-
-   
-    for token in raw_token_data:
-        # Convert UNIX timestamp to datetime
-        time_at_value = None
-        if 'time_at' in token and isinstance(token.get('time_at'), (int, float)):
-            try:
-                time_at_value = datetime.utcfromtimestamp(token.get('time_at')).strftime('%Y-%m-%d %H:%M:%S')
-            except:
-                pass
-
-        # Prepare the values to insert
-        values_to_insert = (
-            token['id'], wallet_address, token['chain'], token['name'], 
-            token['symbol'], token.get('display_symbol'), token.get('optimized_symbol'), 
-            token.get('decimals'), token.get('logo_url'), token.get('protocol_id'), 
-            to_decimal(token['price']), to_decimal(token.get('price_24h_change')), 
-            token.get('is_verified'), token.get('is_core'), token.get('is_wallet'), 
-            time_at_value, to_decimal(token.get('amount'))
-    )
-
-        # Execute the insertion query
-        execute_query('''
-            INSERT INTO Tokens (id, wallet_address, chain, name, symbol, display_symbol, optimized_symbol, decimals, logo_url, protocol_id, price, price_24h_change, is_verified, is_core, is_wallet, time_at, amount)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (id)
-            DO UPDATE SET 
-                chain = EXCLUDED.chain, 
-                name = EXCLUDED.name, 
-                symbol = EXCLUDED.symbol,
-                display_symbol = EXCLUDED.display_symbol,
-                optimized_symbol = EXCLUDED.optimized_symbol,
-                decimals = EXCLUDED.decimals,
-                logo_url = EXCLUDED.logo_url,
-                protocol_id = EXCLUDED.protocol_id,
-                price = EXCLUDED.price,
-                price_24h_change = EXCLUDED.price_24h_change,
-                is_verified = EXCLUDED.is_verified,
-                is_core = EXCLUDED.is_core,
-                is_wallet = EXCLUDED.is_wallet,
-                time_at = EXCLUDED.time_at,
-                amount = EXCLUDED.amount
-        ''', values_to_insert)
-        
-     
-        # 5. Insert or Update WalletTokenBalances
-        execute_query('''
-            INSERT INTO WalletTokenBalances (wallet_address, token_id, amount)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (wallet_address, token_id)
-            DO UPDATE SET amount = EXCLUDED.amount;
-        ''', (wallet_address, token['id'], to_decimal(token['amount'])))
+    """Saves a wallet's DeBank payloads in a single batched transaction."""
+    save_wallet_snapshot(wallet_address, raw_balance_data, raw_token_data)
 
 
 def fetch_aggregated_data_for_user(user_id):
     """
-    Fetches aggregated token and chain data associated with a specific user.
-    """
-    query = """
-    WITH user_portfolio_aggregation AS (
-        SELECT 
-            up.chain AS chain_id,
-            SUM(up.total_usd_value) AS aggregated_usd_value
-        FROM 
-            UserPortfolio up
-        WHERE up.user_id = %s
-        GROUP BY up.chain
-    ),
-    wallet_chain_data AS (
-        SELECT 
-            wcb.chain_id,
-            SUM(wcb.usd_value) AS reported_usd_value
-        FROM 
-            WalletChainBalances wcb
-        JOIN 
-            UserWallets uw ON wcb.wallet_address = uw.wallet_address
-        WHERE uw.user_id = %s
-        GROUP BY wcb.chain_id
-    )
-    SELECT 
-        upa.chain_id,
-        upa.aggregated_usd_value,
-        wcd.reported_usd_value
-    FROM 
-        user_portfolio_aggregation upa
-    LEFT JOIN 
-        wallet_chain_data wcd ON upa.chain_id = wcd.chain_id;
+    Fetches aggregated token and chain data associated with a specific user
+    (per-chain totals as in the user_chain_aggregates view, computed live).
     """
 
     df = None
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(query, (user_id, user_id))
-                rows = cursor.fetchall()
-                df = pd.DataFrame(rows, columns=[desc[0] for desc in cursor.description])
+        with transaction() as cursor:
+            cursor.execute(USER_CHAIN_AGGREGATES_QUERY, (user_id, user_id))
+            rows = cursor.fetchall()
+            df = pd.DataFrame(rows, columns=[desc[0] for desc in cursor.description])
     except Exception as e:
         print(f"Error fetching aggregated data: {e}")
 
     return df
 
 def fill_user_portfolio(user_id):
-    query = """
-    INSERT INTO UserPortfolio (user_id, token_id, name, total_token_amount, total_usd_value, wallet_address, chain)
-    SELECT 
-        uw.user_id,
-        wtb.token_id,
-        t.name,
-        SUM(wtb.amount),
-        SUM(wtb.amount * t.price),
-        uw.wallet_address,
-        t.chain  -- Added chain information
-    FROM UserWallets uw
-    JOIN WalletTokenBalances wtb ON uw.wallet_address = wtb.wallet_address
-    JOIN Tokens t ON wtb.token_id = t.id
-    WHERE uw.user_id = %s
-    GROUP BY uw.user_id, wtb.token_id, t.name, uw.wallet_address, t.chain  -- Group by chain as well
-    ON CONFLICT (user_id, token_id, wallet_address)  -- Consider whether 'chain' should be part of the conflict target
-    DO UPDATE SET 
-        name = EXCLUDED.name, 
-        total_token_amount = EXCLUDED.total_token_amount, 
-        total_usd_value = EXCLUDED.total_usd_value,
-        chain = EXCLUDED.chain;  -- Updating chain information
-"""
-
+    """
+    Rebuilds one user's portfolio, dropping positions that no longer exist.
+    The user's dashboard totals are read live, so the all-user aggregates
+    view is left to the ingest and full rebuild paths.
+    """
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
-            cur = conn.cursor()
-            cur.execute(query, (user_id,))
-            conn.commit()
+        return materialize_portfolio(user_ids=[user_id])
     except Exception as e:
         print(f"Error filling user portfolio: {e}")
 
 
-
-
-def get_data_from_table(table_name, user_id=None):
-    if user_id:
-        query = f"SELECT * FROM {table_name} WHERE user_id = %s;"
-        return execute_query_with_result(query, (user_id,))
-    else:
-        query = f"SELECT * FROM {table_name};"
-        return execute_query_with_result(query)
+def refresh_all_portfolios(incremental=True):
+    """
+    Rebuilds UserPortfolio for every user (incremental runs only touch changed
+    wallets) and refreshes the dashboard aggregates.
+    """
+    try:
+        stats = materialize_portfolio(incremental=incremental)
+        refresh_chain_aggregates()
+        return stats
+    except Exception as e:
+        print(f"Error refreshing portfolios: {e}")
 
 def get_tokens_for_user(user_id):
     """Fetches tokens for a specific user from the UserPortfolio table."""
-    query = """
-    SELECT 
-        up.user_id, up.token_id, up.wallet_address, up.chain, up.name, up.total_token_amount, 
-        up.total_usd_value, up.timestamp, up.updated_at, t.is_verified, t.is_core, t.is_wallet 
-    FROM UserPortfolio up
-    JOIN Tokens t ON up.token_id = t.id
-    WHERE up.user_id = %s;
-    """
-    rows = execute_query_with_result(query, (user_id,))
+    rows = execute_query_with_result(USER_TOKENS_QUERY, (user_id,))
     
     columns = ["user_id", "token_id", "wallet_address", "chain", "name", "total_token_amount", 
                "total_usd_value", "timestamp", "updated_at", "is_verified", "is_core", "is_wallet"]
@@ -282,21 +148,28 @@ def get_tokens_for_user(user_id):
     
     return df
 
-def get_tokens_for_user_without_spam(user_id, tokens_for_address_df):
-    """Fetches tokens for a user excluding the spam tokens for a given address, returning a DataFrame."""
-    
-    # Fetch spam tokens for the user
-    spam_tokens_row = execute_query_with_result('SELECT spam_tokens FROM UserSpamFilters WHERE user_id = %s', (user_id,))
-    
-    if spam_tokens_row:
-        spam_tokens_list = spam_tokens_row[0][0]
-        non_spam_tokens_df = tokens_for_address_df[~tokens_for_address_df['name'].isin(spam_tokens_list)]
+def get_tokens_for_user_without_spam(user_id, tokens_for_address_df, spam_tokens=None):
+    """
+    Fetches tokens for a user excluding the spam tokens for a given address, returning a DataFrame.
+    Pass `spam_tokens` (e.g. from a cache) to skip the UserSpamFilters lookup.
+    """
+    if spam_tokens is None:
+        spam_tokens = get_previously_marked_spam_tokens(user_id)
+
+    if spam_tokens:
+        non_spam_tokens_df = tokens_for_address_df[~tokens_for_address_df['name'].isin(spam_tokens)]
     else:
         non_spam_tokens_df = tokens_for_address_df.copy()
     
     return non_spam_tokens_df
 
 
+def portfolio_version(user_id):
+    """Cheap change stamp of a user's UserPortfolio rows: (max updated_at, row count)."""
+    rows = execute_query_with_result('SELECT max(updated_at), count(*) FROM UserPortfolio WHERE user_id = %s', (user_id,))
+    return tuple(rows[0]) if rows else None
+
+
 def get_non_spam_tokens_for_user(user_id):
     all_tokens_df = get_tokens_for_user(user_id)
     all_tokens_set = set(all_tokens_df['name'].tolist())
@@ -332,8 +205,8 @@ def update_spam_tokens_in_db(user_id, spam_tokens_set):
     
     if existing_record:
         # If a record exists, update the spam tokens for the user
-        query = 'UPDATE UserSpamFilters SET spam_tokens = %s WHERE user_id = %s'
-        execute_query(query, (spam_tokens_list, user_id))
+        query = 'UPDATE UserSpamFilters SET spam_tokens = %s WHERE user_id = %s AND spam_tokens IS DISTINCT FROM %s'
+        execute_query(query, (spam_tokens_list, user_id, spam_tokens_list))
     else:
         # If no record exists, insert a new one
         query = 'INSERT INTO UserSpamFilters (user_id, spam_tokens) VALUES (%s, %s)'
@@ -348,5 +221,52 @@ def get_all_unique_tokens_for_user(user_id):
 
 
 def get_all_wallet_addresses():
-    return [row[0] for row in execute_query_with_result("SELECT wallet_address FROM UserWallets;")]
+    return [row[0] for row in execute_query_with_result("SELECT DISTINCT wallet_address FROM UserWallets;")]
+
+
+def fetch_users_with_addresses():
+    """Fetches every user with their wallet addresses in one grouped query: {user_id: [address, ...]}."""
+    rows = execute_query_with_result('''
+        SELECT u.user_id,
+               COALESCE(array_agg(uw.wallet_address ORDER BY uw.wallet_address)
+                        FILTER (WHERE uw.wallet_address IS NOT NULL), '{}')
+        FROM users u
+        LEFT JOIN UserWallets uw ON uw.user_id = u.user_id
+        GROUP BY u.user_id
+        ORDER BY u.user_id;
+    ''')
+    return {user_id: list(addresses) for user_id, addresses in rows}
+
+
+def fetch_spam_tokens_for_users(user_ids):
+    """Fetches the spam token sets of several users in one query: {user_id: set}."""
+    rows = execute_query_with_result('SELECT user_id, spam_tokens FROM UserSpamFilters WHERE user_id = ANY(%s)',
+                                     (list(user_ids),))
+    spam_tokens = {user_id: set() for user_id in user_ids}
+    spam_tokens.update({user_id: set(tokens or []) for user_id, tokens in rows})
+    return spam_tokens
 
+
+def fetch_user_wallet_pairs():
+    """Fetches every (user_id, wallet_address) association."""
+    return execute_query_with_result("SELECT user_id, wallet_address FROM UserWallets;")
+
+
+
+def fetch_stored_wallet_balances():
+    """
+    Fetches the last stored total and per-chain USD values of every wallet.
+
+    Returns a dict of {wallet_address: (total_usd_value, {chain_id: usd_value})}.
+    """
+    query = """
+    SELECT w.address, w.total_usd_value, wcb.chain_id, wcb.usd_value
+    FROM Wallets w
+    LEFT JOIN WalletChainBalances wcb ON wcb.wallet_address = w.address;
+    """
+    stored = {}
+    for address, total_usd_value, chain_id, usd_value in execute_query_with_result(query):
+        _, chains = stored.setdefault(address, (total_usd_value, {}))
+        if chain_id is not None:
+            chains[chain_id] = usd_value
+    return stored
@@ -0,0 +1,225 @@
+"""
+COPY-based bulk loader for full refreshes.
+
+Normalized rows for many wallets are streamed into temporary staging tables
+with `COPY ... FROM STDIN` (CSV), then merged into Wallets, Chains,
+WalletChainBalances, TokenCatalog and WalletTokenBalances with one set-based
+`INSERT ... SELECT ... ON CONFLICT` per table; balances of tokens that a loaded
+wallet's token list no longer contains are deleted with an anti-join against
+the staged tokens. Everything runs in a single
+transaction and the load reports its rows/sec and, per table, how many rows
+were inserted, updated or unchanged.
+"""
+
+import io
+import logging
+import time
+
+from db.connection import transaction
+from db.snapshot_writer import RECORD_BALANCE_DELETIONS
+from db.write_stats import write_stats, run_counted_merge
+from utils.debank_utils import to_decimal, normalize_chain_rows, normalize_token_rows
+
+WALLET_COLUMNS = ["address", "total_usd_value"]
+CHAIN_COLUMNS = ["id", "wallet_address", "name", "logo_url", "wrapped_token_id", "community_id",
+                 "native_token_id", "is_support_pre_exec", "usd_value"]
+TOKEN_COLUMNS = ["token_id", "wallet_address", "chain", "name", "symbol", "display_symbol", "optimized_symbol",
+                 "decimals", "logo_url", "protocol_id", "price", "price_24h_change", "is_verified", "is_core",
+                 "is_wallet", "time_at", "amount"]
+# Chains whose token lists each loaded wallet was fetched for; a NULL chain means all of them.
+TOKEN_SCOPE_COLUMNS = ["wallet_address", "chain"]
+
+# Staging tables are session temp tables (never WAL-logged) dropped at commit.
+CREATE_STAGING_TABLES = '''
+    CREATE TEMP TABLE stage_wallets (LIKE Wallets INCLUDING DEFAULTS) ON COMMIT DROP;
+    CREATE TEMP TABLE stage_chains (LIKE Chains INCLUDING DEFAULTS) ON COMMIT DROP;
+    CREATE TEMP TABLE stage_tokens (
+        LIKE TokenCatalog INCLUDING DEFAULTS,
+        wallet_address VARCHAR,
+        amount NUMERIC
+    ) ON COMMIT DROP;
+    CREATE TEMP TABLE stage_token_scopes (wallet_address VARCHAR, chain VARCHAR) ON COMMIT DROP;
+'''
+
+# Balances within a loaded wallet's fetched scope that its staged tokens lack;
+# returns the number deleted.
+DELETE_STALE_BALANCES = f'''
+    WITH deleted AS (
+        DELETE FROM WalletTokenBalances wtb
+        USING stage_token_scopes s
+        WHERE wtb.wallet_address = s.wallet_address
+          AND (s.chain IS NULL OR wtb.chain = s.chain)
+          AND NOT EXISTS (
+              SELECT 1 FROM stage_tokens st
+              WHERE st.wallet_address = wtb.wallet_address AND st.chain = wtb.chain AND st.token_id = wtb.token_id
+          )
+        RETURNING wtb.wallet_address
+    ),
+    {RECORD_BALANCE_DELETIONS}
+    SELECT count(*) FROM deleted;
+'''
+
+# DISTINCT ON keeps one row per target key so a single INSERT never touches
+# the same row twice; a token held by many wallets becomes one TokenCatalog
+# row, the last loaded one winning.
+# Each entry is (table, source SELECT, INSERT INTO ..., ON CONFLICT ...) and is
+# run through run_counted_merge; the IS DISTINCT FROM guards skip unchanged rows.
+MERGE_STATEMENTS = [
+    ("Wallets",
+     '''SELECT DISTINCT ON (address) address, total_usd_value
+        FROM stage_wallets
+        ORDER BY address, ctid DESC''',
+     "INSERT INTO Wallets (address, total_usd_value)",
+     '''ON CONFLICT (address)
+        DO UPDATE SET total_usd_value = EXCLUDED.total_usd_value
+        WHERE Wallets.total_usd_value IS DISTINCT FROM EXCLUDED.total_usd_value'''),
+    ("Chains",
+     '''SELECT DISTINCT ON (id, wallet_address)
+            id, wallet_address, name, logo_url, wrapped_token_id, community_id, native_token_id, is_support_pre_exec, usd_value
+        FROM stage_chains
+        ORDER BY id, wallet_address, ctid DESC''',
+     "INSERT INTO Chains (id, wallet_address, name, logo_url, wrapped_token_id, community_id, native_token_id, is_support_pre_exec, usd_value)",
+     '''ON CONFLICT (id, wallet_address)
+        DO UPDATE SET
+            name = EXCLUDED.name,
+            logo_url = EXCLUDED.logo_url,
+            wrapped_token_id = EXCLUDED.wrapped_token_id,
+            community_id = EXCLUDED.community_id,
+            native_token_id = EXCLUDED.native_token_id,
+            is_support_pre_exec = EXCLUDED.is_support_pre_exec,
+            usd_value = EXCLUDED.usd_value
+        WHERE (Chains.name, Chains.logo_url, Chains.wrapped_token_id, Chains.community_id, Chains.native_token_id, Chains.is_support_pre_exec, Chains.usd_value)
+            IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.logo_url, EXCLUDED.wrapped_token_id, EXCLUDED.community_id, EXCLUDED.native_token_id, EXCLUDED.is_support_pre_exec, EXCLUDED.usd_value)'''),
+    ("WalletChainBalances",
+     '''SELECT DISTINCT ON (wallet_address, id) wallet_address, id, usd_value
+        FROM stage_chains
+        ORDER BY wallet_address, id, ctid DESC''',
+     "INSERT INTO WalletChainBalances (wallet_address, chain_id, usd_value)",
+     '''ON CONFLICT (wallet_address, chain_id)
+        DO UPDATE SET usd_value = EXCLUDED.usd_value
+        WHERE WalletChainBalances.usd_value IS DISTINCT FROM EXCLUDED.usd_value'''),
+    ("TokenCatalog",
+     '''SELECT DISTINCT ON (chain, token_id)
+            chain, token_id, name, symbol, display_symbol, optimized_symbol, decimals, logo_url, protocol_id, price, price_24h_change, is_verified, is_core, is_wallet, time_at
+        FROM stage_tokens
+        ORDER BY chain, token_id, ctid DESC''',
+     "INSERT INTO TokenCatalog (chain, token_id, name, symbol, display_symbol, optimized_symbol, decimals, logo_url, protocol_id, price, price_24h_change, is_verified, is_core, is_wallet, time_at)",
+     '''ON CONFLICT (chain, token_id)
+        DO UPDATE SET
+            name = EXCLUDED.name,
+            symbol = EXCLUDED.symbol,
+            display_symbol = EXCLUDED.display_symbol,
+            optimized_symbol = EXCLUDED.optimized_symbol,
+            decimals = EXCLUDED.decimals,
+            logo_url = EXCLUDED.logo_url,
+            protocol_id = EXCLUDED.protocol_id,
+            price = EXCLUDED.price,
+            price_24h_change = EXCLUDED.price_24h_change,
+            is_verified = EXCLUDED.is_verified,
+            is_core = EXCLUDED.is_core,
+            is_wallet = EXCLUDED.is_wallet,
+            time_at = EXCLUDED.time_at
+        WHERE (TokenCatalog.name, TokenCatalog.symbol, TokenCatalog.display_symbol, TokenCatalog.optimized_symbol, TokenCatalog.decimals, TokenCatalog.logo_url, TokenCatalog.protocol_id, TokenCatalog.price, TokenCatalog.price_24h_change, TokenCatalog.is_verified, TokenCatalog.is_core, TokenCatalog.is_wallet, TokenCatalog.time_at)
+            IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.symbol, EXCLUDED.display_symbol, EXCLUDED.optimized_symbol, EXCLUDED.decimals, EXCLUDED.logo_url, EXCLUDED.protocol_id, EXCLUDED.price, EXCLUDED.price_24h_change, EXCLUDED.is_verified, EXCLUDED.is_core, EXCLUDED.is_wallet, EXCLUDED.time_at)'''),
+    ("WalletTokenBalances",
+     '''SELECT DISTINCT ON (wallet_address, chain, token_id) wallet_address, chain, token_id, amount
+        FROM stage_tokens
+        ORDER BY wallet_address, chain, token_id, ctid DESC''',
+     "INSERT INTO WalletTokenBalances (wallet_address, chain, token_id, amount)",
+     '''ON CONFLICT (wallet_address, chain, token_id)
+        DO UPDATE SET amount = EXCLUDED.amount
+        WHERE WalletTokenBalances.amount IS DISTINCT FROM EXCLUDED.amount'''),
+]
+
+
+# COPY reads an unquoted \N as NULL. Every other value is quoted, so empty
+# strings (DeBank's protocol_id "") stay empty strings, as with execute_values.
+COPY_NULL = r"\N"
+
+
+def _csv_field(value):
+    if value is None:
+        return COPY_NULL
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def _csv_buffer(rows):
+    """Encodes rows as COPY-compatible CSV (see COPY_NULL)."""
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write(",".join(_csv_field(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    return buffer
+
+
+def copy_rows(cursor, table, columns, rows):
+    """Streams rows into `table` with COPY FROM STDIN."""
+    if not rows:
+        return 0
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')",
+                       _csv_buffer(rows))
+    return len(rows)
+
+
+class BulkLoadBuffer:
+    """Collects normalized rows from many wallets for one bulk load."""
+
+    def __init__(self):
+        self.wallet_rows = []
+        self.chain_rows = []
+        self.token_rows = []
+        self.token_scopes = []
+
+    def add_wallet(self, wallet_address, raw_balance_data, raw_token_data):
+        """Same signature as save_raw_data_to_db, so it can be used as the engine's writer."""
+        self.wallet_rows.append((wallet_address, to_decimal(raw_balance_data['total_usd_value'])))
+        self.chain_rows.extend(normalize_chain_rows(wallet_address, raw_balance_data))
+        self.token_rows.extend(normalize_token_rows(wallet_address, raw_token_data))
+        self.token_scopes.append((wallet_address, None))
+
+    def add_snapshot(self, wallet_address, total_usd_value, chain_rows, token_rows, token_chains=None):
+        """Adds a snapshot that was already normalized (see db.snapshot_writer.normalize_snapshot)."""
+        self.wallet_rows.append((wallet_address, total_usd_value))
+        self.chain_rows.extend(chain_rows)
+        self.token_rows.extend(token_rows)
+        self.token_scopes.extend([(wallet_address, None)] if token_chains is None
+                                 else [(wallet_address, chain) for chain in token_chains])
+
+    def __len__(self):
+        return len(self.wallet_rows)
+
+
+def bulk_load(buffer):
+    """
+    Loads everything collected in a BulkLoadBuffer with COPY + set-based merges.
+
+    Returns a stats dict with row counts, elapsed time and rows/sec.
+    """
+    started = time.monotonic()
+    with transaction() as cursor:
+        cursor.execute(CREATE_STAGING_TABLES)
+        staged = copy_rows(cursor, "stage_wallets", WALLET_COLUMNS, buffer.wallet_rows)
+        staged += copy_rows(cursor, "stage_chains", CHAIN_COLUMNS, buffer.chain_rows)
+        staged += copy_rows(cursor, "stage_tokens", TOKEN_COLUMNS, buffer.token_rows)
+        copy_rows(cursor, "stage_token_scopes", TOKEN_SCOPE_COLUMNS, buffer.token_scopes)
+        copied_at = time.monotonic()
+
+        merged = {}
+        for table, source_sql, insert_sql, conflict_sql in MERGE_STATEMENTS:
+            merged[table] = run_counted_merge(cursor, table, source_sql, insert_sql, conflict_sql)
+        cursor.execute(DELETE_STALE_BALANCES)
+        merged["WalletTokenBalances"]["deleted"] = deleted = cursor.fetchone()[0]
+        write_stats.record_deleted("WalletTokenBalances", deleted)
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    stats = {
+        "wallets": len(buffer),
+        "staged_rows": staged,
+        "merged_rows": merged,
+        "copy_seconds": round(copied_at - started, 3),
+        "elapsed_seconds": round(elapsed, 3),
+        "rows_per_second": round(staged / elapsed, 1),
+    }
+    logging.info(f"Bulk load finished: {stats}")
+    return stats
@@ -0,0 +1,147 @@
+"""
+Shared PostgreSQL access backed by a thread-safe connection pool.
+
+All database modules go through this one instead of opening a new
+psycopg2 connection per statement.
+
+    with transaction() as cursor:
+        cursor.execute(...)
+
+commits on success and rolls back if the block raises. When all
+DB_POOL_MAX_SIZE connections are checked out, callers wait up to
+DB_POOL_TIMEOUT seconds for one to be returned instead of failing at once.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions, pool
+from decouple import config
+
+DATABASE_URL = config('DATABASE_URL').replace("postgresql+psycopg2://", "postgresql://")
+DB_POOL_MIN_SIZE = config('DB_POOL_MIN_SIZE', default=1, cast=int)
+DB_POOL_MAX_SIZE = config('DB_POOL_MAX_SIZE', default=10, cast=int)
+# Connections idle for longer than this are pinged before being handed out.
+DB_POOL_HEALTH_CHECK_AFTER = config('DB_POOL_HEALTH_CHECK_AFTER', default=30.0, cast=float)
+# Seconds a caller waits for a free connection before giving up.
+DB_POOL_TIMEOUT = config('DB_POOL_TIMEOUT', default=30.0, cast=float)
+
+_pool = None
+_pool_lock = threading.Lock()
+# One slot per pooled connection: ThreadedConnectionPool raises PoolError
+# instead of blocking once maxconn connections are checked out.
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_SIZE)
+_last_used = {}
+
+
+def get_pool():
+    """Returns the process-wide connection pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = pool.ThreadedConnectionPool(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DATABASE_URL)
+    return _pool
+
+
+def close_pool():
+    """Closes every pooled connection, e.g. before a process exits."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _last_used.clear()
+
+
+def _is_healthy(conn):
+    if conn.closed or conn.info.transaction_status == extensions.TRANSACTION_STATUS_UNKNOWN:
+        return False
+    if time.monotonic() - _last_used.get(id(conn), 0) < DB_POOL_HEALTH_CHECK_AFTER:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _checkout():
+    """Takes a pool slot and a healthy connection; the caller releases the slot after putconn."""
+    if not _pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise pool.PoolError(f"No database connection became free within {DB_POOL_TIMEOUT}s.")
+    try:
+        connection_pool = get_pool()
+        # Bounded retry: a broken connection is discarded and a fresh one taken.
+        for _ in range(DB_POOL_MAX_SIZE + 1):
+            conn = connection_pool.getconn()
+            if _is_healthy(conn):
+                return conn
+            connection_pool.putconn(conn, close=True)
+            _last_used.pop(id(conn), None)
+        raise psycopg2.OperationalError("Could not obtain a healthy database connection.")
+    except BaseException:
+        _pool_slots.release()
+        raise
+
+
+@contextmanager
+def connection():
+    """Checks a connection out of the pool and returns it afterwards."""
+    conn = _checkout()
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        if not broken and not conn.closed:
+            if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            _last_used[id(conn)] = time.monotonic()
+        else:
+            _last_used.pop(id(conn), None)
+        try:
+            get_pool().putconn(conn, close=broken or bool(conn.closed))
+        finally:
+            _pool_slots.release()
+
+
+@contextmanager
+def transaction():
+    """Yields a cursor inside a single transaction: commit on success, rollback on error."""
+    with connection() as conn:
+        try:
+            with conn.cursor() as cursor:
+                yield cursor
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+
+
+# Utility functions for database operations
+
+def execute_query(query, values=None):
+    try:
+        with transaction() as cursor:
+            cursor.execute(query, values)
+    except Exception as e:
+        print(f"Error executing query: {e}")
+
+
+def execute_query_with_result(query, values=None):
+    try:
+        with transaction() as cursor:
+            cursor.execute(query, values)
+            return cursor.fetchall()
+    except Exception as e:
+        print(f"Error executing query: {e}")
+        return []
@@ -1,183 +1,133 @@
-import psycopg2
-from app_user_operations import execute_query, execute_query_with_result ,to_decimal
+from db.connection import execute_query, execute_query_with_result, transaction
+from db.snapshot_writer import (upsert_rows, UPSERT_WALLETS, UPSERT_CHAINS, UPSERT_WALLET_CHAIN_BALANCES,
+                                UPSERT_TOKEN_CATALOG, UPSERT_WALLET_TOKEN_BALANCES, SNAPSHOT_PAGE_SIZE,
+                                catalog_rows, balance_rows, delete_stale_balances)
+from psycopg2.extras import execute_batch
+from utils.debank_utils import to_decimal, normalize_chain_rows, normalize_token_rows
 from datetime import datetime
 
 
 
 def insert_update_evm_wallet(wallet_address, raw_balance_data):
-    query = '''
-        INSERT INTO Wallets (address, total_usd_value)
-        VALUES (%s, %s)
-        ON CONFLICT (address)
-        DO UPDATE SET total_usd_value = EXCLUDED.total_usd_value;
-    '''
-    values = (wallet_address, to_decimal(raw_balance_data['total_usd_value']))
-    execute_query(query, values)
+    with transaction() as cursor:
+        upsert_rows(cursor, "Wallets", UPSERT_WALLETS, [(wallet_address, to_decimal(raw_balance_data['total_usd_value']))])
 
 def insert_update_evm_chains(wallet_address, raw_balance_data_debank):
-    # Loop through each chain in the raw_balance_data_debank['chain_list']
-    for chain in raw_balance_data_debank['chain_list']:
-        # Construct the SQL query for inserting/updating chain data
-        query = '''
-            INSERT INTO Chains (
-                id, wallet_address, name, logo_url, wrapped_token_id,
-                community_id, native_token_id, is_support_pre_exec, usd_value
-            )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (id, wallet_address)
-            DO UPDATE SET 
-                name = EXCLUDED.name, 
-                logo_url = EXCLUDED.logo_url, 
-                wrapped_token_id = EXCLUDED.wrapped_token_id,
-                community_id = EXCLUDED.community_id,
-                native_token_id = EXCLUDED.native_token_id,
-                is_support_pre_exec = EXCLUDED.is_support_pre_exec,
-                usd_value = EXCLUDED.usd_value;
-        '''
-        # Prepare the values to be inserted/updated
-        values = (
-            chain['id'], wallet_address, chain['name'], chain['logo_url'],
-            chain['wrapped_token_id'], chain.get('community_id'), chain.get('native_token_id'),
-            chain.get('is_support_pre_exec'), to_decimal(chain['usd_value'])
-        )
-        # Execute the query
-        execute_query(query, values)
+    # All chains in raw_balance_data_debank['chain_list'] go out as multi-row batches in one transaction
+    chain_rows = normalize_chain_rows(wallet_address, raw_balance_data_debank)
+    with transaction() as cursor:
+        upsert_rows(cursor, "Chains", UPSERT_CHAINS, chain_rows)
 
 def insert_update_wallet_chain_balances(wallet_address, raw_balance_data_debank):
-    for chain in raw_balance_data_debank['chain_list']:
-        query = '''
-            INSERT INTO WalletChainBalances (wallet_address, chain_id, usd_value)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (wallet_address, chain_id)
-            DO UPDATE SET usd_value = EXCLUDED.usd_value;
-        '''
-        values = (wallet_address, chain['id'], to_decimal(chain['usd_value']))
-        execute_query(query, values)
+    values = [
+        (wallet_address, chain['id'], to_decimal(chain['usd_value']))
+        for chain in raw_balance_data_debank['chain_list']
+    ]
+    with transaction() as cursor:
+        upsert_rows(cursor, "WalletChainBalances", UPSERT_WALLET_CHAIN_BALANCES, values)
 
 
 def insert_update_evm_tokens(wallet_address, raw_token_data_debank):
-    # Loop through each token in raw_token_data_debank
-    for token in raw_token_data_debank:
-        # Convert UNIX timestamp to datetime
-        time_at_value = None
-        if 'time_at' in token and isinstance(token.get('time_at'), (int, float)):
-            try:
-                time_at_value = datetime.utcfromtimestamp(token.get('time_at')).strftime('%Y-%m-%d %H:%M:%S')
-            except:
-                pass
-        
-        # Construct the SQL query for inserting/updating token data
-        query = '''
-            INSERT INTO Tokens (
-                id, wallet_address, chain, name, symbol, 
-                display_symbol, optimized_symbol, decimals, 
-                logo_url, protocol_id, price, price_24h_change, 
-                is_verified, is_core, is_wallet, time_at, amount
-            )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (id)
-            DO UPDATE SET 
-                chain = EXCLUDED.chain, 
-                name = EXCLUDED.name, 
-                symbol = EXCLUDED.symbol,
-                display_symbol = EXCLUDED.display_symbol,
-                optimized_symbol = EXCLUDED.optimized_symbol,
-                decimals = EXCLUDED.decimals,
-                logo_url = EXCLUDED.logo_url,
-                protocol_id = EXCLUDED.protocol_id,
-                price = EXCLUDED.price,
-                price_24h_change = EXCLUDED.price_24h_change,
-                is_verified = EXCLUDED.is_verified,
-                is_core = EXCLUDED.is_core,
-                is_wallet = EXCLUDED.is_wallet,
-                time_at = EXCLUDED.time_at,
-                amount = EXCLUDED.amount;
-        '''
-        # Prepare the values to be inserted/updated
-        values = (
-            token['id'], wallet_address, token['chain'], token['name'],
-            token['symbol'], token.get('display_symbol'), token.get('optimized_symbol'),
-            token.get('decimals'), token.get('logo_url'), token.get('protocol_id'),
-            to_decimal(token['price']), to_decimal(token.get('price_24h_change')),
-            token.get('is_verified'), token.get('is_core'), token.get('is_wallet'),
-            time_at_value, to_decimal(token.get('amount'))
-        )
-        # Execute the query
-        execute_query(query, values)
+    # Token metadata and prices are normalized (decimals, time_at timestamps) and upserted
+    # into the catalog in batches, one row per (chain, token id)
+    token_rows = normalize_token_rows(wallet_address, raw_token_data_debank)
+    with transaction() as cursor:
+        upsert_rows(cursor, "TokenCatalog", UPSERT_TOKEN_CATALOG, catalog_rows(token_rows))
 
 def insert_update_wallet_token_balances(wallet_address, raw_token_data_debank):
-    for token in raw_token_data_debank:
-        query = '''
-            INSERT INTO WalletTokenBalances (wallet_address, token_id, amount)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (wallet_address, token_id)
-            DO UPDATE SET amount = EXCLUDED.amount;
-        '''
-        values = (wallet_address, token['id'], to_decimal(token['amount']))
-        execute_query(query, values)
+    # Keyed by (chain, token id), last occurrence wins (same as one upsert per token);
+    # the tokens must already be in the catalog (insert_update_evm_tokens). Tokens the
+    # wallet no longer holds are deleted in the same transaction
+    values = balance_rows(normalize_token_rows(wallet_address, raw_token_data_debank))
+    with transaction() as cursor:
+        upsert_rows(cursor, "WalletTokenBalances", UPSERT_WALLET_TOKEN_BALANCES, values)
+        delete_stale_balances(cursor, [(wallet_address, None)], values)
 
 
 
 def insert_update_evm_nfts(wallet_address, raw_evm_nft_data):
-    for nft in raw_evm_nft_data:
-        # Insert or update NFTs table
-        nft_query = '''
-            INSERT INTO NFTs (
-                id, wallet_address, contract_id, inner_id, chain,
-                name, description, content_type, content, thumbnail_url,
-                total_supply, detail_url, collection_id, contract_name,
-                is_erc721, is_erc1155, amount, usd_price
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (id)
-            DO UPDATE SET
-                DO UPDATE SET
-                wallet_address = EXCLUDED.wallet_address,
-                contract_id = EXCLUDED.contract_id,
-                inner_id = EXCLUDED.inner_id,
-                chain = EXCLUDED.chain,
-                name = EXCLUDED.name,
-                description = EXCLUDED.description,
-                content_type = EXCLUDED.content_type,
-                content = EXCLUDED.content,
-                thumbnail_url = EXCLUDED.thumbnail_url,
-                total_supply = EXCLUDED.total_supply,
-                detail_url = EXCLUDED.detail_url,
-                collection_id = EXCLUDED.collection_id,
-                contract_name = EXCLUDED.contract_name,
-                is_erc721 = EXCLUDED.is_erc721,
-                is_erc1155 = EXCLUDED.is_erc1155,
-                amount = EXCLUDED.amount,
-                usd_price = EXCLUDED.usd_price;
-        '''
-        nft_values = (
-            nft['id'], wallet_address, nft['contract_id'], nft['inner_id'],
-            nft['chain'], nft['name'], nft['description'], nft['content_type'],
-            nft['content'], nft['thumbnail_url'], nft['total_supply'],
-            nft['detail_url'], nft['collection_id'], nft['contract_name'],
-            nft['is_erc721'], nft['is_erc1155'], nft['amount'], to_decimal(nft['usd_price'])
-        )
-        execute_query(nft_query, nft_values)
-        
-        # Insert or update Attributes table
-        attributes = nft.get('attributes', [])
-        for attribute in attributes:
-            attribute_query = '''
-                INSERT INTO Attributes (
-                    wallet_address, nft_id, key, trait_type, value
-                ) VALUES (%s, %s, %s, %s, %s)
-                ON CONFLICT (attribute_id)
-                DO UPDATE SET
-                    nft_id = EXCLUDED.nft_id,
-                    key = EXCLUDED.key,
-                    trait_type = EXCLUDED.trait_type,
-                    value = EXCLUDED.value;
+    # Insert or update NFTs table
+    nft_query = '''
+        INSERT INTO NFTs (
+            id, wallet_address, contract_id, inner_id, chain,
+            name, description, content_type, content, thumbnail_url,
+            total_supply, detail_url, collection_id, contract_name,
+            is_erc721, is_erc1155, amount, usd_price
+        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (id)
+        DO UPDATE SET
+            wallet_address = EXCLUDED.wallet_address,
+            contract_id = EXCLUDED.contract_id,
+            inner_id = EXCLUDED.inner_id,
+            chain = EXCLUDED.chain,
+            name = EXCLUDED.name,
+            description = EXCLUDED.description,
+            content_type = EXCLUDED.content_type,
+            content = EXCLUDED.content,
+            thumbnail_url = EXCLUDED.thumbnail_url,
+            total_supply = EXCLUDED.total_supply,
+            detail_url = EXCLUDED.detail_url,
+            collection_id = EXCLUDED.collection_id,
+            contract_name = EXCLUDED.contract_name,
+            is_erc721 = EXCLUDED.is_erc721,
+            is_erc1155 = EXCLUDED.is_erc1155,
+            amount = EXCLUDED.amount,
+            usd_price = EXCLUDED.usd_price
+        WHERE (NFTs.wallet_address, NFTs.contract_id, NFTs.inner_id, NFTs.chain, NFTs.name, NFTs.description, NFTs.content_type, NFTs.content, NFTs.thumbnail_url, NFTs.total_supply, NFTs.detail_url, NFTs.collection_id, NFTs.contract_name, NFTs.is_erc721, NFTs.is_erc1155, NFTs.amount, NFTs.usd_price)
+            IS DISTINCT FROM (EXCLUDED.wallet_address, EXCLUDED.contract_id, EXCLUDED.inner_id, EXCLUDED.chain, EXCLUDED.name, EXCLUDED.description, EXCLUDED.content_type, EXCLUDED.content, EXCLUDED.thumbnail_url, EXCLUDED.total_supply, EXCLUDED.detail_url, EXCLUDED.collection_id, EXCLUDED.contract_name, EXCLUDED.is_erc721, EXCLUDED.is_erc1155, EXCLUDED.amount, EXCLUDED.usd_price);
+    '''
+    # Insert or update Attributes table
+    attribute_query = '''
+        INSERT INTO Attributes (
+            wallet_address, nft_id, key, trait_type, value
+        ) VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (attribute_id)
+        DO UPDATE SET
+            nft_id = EXCLUDED.nft_id,
+            key = EXCLUDED.key,
+            trait_type = EXCLUDED.trait_type,
+            value = EXCLUDED.value
+        WHERE (Attributes.nft_id, Attributes.key, Attributes.trait_type, Attributes.value)
+            IS DISTINCT FROM (EXCLUDED.nft_id, EXCLUDED.key, EXCLUDED.trait_type, EXCLUDED.value);
+    '''
 
-            '''
-            attribute_values = (
-                wallet_address, nft['id'], attribute['key'],
-                attribute['trait_type'], attribute['value']
+    # raw_evm_nft_data may be any iterable of NFTs: flush every
+    # SNAPSHOT_PAGE_SIZE NFTs so memory is bounded by the batch, not the payload.
+    nft_batch = []
+    attribute_batch = []
+    with transaction() as cursor:
+        for nft in raw_evm_nft_data:
+            nft_values = (
+                nft['id'], wallet_address, nft['contract_id'], nft['inner_id'],
+                nft['chain'], nft['name'], nft['description'], nft['content_type'],
+                nft['content'], nft['thumbnail_url'], nft['total_supply'],
+                nft['detail_url'], nft['collection_id'], nft['contract_name'],
+                nft['is_erc721'], nft['is_erc1155'], nft['amount'], to_decimal(nft['usd_price'])
             )
-            execute_query(attribute_query, attribute_values)
+            nft_batch.append(nft_values)
+
+            # Collect the NFT's attributes
+            attributes = nft.get('attributes', [])
+            for attribute in attributes:
+                attribute_values = (
+                    wallet_address, nft['id'], attribute['key'],
+                    attribute['trait_type'], attribute['value']
+                )
+                attribute_batch.append(attribute_values)
+
+            if len(nft_batch) >= SNAPSHOT_PAGE_SIZE:
+                _flush_nft_batches(cursor, nft_query, nft_batch, attribute_query, attribute_batch)
+
+        _flush_nft_batches(cursor, nft_query, nft_batch, attribute_query, attribute_batch)
+
+
+def _flush_nft_batches(cursor, nft_query, nft_batch, attribute_query, attribute_batch):
+    if nft_batch:
+        execute_batch(cursor, nft_query, nft_batch, page_size=SNAPSHOT_PAGE_SIZE)
+    if attribute_batch:
+        execute_batch(cursor, attribute_query, attribute_batch, page_size=SNAPSHOT_PAGE_SIZE)
+    nft_batch.clear()
+    attribute_batch.clear()
 
 
 def insert_update_solana_wallet(wallet_address, raw_solana_data):
@@ -190,7 +140,9 @@ def insert_update_solana_wallet(wallet_address, raw_solana_data):
         ON CONFLICT (wallet_address)
         DO UPDATE SET
             lamports = EXCLUDED.lamports,
-            solana = EXCLUDED.solana;
+            solana = EXCLUDED.solana
+        WHERE (Native_Balance_sol.lamports, Native_Balance_sol.solana)
+            IS DISTINCT FROM (EXCLUDED.lamports, EXCLUDED.solana);
     ''', (
         wallet_address, native_balance.get('lamports'), to_decimal(native_balance.get('solana'))
     ))
@@ -209,7 +161,9 @@ def insert_update_solana_wallet(wallet_address, raw_solana_data):
                 amount = EXCLUDED.amount,
                 decimals = EXCLUDED.decimals,
                 name = EXCLUDED.name,
-                symbol = EXCLUDED.symbol;
+                symbol = EXCLUDED.symbol
+            WHERE (Tokens_sol.mint, Tokens_sol.amount_raw, Tokens_sol.amount, Tokens_sol.decimals, Tokens_sol.name, Tokens_sol.symbol)
+                IS DISTINCT FROM (EXCLUDED.mint, EXCLUDED.amount_raw, EXCLUDED.amount, EXCLUDED.decimals, EXCLUDED.name, EXCLUDED.symbol);
         ''', (
             wallet_address, token['associated_token_address'], token['mint'],
             token['amount_raw'], to_decimal(token['amount']), token['decimals'],
@@ -230,7 +184,9 @@ def insert_update_solana_wallet(wallet_address, raw_solana_data):
                 amount = EXCLUDED.amount,
                 decimals = EXCLUDED.decimals,
                 name = EXCLUDED.name,
-                symbol = EXCLUDED.symbol;
+                symbol = EXCLUDED.symbol
+            WHERE (NFTs_sol.mint, NFTs_sol.amount_raw, NFTs_sol.amount, NFTs_sol.decimals, NFTs_sol.name, NFTs_sol.symbol)
+                IS DISTINCT FROM (EXCLUDED.mint, EXCLUDED.amount_raw, EXCLUDED.amount, EXCLUDED.decimals, EXCLUDED.name, EXCLUDED.symbol);
         ''', (
             wallet_address, nft['associated_token_address'], nft['mint'],
             nft['amount_raw'], to_decimal(nft['amount']), nft['decimals'],
@@ -257,7 +213,9 @@ def insert_update_bitcoin_wallet(wallet_address, raw_bitcoin_data):
             unconfirmed_sent = EXCLUDED.unconfirmed_sent,
             unspent_tx_count = EXCLUDED.unspent_tx_count,
             first_tx = EXCLUDED.first_tx,
-            last_tx = EXCLUDED.last_tx;
+            last_tx = EXCLUDED.last_tx
+        WHERE (Native_Balance_btc.received, Native_Balance_btc.sent, Native_Balance_btc.balance, Native_Balance_btc.tx_count, Native_Balance_btc.unconfirmed_tx_count, Native_Balance_btc.unconfirmed_received, Native_Balance_btc.unconfirmed_sent, Native_Balance_btc.unspent_tx_count, Native_Balance_btc.first_tx, Native_Balance_btc.last_tx)
+            IS DISTINCT FROM (EXCLUDED.received, EXCLUDED.sent, EXCLUDED.balance, EXCLUDED.tx_count, EXCLUDED.unconfirmed_tx_count, EXCLUDED.unconfirmed_received, EXCLUDED.unconfirmed_sent, EXCLUDED.unspent_tx_count, EXCLUDED.first_tx, EXCLUDED.last_tx);
     '''
     btc_values = (
         wallet_address, raw_bitcoin_data['user_id'],
@@ -0,0 +1,343 @@
+"""
+Time-partitioned, append-only history storage.
+
+Every `<table>_History` table is range-partitioned by `backup_timestamp`, one
+partition per month (`<table>_history_pYYYYMM`) plus a DEFAULT partition as a
+safety net, with a BRIN index on `backup_timestamp`. The backup triggers keep
+inserting into the parent table unchanged.
+
+Upcoming monthly partitions are created by migrations, at the start of every
+ingestion run and by the retention job (`ensure_upcoming_partitions`). Rows
+that still land in DEFAULT, because their month had no partition yet, are
+moved into a monthly partition of their own the next time partitions are
+ensured, so they are rolled up and dropped like any other month.
+
+`run_history_retention` is the retention job: it ensures partitions, rolls raw partitions older than the retention window up into
+`<table>_History_Daily` (the last state of each row per day) and drops them.
+Run it from cron with `python -m db.history`.
+"""
+
+import logging
+from datetime import date
+
+from decouple import config
+
+from db.connection import transaction
+
+logging.basicConfig(level=logging.INFO)
+
+HISTORY_RETENTION_MONTHS = config('HISTORY_RETENTION_MONTHS', default=3, cast=int)
+HISTORY_PARTITIONS_AHEAD = config('HISTORY_PARTITIONS_AHEAD', default=2, cast=int)
+
+# History tables and the key columns that identify a row in their base table.
+HISTORY_TABLES = {
+    "Wallets": ["address"],
+    "Chains": ["id", "wallet_address"],
+    "Tokens": ["id"],
+    "NFTs": ["id"],
+    "TokenCatalog": ["chain", "token_id"],
+    "UserPortfolio": ["user_id", "chain", "token_id", "wallet_address"],
+    "WalletChainBalances": ["wallet_address", "chain_id"],
+    "WalletTokenBalances": ["wallet_address", "chain", "token_id"],
+    "Attributes": ["attribute_id"],
+    "bitcoin_addresses": ["address"],
+}
+
+
+def _add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def partition_name(table, month):
+    return f"{table.lower()}_history_p{month:%Y%m}"
+
+
+def create_month_partition(cursor, table, month):
+    """Creates the monthly partition of <table>_History starting at `month`."""
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {partition_name(table, month)}
+        PARTITION OF {table}_History
+        FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{_add_months(month, 1):%Y-%m-%d}');
+    ''')
+
+
+def table_columns(cursor, relation):
+    """Returns [(column, type)] of `relation` (resolved through search_path) in column order."""
+    cursor.execute('''
+        SELECT attname, format_type(atttypid, atttypmod)
+        FROM pg_attribute
+        WHERE attrelid = to_regclass(%s) AND attnum > 0 AND NOT attisdropped
+        ORDER BY attnum;
+    ''', (relation.lower(),))
+    return cursor.fetchall()
+
+
+def add_missing_columns(cursor, source, target):
+    """Adds columns that `source` has and `target` lacks, e.g. after a base table migration."""
+    existing = {name for name, _ in table_columns(cursor, target)}
+    for name, column_type in table_columns(cursor, source):
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {target} ADD COLUMN {name} {column_type};")
+
+
+def _is_partitioned(cursor, table):
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s);", (f"{table}_History".lower(),))
+    row = cursor.fetchone()
+    return None if row is None else row[0] == 'p'
+
+
+def create_history_table(cursor, table, months_ahead=HISTORY_PARTITIONS_AHEAD):
+    """
+    Creates <table>_History as a partitioned table, converting a legacy
+    (plain heap) history table in place if one exists.
+    """
+    partitioned = _is_partitioned(cursor, table)
+    if partitioned:
+        add_missing_columns(cursor, table, f"{table}_History")
+        return ensure_history_partitions(cursor, table, months_ahead)
+
+    legacy = f"{table}_History_Legacy"
+    if partitioned is False:
+        cursor.execute(f"ALTER TABLE {table}_History RENAME TO {legacy};")
+
+    cursor.execute(f'''
+        CREATE TABLE {table}_History (
+            LIKE {table},
+            backup_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+        ) PARTITION BY RANGE (backup_timestamp);
+        CREATE TABLE {table.lower()}_history_default PARTITION OF {table}_History DEFAULT;
+        CREATE INDEX {table.lower()}_history_backup_timestamp_brin ON {table}_History USING BRIN (backup_timestamp);
+    ''')
+
+    first_month = _month_start(date.today())
+    if partitioned is False:
+        cursor.execute(f"SELECT min(backup_timestamp)::date FROM {legacy};")
+        oldest = cursor.fetchone()[0]
+        if oldest is not None:
+            first_month = min(first_month, _month_start(oldest))
+
+    month = first_month
+    while month <= _add_months(_month_start(date.today()), months_ahead):
+        create_month_partition(cursor, table, month)
+        month = _add_months(month, 1)
+
+    if partitioned is False:
+        current = {name for name, _ in table_columns(cursor, f"{table}_History")}
+        columns = ", ".join(name for name, _ in table_columns(cursor, legacy) if name in current)
+        cursor.execute(f"INSERT INTO {table}_History ({columns}) SELECT {columns} FROM {legacy};")
+        cursor.execute(f"DROP TABLE {legacy};")
+
+
+def default_partition_name(table):
+    return f"{table.lower()}_history_default"
+
+
+def move_default_partition_rows(cursor, table):
+    """
+    Moves rows of the DEFAULT partition into monthly partitions and returns the
+    months created for them.
+
+    A monthly partition cannot be created while DEFAULT holds rows in its range,
+    so DEFAULT is detached, the months are created and filled from it, and it is
+    attached again (empty) within the caller's transaction.
+    """
+    default = default_partition_name(table)
+    cursor.execute(f"SELECT DISTINCT date_trunc('month', backup_timestamp)::date FROM {default};")
+    months = sorted(month for (month,) in cursor.fetchall())
+    if not months:
+        return []
+
+    columns = ", ".join(name for name, _ in table_columns(cursor, f"{table}_History"))
+    cursor.execute(f"ALTER TABLE {table}_History DETACH PARTITION {default};")
+    for month in months:
+        create_month_partition(cursor, table, month)
+        cursor.execute(f'''
+            WITH moved AS (
+                DELETE FROM {default}
+                WHERE backup_timestamp >= %(start)s AND backup_timestamp < %(end)s
+                RETURNING {columns}
+            )
+            INSERT INTO {partition_name(table, month)} ({columns}) SELECT {columns} FROM moved;
+        ''', {"start": month, "end": _add_months(month, 1)})
+    cursor.execute(f"ALTER TABLE {table}_History ATTACH PARTITION {default} DEFAULT;")
+    logging.info(f"Moved DEFAULT rows of {table}_History into {len(months)} monthly partitions.")
+    return months
+
+
+def ensure_history_partitions(cursor, table, months_ahead=HISTORY_PARTITIONS_AHEAD):
+    """
+    Creates the current and next `months_ahead` monthly partitions if missing,
+    after moving rows stranded in DEFAULT into partitions of their own.
+    """
+    move_default_partition_rows(cursor, table)
+    current = _month_start(date.today())
+    for offset in range(months_ahead + 1):
+        create_month_partition(cursor, table, _add_months(current, offset))
+
+
+def ensure_upcoming_partitions(months_ahead=HISTORY_PARTITIONS_AHEAD):
+    """
+    Runs ensure_history_partitions for every partitioned history table, one
+    transaction per table. Returns the tables that failed (and were logged).
+    """
+    failed = []
+    for table in HISTORY_TABLES:
+        try:
+            with transaction() as cursor:
+                if _is_partitioned(cursor, table):
+                    ensure_history_partitions(cursor, table, months_ahead)
+        except Exception:
+            logging.exception(f"Could not ensure history partitions for {table}.")
+            failed.append(table)
+    return failed
+
+
+def list_month_partitions(cursor, table):
+    """Returns [(partition_name, month)] for the monthly partitions of <table>_History."""
+    prefix = f"{table.lower()}_history_p"
+    cursor.execute('''
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s);
+    ''', (f"{table}_History".lower(),))
+    partitions = []
+    for (name,) in cursor.fetchall():
+        if name.startswith(prefix):
+            suffix = name[len(prefix):]
+            partitions.append((name, date(int(suffix[:4]), int(suffix[4:6]), 1)))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def create_daily_rollup_table(cursor, table):
+    keys = ", ".join(HISTORY_TABLES[table])
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table}_History_Daily (
+            LIKE {table}_History,
+            snapshot_date DATE NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS {table.lower()}_history_daily_snapshot_date_brin
+            ON {table}_History_Daily USING BRIN (snapshot_date);
+        CREATE INDEX IF NOT EXISTS {table.lower()}_history_daily_key
+            ON {table}_History_Daily ({keys}, snapshot_date);
+    ''')
+
+
+def roll_up_partition(cursor, table, partition):
+    """Copies the last state per row and day of a raw partition into <table>_History_Daily."""
+    keys = ", ".join(HISTORY_TABLES[table])
+    add_missing_columns(cursor, f"{table}_History", f"{table}_History_Daily")
+    columns = ", ".join(name for name, _ in table_columns(cursor, f"{table}_History"))
+    cursor.execute(f'''
+        INSERT INTO {table}_History_Daily ({columns}, snapshot_date)
+        SELECT DISTINCT ON ({keys}, backup_timestamp::date) {columns}, backup_timestamp::date
+        FROM {partition} p
+        ORDER BY {keys}, backup_timestamp::date, backup_timestamp DESC;
+    ''')
+    return cursor.rowcount
+
+
+def create_capture_trigger(cursor, table, per_row=False):
+    """
+    Installs the trigger that copies the pre-update state of `table` rows into
+    <table>_History.
+
+    The default is one statement-level AFTER UPDATE trigger that reads the
+    `REFERENCING OLD TABLE` transition table, so a batched upsert writes all of
+    its history rows with a single INSERT ... SELECT. `per_row=True` installs
+    the legacy FOR EACH ROW variant (kept for benchmarking).
+
+    Columns are listed explicitly, so the trigger has to be reinstalled when
+    the base table gains columns (migrations do this).
+    """
+    name = table.lower()
+    columns = ", ".join(column for column, _ in table_columns(cursor, table))
+    cursor.execute(f'''
+        DROP TRIGGER IF EXISTS backup_{name}_before_update_trigger ON {table};
+        DROP TRIGGER IF EXISTS backup_{name}_after_update_trigger ON {table};
+    ''')
+    if per_row:
+        cursor.execute(f'''
+            CREATE OR REPLACE FUNCTION backup_{name}_trigger()
+            RETURNS TRIGGER AS $$
+            BEGIN
+                INSERT INTO {table}_History ({columns}, backup_timestamp) SELECT OLD.*, now();
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER backup_{name}_before_update_trigger
+            BEFORE UPDATE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION backup_{name}_trigger();
+        ''')
+    else:
+        cursor.execute(f'''
+            CREATE OR REPLACE FUNCTION backup_{name}_trigger()
+            RETURNS TRIGGER AS $$
+            BEGIN
+                INSERT INTO {table}_History ({columns}, backup_timestamp) SELECT {columns}, now() FROM old_rows;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            CREATE TRIGGER backup_{name}_after_update_trigger
+            AFTER UPDATE ON {table}
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION backup_{name}_trigger();
+        ''')
+
+
+def initialize_history_tables(tables=None):
+    """Creates (or converts) the partitioned history tables, one transaction per table."""
+    for table in tables or HISTORY_TABLES:
+        try:
+            with transaction() as cursor:
+                create_history_table(cursor, table)
+        except Exception:
+            logging.exception(f"Could not create history table for {table}.")
+
+
+def run_history_retention(keep_months=HISTORY_RETENTION_MONTHS, months_ahead=HISTORY_PARTITIONS_AHEAD):
+    """
+    Rolls up and drops raw history partitions older than `keep_months` and
+    pre-creates upcoming partitions. Each partition is handled in its own
+    transaction, so a failure never loses raw history that was not rolled up.
+
+    Returns {table: [(partition, rolled_up_rows)]}.
+    """
+    cutoff = _add_months(_month_start(date.today()), -keep_months)
+    failed = set(ensure_upcoming_partitions(months_ahead))
+    report = {}
+    for table in HISTORY_TABLES:
+        if table in failed:
+            continue
+        try:
+            with transaction() as cursor:
+                if not _is_partitioned(cursor, table):
+                    continue
+                create_daily_rollup_table(cursor, table)
+                expired = [name for name, month in list_month_partitions(cursor, table) if month < cutoff]
+        except Exception:
+            logging.exception(f"Could not prepare history retention for {table}.")
+            continue
+
+        for partition in expired:
+            try:
+                with transaction() as cursor:
+                    rows = roll_up_partition(cursor, table, partition)
+                    cursor.execute(f"ALTER TABLE {table}_History DETACH PARTITION {partition};")
+                    cursor.execute(f"DROP TABLE {partition};")
+                report.setdefault(table, []).append((partition, rows))
+                logging.info(f"Rolled up {partition} into {table}_History_Daily ({rows} rows) and dropped it.")
+            except Exception:
+                logging.exception(f"Could not roll up {partition}.")
+    return report
+
+
+if __name__ == "__main__":
+    run_history_retention()
@@ -0,0 +1,73 @@
+"""
+Per-row vs. per-statement history capture on a token refresh.
+
+Creates session-local temp copies of TokenCatalog and TokenCatalog_History
+(they shadow the real tables through the default search_path), seeds them with
+N tokens, then re-upserts every token with a new price using the production
+UPSERT_TOKEN_CATALOG batch, once with each trigger flavour from db.history.create_capture_trigger.
+Everything runs in one transaction that is rolled back, so no real table,
+trigger or function is changed. Point it at a development database:
+
+    python -m db.history_benchmark [tokens]
+"""
+
+import sys
+import time
+
+from db.connection import connection
+from db.history import create_capture_trigger
+from db.snapshot_writer import UPSERT_TOKEN_CATALOG, SNAPSHOT_PAGE_SIZE
+from psycopg2.extras import execute_values
+
+BENCHMARK_TOKENS = 10_000
+
+
+def _token_rows(count, price):
+    return [
+        ("eth", f"bench_token_{i}", f"Token {i}", f"T{i}", None, f"T{i}", 18, None, None,
+         price + i, 0, True, True, True, None)
+        for i in range(count)
+    ]
+
+
+def _timed_refresh(cursor, count, price):
+    cursor.execute("TRUNCATE TokenCatalog_History;")
+    started = time.perf_counter()
+    execute_values(cursor, UPSERT_TOKEN_CATALOG, _token_rows(count, price), page_size=SNAPSHOT_PAGE_SIZE)
+    elapsed = time.perf_counter() - started
+    cursor.execute("SELECT count(*) FROM TokenCatalog_History;")
+    return elapsed, cursor.fetchone()[0]
+
+
+def run_benchmark(count=BENCHMARK_TOKENS):
+    """Returns {"per_row": (seconds, history_rows), "per_statement": (seconds, history_rows)}."""
+    results = {}
+    with connection() as conn:
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('''
+                    CREATE TEMP TABLE TokenCatalog (LIKE TokenCatalog INCLUDING ALL);
+                    CREATE TEMP TABLE TokenCatalog_History (
+                        LIKE TokenCatalog,
+                        backup_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+                    );
+                ''')
+                execute_values(cursor, UPSERT_TOKEN_CATALOG, _token_rows(count, 1), page_size=SNAPSHOT_PAGE_SIZE)
+
+                create_capture_trigger(cursor, "TokenCatalog", per_row=True)
+                results["per_row"] = _timed_refresh(cursor, count, 2)
+
+                create_capture_trigger(cursor, "TokenCatalog")
+                results["per_statement"] = _timed_refresh(cursor, count, 3)
+        finally:
+            conn.rollback()
+    return results
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else BENCHMARK_TOKENS
+    results = run_benchmark(count)
+    for mode, (seconds, history_rows) in results.items():
+        print(f"{mode:>13}: {seconds:.3f}s for {count} updated tokens "
+              f"({history_rows} history rows, {count / seconds:,.0f} rows/s)")
+    print(f"Speedup: {results['per_row'][0] / results['per_statement'][0]:.2f}x")
@@ -0,0 +1,142 @@
+"""
+EXPLAIN-based check that the per-user portfolio queries use the hot-path
+indexes (db.migrations.CURRENT_HOT_PATH_INDEXES) at realistic table sizes.
+
+Inside one transaction that is always rolled back, it seeds synthetic users,
+wallets, tokens and 1M+ WalletTokenBalances / UserPortfolio rows, ANALYZEs
+them, then EXPLAINs USER_CHAIN_AGGREGATES_QUERY, PORTFOLIO_SOURCE_QUERY and
+USER_TOKENS_QUERY for one user and fails if any of the hot tables is read with
+a sequential scan. Point it at a development database:
+
+    python -m db.index_check
+"""
+
+import json
+import sys
+import time
+
+from db.app_user_operations import USER_CHAIN_AGGREGATES_QUERY, USER_TOKENS_QUERY
+from db.connection import connection
+from db.migrations import CURRENT_HOT_PATH_INDEXES
+from db.portfolio_materializer import PORTFOLIO_SOURCE_QUERY
+
+CHECK_USERS = 2_000
+WALLETS_PER_USER = 5
+TOKENS = 20_000
+TOKENS_PER_WALLET = 100
+
+# Tables that must never be sequentially scanned by a per-user query.
+HOT_TABLES = {"userwallets", "wallettokenbalances", "walletchainbalances", "userportfolio", "user_chain_aggregates"}
+
+SEED_SQL = '''
+    INSERT INTO users (user_id)
+    SELECT 'idxcheck_user_' || u FROM generate_series(1, %(users)s) u;
+
+    INSERT INTO Wallets (address, total_usd_value)
+    SELECT 'idxcheck_wallet_' || w, w FROM generate_series(1, %(users)s * %(wallets_per_user)s) w;
+
+    INSERT INTO UserWallets (user_id, wallet_address)
+    SELECT 'idxcheck_user_' || ((w - 1) / %(wallets_per_user)s + 1), 'idxcheck_wallet_' || w
+    FROM generate_series(1, %(users)s * %(wallets_per_user)s) w;
+
+    INSERT INTO TokenCatalog (chain, token_id, name, price)
+    SELECT 'chain_' || (t %% 20), 'idxcheck_token_' || t, 'Token ' || t, t %% 100
+    FROM generate_series(1, %(tokens)s) t;
+
+    INSERT INTO WalletChainBalances (wallet_address, chain_id, usd_value)
+    SELECT 'idxcheck_wallet_' || w, 'chain_' || c, c
+    FROM generate_series(1, %(users)s * %(wallets_per_user)s) w, generate_series(0, 19) c;
+
+    INSERT INTO WalletTokenBalances (wallet_address, chain, token_id, amount)
+    SELECT 'idxcheck_wallet_' || w, 'chain_' || (token.n %% 20), 'idxcheck_token_' || token.n, k
+    FROM generate_series(1, %(users)s * %(wallets_per_user)s) w, generate_series(1, %(tokens_per_wallet)s) k,
+        LATERAL (SELECT (w * 37 + k) %% %(tokens)s + 1 AS n) token;
+
+    INSERT INTO UserPortfolio (user_id, token_id, wallet_address, chain, name, total_token_amount, total_usd_value)
+    SELECT uw.user_id, wtb.token_id, uw.wallet_address, wtb.chain, t.name, wtb.amount, wtb.amount * t.price
+    FROM UserWallets uw
+    JOIN WalletTokenBalances wtb ON wtb.wallet_address = uw.wallet_address
+    JOIN TokenCatalog t ON t.chain = wtb.chain AND t.token_id = wtb.token_id
+    WHERE uw.user_id LIKE 'idxcheck_user_%%';
+
+    REFRESH MATERIALIZED VIEW user_chain_aggregates;
+
+    ANALYZE users, Wallets, UserWallets, TokenCatalog, WalletChainBalances, WalletTokenBalances, UserPortfolio,
+        user_chain_aggregates;
+'''
+
+CHECKED_QUERIES = {
+    "fetch_aggregated_data_for_user": (USER_CHAIN_AGGREGATES_QUERY, 2),
+    "fill_user_portfolio": (PORTFOLIO_SOURCE_QUERY.format(scope="uw.user_id = %s"), 1),
+    "get_tokens_for_user": (USER_TOKENS_QUERY, 1),
+}
+
+
+def _scans(plan):
+    """Yields (node type, relation, index) for every scan node of an EXPLAIN JSON plan."""
+    if "Relation Name" in plan:
+        yield plan["Node Type"], plan["Relation Name"].lower(), plan.get("Index Name")
+    for child in plan.get("Plans", []):
+        yield from _scans(child)
+
+
+def missing_indexes(cursor):
+    cursor.execute("SELECT indexname FROM pg_indexes WHERE indexname = ANY(%s);",
+                   ([name for name, _, _ in CURRENT_HOT_PATH_INDEXES],))
+    present = {row[0] for row in cursor.fetchall()}
+    return [name for name, _, _ in CURRENT_HOT_PATH_INDEXES if name not in present]
+
+
+def run_index_check(users=CHECK_USERS):
+    """
+    Seeds, ANALYZEs and EXPLAINs inside a rolled-back transaction.
+
+    Returns (ok, report) where report maps each query to its scan nodes and
+    the hot tables it read sequentially.
+    """
+    report = {}
+    with connection() as conn:
+        try:
+            with conn.cursor() as cursor:
+                missing = missing_indexes(cursor)
+                if missing:
+                    return False, {"missing_indexes": missing}
+
+                started = time.monotonic()
+                cursor.execute(SEED_SQL, {"users": users, "wallets_per_user": WALLETS_PER_USER,
+                                          "tokens": TOKENS, "tokens_per_wallet": TOKENS_PER_WALLET})
+                report["seed_seconds"] = round(time.monotonic() - started, 1)
+                report["balance_rows"] = users * WALLETS_PER_USER * TOKENS_PER_WALLET
+
+                user_id = f"idxcheck_user_{users // 2}"
+                for name, (query, user_params) in CHECKED_QUERIES.items():
+                    cursor.execute(f"EXPLAIN (FORMAT JSON) {query.strip().rstrip(';')}", (user_id,) * user_params)
+                    plan = cursor.fetchone()[0]
+                    if isinstance(plan, str):
+                        plan = json.loads(plan)
+                    scans = list(_scans(plan[0]["Plan"]))
+                    report[name] = {
+                        "scans": scans,
+                        "seq_scans": sorted({relation for node, relation, _ in scans
+                                             if node == "Seq Scan" and relation in HOT_TABLES}),
+                    }
+        finally:
+            conn.rollback()
+
+    ok = all(not result["seq_scans"] for name, result in report.items() if name in CHECKED_QUERIES)
+    return ok, report
+
+
+if __name__ == "__main__":
+    ok, report = run_index_check()
+    if "missing_indexes" in report:
+        print(f"Missing indexes (run migrations first): {', '.join(report['missing_indexes'])}")
+        sys.exit(1)
+    print(f"Seeded {report['balance_rows']:,} balance rows in {report['seed_seconds']}s")
+    for name in CHECKED_QUERIES:
+        result = report[name]
+        status = "OK" if not result["seq_scans"] else f"SEQ SCAN on {', '.join(result['seq_scans'])}"
+        print(f"{name}: {status}")
+        for node, relation, index in result["scans"]:
+            print(f"    {node} on {relation}" + (f" using {index}" if index else ""))
+    sys.exit(0 if ok else 1)
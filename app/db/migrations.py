@@ -0,0 +1,586 @@
+"""
+Numbered, checksummed schema migrations.
+
+Each entry of MIGRATIONS is (version, name, step) where step is either a SQL
+script (sent in one round trip) or a function taking a cursor. Every pending
+migration is applied in its own transaction together with its
+`schema_version` row, serialized across processes by an advisory lock.
+
+After a successful run the expected schema stamp (latest version plus a hash
+of all migration checksums) is stored as the comment of `schema_version`, so
+confirming that a database is up to date costs one catalog query. Applied
+migrations must never be edited: a checksum mismatch raises MigrationError.
+Schema changes go into a new migration appended to the list.
+
+A function step is checksummed by its name and an explicit revision
+(`step_revision`), not by its source: it calls db.history helpers that keep
+evolving for the retention job, and their edits must not invalidate applied
+databases. Bump the revision only if the step itself has to change, which
+means it never shipped.
+"""
+
+import hashlib
+import logging
+
+from db import history
+from db.connection import transaction
+
+logging.basicConfig(level=logging.INFO)
+
+# Arbitrary key for pg_advisory_xact_lock, shared by every migrating process.
+MIGRATION_LOCK_ID = 72_640_013
+
+CREATE_SCHEMA_VERSION = '''
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INT PRIMARY KEY,
+        name VARCHAR NOT NULL,
+        checksum VARCHAR(64) NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+    );
+'''
+
+SCHEMA_STAMP_QUERY = "SELECT obj_description(to_regclass('schema_version'), 'pg_class');"
+
+# Tables as created by the baseline migration, in dependency order. Frozen:
+# later schema changes are separate migrations.
+BASELINE_TABLES = {
+    "users": '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id VARCHAR PRIMARY KEY
+        );
+    ''',
+    "Wallets": '''
+        CREATE TABLE IF NOT EXISTS Wallets (
+            address VARCHAR PRIMARY KEY,
+            total_usd_value NUMERIC,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+        );
+    ''',
+    "UserWallets": '''
+        CREATE TABLE IF NOT EXISTS UserWallets (
+            user_id VARCHAR REFERENCES users(user_id),
+            wallet_address VARCHAR REFERENCES Wallets(address),
+            PRIMARY KEY (user_id, wallet_address)
+        );
+    ''',
+    "Chains": '''
+        CREATE TABLE IF NOT EXISTS Chains (
+            id VARCHAR,
+            wallet_address VARCHAR REFERENCES Wallets(address),
+            community_id NUMERIC,
+            name VARCHAR,
+            native_token_id VARCHAR,
+            logo_url VARCHAR,
+            wrapped_token_id VARCHAR,
+            is_support_pre_exec BOOLEAN,
+            usd_value NUMERIC,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+            PRIMARY KEY (id, wallet_address)
+        );
+    ''',
+    "Tokens": '''
+        CREATE TABLE IF NOT EXISTS Tokens (
+            id VARCHAR(255) PRIMARY KEY,
+            wallet_address VARCHAR REFERENCES Wallets(address),
+            chain VARCHAR,
+            name VARCHAR,
+            symbol VARCHAR,
+            display_symbol VARCHAR,
+            optimized_symbol VARCHAR,
+            decimals NUMERIC,
+            logo_url VARCHAR(255),
+            protocol_id VARCHAR,
+            price NUMERIC,
+            price_24h_change NUMERIC,
+            is_verified BOOLEAN,
+            is_core BOOLEAN,
+            is_wallet BOOLEAN,
+            time_at TIMESTAMP,
+            amount NUMERIC,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+        );
+    ''',
+    "NFTs": '''
+        CREATE TABLE IF NOT EXISTS NFTs (
+            id VARCHAR PRIMARY KEY,
+            contract_id VARCHAR,
+            inner_id INT,
+            chain VARCHAR,
+            name VARCHAR,
+            description TEXT,
+            content_type VARCHAR,
+            content VARCHAR,
+            thumbnail_url VARCHAR,
+            total_supply INT,
+            detail_url VARCHAR,
+            collection_id VARCHAR,
+            contract_name VARCHAR,
+            is_erc721 BOOLEAN,
+            is_erc1155 BOOLEAN,
+            amount INT,
+            usd_price DECIMAL(10,3),
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+        );
+    ''',
+    "Attributes": '''
+        CREATE TABLE IF NOT EXISTS Attributes (
+            attribute_id SERIAL PRIMARY KEY,
+            nft_id VARCHAR REFERENCES NFTs(id),
+            key VARCHAR,
+            trait_type VARCHAR,
+            value VARCHAR,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+        );
+    ''',
+    "bitcoin_addresses": '''
+        CREATE TABLE IF NOT EXISTS bitcoin_addresses (
+            address VARCHAR PRIMARY KEY,
+            received BIGINT,
+            sent BIGINT,
+            balance BIGINT,
+            tx_count INT,
+            unconfirmed_tx_count INT,
+            unconfirmed_received BIGINT,
+            unconfirmed_sent BIGINT,
+            unspent_tx_count INT,
+            first_tx VARCHAR,
+            last_tx VARCHAR,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+        );
+    ''',
+    "Tokens_sol": '''
+        CREATE TABLE IF NOT EXISTS Tokens_sol (
+            associated_token_address VARCHAR PRIMARY KEY,
+            mint VARCHAR,
+            amount_raw VARCHAR,
+            amount DECIMAL,
+            decimals VARCHAR,
+            name VARCHAR,
+            symbol VARCHAR,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+        );
+    ''',
+    "NFTs_sol": '''
+        CREATE TABLE IF NOT EXISTS NFTs_sol (
+            associated_token_address VARCHAR PRIMARY KEY,
+            mint VARCHAR,
+            amount_raw VARCHAR,
+            amount DECIMAL,
+            decimals VARCHAR,
+            name VARCHAR,
+            symbol VARCHAR,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+        );
+    ''',
+    "Native_Balance_sol": '''
+        CREATE TABLE IF NOT EXISTS Native_Balance_sol (
+            user_id SERIAL PRIMARY KEY,
+            lamports VARCHAR,
+            solana DECIMAL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+        );
+    ''',
+    "WalletChainBalances": '''
+        CREATE TABLE IF NOT EXISTS WalletChainBalances (
+            wallet_address VARCHAR(255) REFERENCES Wallets(address),
+            chain_id VARCHAR(255),
+            usd_value NUMERIC,
+            PRIMARY KEY (wallet_address, chain_id)
+        );
+    ''',
+    "WalletTokenBalances": '''
+        CREATE TABLE IF NOT EXISTS WalletTokenBalances (
+            wallet_address VARCHAR REFERENCES Wallets(address),
+            token_id VARCHAR REFERENCES Tokens(id),
+            amount NUMERIC,
+            PRIMARY KEY (wallet_address, token_id)
+        );
+    ''',
+    "UserSpamFilters": '''
+        CREATE TABLE IF NOT EXISTS UserSpamFilters (
+            user_id VARCHAR PRIMARY KEY REFERENCES users(user_id),
+            spam_tokens VARCHAR[]
+        );
+    ''',
+    "UserPortfolio": '''
+        CREATE TABLE IF NOT EXISTS UserPortfolio (
+            user_id VARCHAR REFERENCES users(user_id),
+            token_id VARCHAR REFERENCES Tokens(id),
+            wallet_address VARCHAR REFERENCES Wallets(address),
+            chain VARCHAR,
+            name VARCHAR(255),
+            total_token_amount NUMERIC(30, 15),
+            total_usd_value NUMERIC(30, 15),
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+            PRIMARY KEY (user_id, token_id, wallet_address)
+        );
+    ''',
+}
+
+UPDATED_AT_TABLES = ["Wallets", "Chains", "Tokens", "WalletChainBalances", "WalletTokenBalances", "UserPortfolio",
+                     "NFTs", "Attributes", "bitcoin_addresses", "Tokens_sol", "NFTs_sol", "Native_Balance_sol"]
+
+# The balance tables were created without timestamp columns, although their
+# updated_at triggers were installed anyway.
+BALANCE_TIMESTAMPS = "".join(f'''
+    ALTER TABLE {table}
+        ADD COLUMN IF NOT EXISTS timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+        ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL;
+''' for table in ["WalletChainBalances", "WalletTokenBalances"])
+
+UPDATED_AT_TRIGGERS = '''
+    CREATE OR REPLACE FUNCTION update_modified_column()
+    RETURNS TRIGGER AS $$
+    BEGIN
+       NEW.updated_at = now();
+       RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+''' + "".join(f'''
+    DROP TRIGGER IF EXISTS update_{table.lower()}_modtime ON {table};
+    CREATE TRIGGER update_{table.lower()}_modtime
+    BEFORE UPDATE ON {table}
+    FOR EACH ROW
+    EXECUTE FUNCTION update_modified_column();
+''' for table in UPDATED_AT_TABLES)
+
+
+# Secondary indexes for the hot read and join paths: (name, table, definition).
+# The covering INCLUDE columns let the per-user portfolio joins run as index-only
+# scans; the updated_at indexes serve staleness lookups.
+HOT_PATH_INDEXES = [
+    ("userwallets_wallet_address_idx", "UserWallets", "(wallet_address) INCLUDE (user_id)"),
+    ("wallettokenbalances_wallet_address_idx", "WalletTokenBalances", "(wallet_address) INCLUDE (token_id, amount)"),
+    ("wallettokenbalances_token_id_idx", "WalletTokenBalances", "(token_id)"),
+    ("walletchainbalances_wallet_address_idx", "WalletChainBalances", "(wallet_address) INCLUDE (chain_id, usd_value)"),
+    ("userportfolio_user_id_chain_idx", "UserPortfolio", "(user_id, chain) INCLUDE (total_usd_value)"),
+    ("tokens_chain_idx", "Tokens", "(chain)"),
+    ("wallets_updated_at_idx", "Wallets", "(updated_at)"),
+    ("tokens_updated_at_idx", "Tokens", "(updated_at)"),
+    ("wallettokenbalances_updated_at_idx", "WalletTokenBalances", "(updated_at)"),
+]
+
+HOT_PATH_INDEX_DDL = "".join(
+    f"CREATE INDEX IF NOT EXISTS {name} ON {table} {definition};\n" for name, table, definition in HOT_PATH_INDEXES
+)
+
+
+PORTFOLIO_MATERIALIZER_STATE = '''
+    CREATE TABLE IF NOT EXISTS portfolio_materializer_state (
+        id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+        last_run_at TIMESTAMP
+    );
+'''
+
+
+# Per-user/per-chain dashboard aggregates; the unique index allows
+# REFRESH MATERIALIZED VIEW CONCURRENTLY and serves the per-user lookups.
+USER_CHAIN_AGGREGATES = '''
+    CREATE MATERIALIZED VIEW IF NOT EXISTS user_chain_aggregates AS
+    WITH user_portfolio_aggregation AS (
+        SELECT user_id, chain AS chain_id, SUM(total_usd_value) AS aggregated_usd_value
+        FROM UserPortfolio
+        GROUP BY user_id, chain
+    ),
+    wallet_chain_data AS (
+        SELECT uw.user_id, wcb.chain_id, SUM(wcb.usd_value) AS reported_usd_value
+        FROM WalletChainBalances wcb
+        JOIN UserWallets uw ON wcb.wallet_address = uw.wallet_address
+        GROUP BY uw.user_id, wcb.chain_id
+    )
+    SELECT upa.user_id, upa.chain_id, upa.aggregated_usd_value, wcd.reported_usd_value
+    FROM user_portfolio_aggregation upa
+    LEFT JOIN wallet_chain_data wcd ON upa.user_id = wcd.user_id AND upa.chain_id = wcd.chain_id;
+    CREATE UNIQUE INDEX IF NOT EXISTS user_chain_aggregates_user_id_chain_id_idx
+        ON user_chain_aggregates (user_id, chain_id);
+'''
+
+
+INGEST_JOBS = '''
+    CREATE TABLE IF NOT EXISTS ingest_jobs (
+        id SERIAL PRIMARY KEY,
+        status VARCHAR NOT NULL DEFAULT 'queued',
+        options JSONB NOT NULL DEFAULT '{}',
+        wallets_total INT,
+        wallets_done INT NOT NULL DEFAULT 0,
+        wallets_failed INT NOT NULL DEFAULT 0,
+        summary JSONB,
+        error TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+        started_at TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+        finished_at TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS ingest_jobs_queued_idx ON ingest_jobs (id) WHERE status = 'queued';
+'''
+
+WALLET_REFRESH_TASKS = '''
+    CREATE TABLE IF NOT EXISTS wallet_refresh_tasks (
+        wallet_address VARCHAR PRIMARY KEY,
+        stored_addresses TEXT[] NOT NULL,
+        user_ids TEXT[] NOT NULL DEFAULT '{}',
+        status VARCHAR NOT NULL DEFAULT 'queued',
+        attempts INT NOT NULL DEFAULT 0,
+        available_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+        lease_owner VARCHAR,
+        lease_expires_at TIMESTAMP,
+        last_error TEXT,
+        enqueued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+        finished_at TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS wallet_refresh_tasks_claim_idx ON wallet_refresh_tasks (available_at)
+        WHERE status = 'queued';
+    CREATE INDEX IF NOT EXISTS wallet_refresh_tasks_lease_idx ON wallet_refresh_tasks (lease_expires_at)
+        WHERE status = 'leased';
+'''
+
+
+# Token metadata and prices, one row per (chain, token id) however many
+# wallets hold the token. Seeded from Tokens, which was keyed by id alone and
+# carried the amount of whichever wallet was written last; Tokens is kept for
+# its history but no longer written.
+TOKEN_CATALOG = '''
+    CREATE TABLE IF NOT EXISTS TokenCatalog (
+        chain VARCHAR NOT NULL,
+        token_id VARCHAR(255) NOT NULL,
+        name VARCHAR,
+        symbol VARCHAR,
+        display_symbol VARCHAR,
+        optimized_symbol VARCHAR,
+        decimals NUMERIC,
+        logo_url VARCHAR,
+        protocol_id VARCHAR,
+        price NUMERIC,
+        price_24h_change NUMERIC,
+        is_verified BOOLEAN,
+        is_core BOOLEAN,
+        is_wallet BOOLEAN,
+        time_at TIMESTAMP,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+        PRIMARY KEY (chain, token_id)
+    );
+    DROP TRIGGER IF EXISTS update_tokencatalog_modtime ON TokenCatalog;
+    CREATE TRIGGER update_tokencatalog_modtime
+    BEFORE UPDATE ON TokenCatalog
+    FOR EACH ROW
+    EXECUTE FUNCTION update_modified_column();
+
+    INSERT INTO TokenCatalog (chain, token_id, name, symbol, display_symbol, optimized_symbol, decimals, logo_url,
+                              protocol_id, price, price_24h_change, is_verified, is_core, is_wallet, time_at)
+    SELECT chain, id, name, symbol, display_symbol, optimized_symbol, decimals, logo_url,
+           protocol_id, price, price_24h_change, is_verified, is_core, is_wallet, time_at
+    FROM Tokens
+    WHERE chain IS NOT NULL
+    ON CONFLICT (chain, token_id) DO NOTHING;
+
+    -- Balances reference the catalog by (chain, token_id). The backfill runs
+    -- without triggers so it neither floods the history nor bumps updated_at.
+    ALTER TABLE WalletTokenBalances ADD COLUMN IF NOT EXISTS chain VARCHAR;
+    ALTER TABLE WalletTokenBalances DISABLE TRIGGER USER;
+    UPDATE WalletTokenBalances wtb SET chain = t.chain FROM Tokens t WHERE t.id = wtb.token_id;
+    ALTER TABLE WalletTokenBalances ENABLE TRIGGER USER;
+    DELETE FROM WalletTokenBalances WHERE chain IS NULL;
+    ALTER TABLE WalletTokenBalances
+        DROP CONSTRAINT IF EXISTS wallettokenbalances_token_id_fkey,
+        DROP CONSTRAINT IF EXISTS wallettokenbalances_pkey,
+        ADD PRIMARY KEY (wallet_address, chain, token_id),
+        ADD CONSTRAINT wallettokenbalances_token_fkey
+            FOREIGN KEY (chain, token_id) REFERENCES TokenCatalog (chain, token_id);
+
+    -- UserPortfolio is derived (see db.portfolio_materializer), so rows the
+    -- new key cannot hold are dropped and rebuilt by the next run.
+    DELETE FROM UserPortfolio WHERE chain IS NULL;
+    ALTER TABLE UserPortfolio
+        DROP CONSTRAINT IF EXISTS userportfolio_token_id_fkey,
+        DROP CONSTRAINT IF EXISTS userportfolio_pkey,
+        ADD PRIMARY KEY (user_id, chain, token_id, wallet_address);
+'''
+
+# Hot-path indexes that migration 9 replaced: the WalletTokenBalances ones now
+# carry the chain, and the catalog's updated_at serves incremental rebuilds.
+SUPERSEDED_HOT_PATH_INDEXES = ["wallettokenbalances_wallet_address_idx", "wallettokenbalances_token_id_idx"]
+
+TOKEN_CATALOG_INDEXES = [
+    ("wallettokenbalances_wallet_address_chain_idx", "WalletTokenBalances",
+     "(wallet_address) INCLUDE (chain, token_id, amount)"),
+    ("wallettokenbalances_chain_token_id_idx", "WalletTokenBalances", "(chain, token_id)"),
+    ("tokencatalog_updated_at_idx", "TokenCatalog", "(updated_at)"),
+]
+
+# The hot-path indexes a current schema has (checked by db.index_check).
+CURRENT_HOT_PATH_INDEXES = [index for index in HOT_PATH_INDEXES
+                            if index[0] not in SUPERSEDED_HOT_PATH_INDEXES] + TOKEN_CATALOG_INDEXES
+
+
+# Portfolio changes that leave no updated_at behind, for incremental
+# materializer runs: wallets newly linked to a user, and wallets whose stale
+# balances were deleted (see db.snapshot_writer.DELETE_STALE_BALANCES).
+PORTFOLIO_CHANGE_TRACKING = '''
+    ALTER TABLE UserWallets ADD COLUMN IF NOT EXISTS linked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL;
+    CREATE INDEX IF NOT EXISTS userwallets_linked_at_idx ON UserWallets (linked_at);
+    CREATE TABLE IF NOT EXISTS wallet_balance_deletions (
+        wallet_address VARCHAR PRIMARY KEY,
+        deleted_at TIMESTAMP NOT NULL
+    );
+'''
+
+
+# Migration 9 gave pre-catalog balances the chain Tokens had for their token
+# id, which is wrong for token ids that exist on several chains. Balances not
+# written since are deleted rather than guessed; their wallets lose their
+# stored total so the next incremental run refetches them in full, and are
+# recorded as deleted so the materializer rebuilds their portfolios.
+REBUILD_BACKFILLED_BALANCES = '''
+    CREATE TEMP TABLE backfilled_balances ON COMMIT DROP AS
+    SELECT wallet_address, chain, token_id
+    FROM WalletTokenBalances
+    WHERE updated_at <= (SELECT applied_at FROM schema_version WHERE version = 9);
+
+    DELETE FROM WalletTokenBalances wtb
+    USING backfilled_balances b
+    WHERE wtb.wallet_address = b.wallet_address AND wtb.chain = b.chain AND wtb.token_id = b.token_id;
+
+    INSERT INTO wallet_balance_deletions (wallet_address, deleted_at)
+    SELECT DISTINCT wallet_address, now() FROM backfilled_balances
+    ON CONFLICT (wallet_address) DO UPDATE SET deleted_at = EXCLUDED.deleted_at;
+
+    ALTER TABLE Wallets DISABLE TRIGGER USER;
+    UPDATE Wallets SET total_usd_value = NULL
+    WHERE address IN (SELECT wallet_address FROM backfilled_balances);
+    ALTER TABLE Wallets ENABLE TRIGGER USER;
+'''
+
+
+def step_revision(revision):
+    """Records the revision a function step's checksum covers."""
+    def mark(step):
+        step.revision = revision
+        return step
+    return mark
+
+
+# History tables created by migration 3; later tables get theirs from the
+# migration that creates them.
+PARTITIONED_HISTORY_TABLES = ["Wallets", "Chains", "Tokens", "NFTs", "UserPortfolio", "WalletChainBalances",
+                              "WalletTokenBalances", "Attributes", "bitcoin_addresses"]
+
+
+@step_revision(1)
+def create_history(cursor):
+    """Partitioned history tables and statement-level capture triggers (db.history)."""
+    for table in PARTITIONED_HISTORY_TABLES:
+        history.create_history_table(cursor, table)
+        history.create_capture_trigger(cursor, table)
+
+
+@step_revision(1)
+def create_token_catalog(cursor):
+    """TokenCatalog, chain-aware balance and portfolio keys, their indexes and history."""
+    cursor.execute(TOKEN_CATALOG)
+    cursor.execute("".join(f"DROP INDEX IF EXISTS {name};\n" for name in SUPERSEDED_HOT_PATH_INDEXES))
+    cursor.execute("".join(f"CREATE INDEX IF NOT EXISTS {name} ON {table} {definition};\n"
+                           for name, table, definition in TOKEN_CATALOG_INDEXES))
+    # The balance and portfolio capture triggers list their columns, so they
+    # are reinstalled once the history tables have the new chain column.
+    for table in ["TokenCatalog", "WalletTokenBalances", "UserPortfolio"]:
+        history.create_history_table(cursor, table)
+        history.create_capture_trigger(cursor, table)
+
+
+MIGRATIONS = [
+    (1, "baseline", "".join(BASELINE_TABLES.values())),
+    (2, "balance_timestamps_and_updated_at_triggers", BALANCE_TIMESTAMPS + UPDATED_AT_TRIGGERS),
+    (3, "partitioned_history", create_history),
+    (4, "hot_path_indexes", HOT_PATH_INDEX_DDL),
+    (5, "portfolio_materializer_state", PORTFOLIO_MATERIALIZER_STATE),
+    (6, "user_chain_aggregates", USER_CHAIN_AGGREGATES),
+    (7, "ingest_jobs", INGEST_JOBS),
+    (8, "wallet_refresh_tasks", WALLET_REFRESH_TASKS),
+    (9, "token_catalog", create_token_catalog),
+    (10, "portfolio_change_tracking", PORTFOLIO_CHANGE_TRACKING),
+    (11, "rebuild_backfilled_balances", REBUILD_BACKFILLED_BALANCES),
+]
+
+
+class MigrationError(Exception):
+    """Raised when the database disagrees with the migrations shipped in this code."""
+
+
+def checksum(step):
+    source = step if isinstance(step, str) else f"{step.__module__}.{step.__qualname__}@{step.revision}"
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+def schema_stamp():
+    """Latest version plus a hash over every migration checksum."""
+    combined = hashlib.sha256("".join(checksum(step) for _, _, step in MIGRATIONS).encode()).hexdigest()
+    return f"{MIGRATIONS[-1][0]}:{combined}"
+
+
+def is_up_to_date():
+    """One catalog query: compares the stamp stored on schema_version with this code's."""
+    with transaction() as cursor:
+        cursor.execute(SCHEMA_STAMP_QUERY)
+        return cursor.fetchone()[0] == schema_stamp()
+
+
+def _apply(cursor, version, name, step):
+    cursor.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK_ID,))
+    cursor.execute(CREATE_SCHEMA_VERSION)
+    cursor.execute("SELECT checksum FROM schema_version WHERE version = %s;", (version,))
+    row = cursor.fetchone()
+    if row is not None:
+        if row[0] != checksum(step):
+            raise MigrationError(f"Migration {version} ({name}) was changed after it was applied.")
+        return False
+    if isinstance(step, str):
+        cursor.execute(step)
+    else:
+        step(cursor)
+    cursor.execute("INSERT INTO schema_version (version, name, checksum) VALUES (%s, %s, %s);",
+                   (version, name, checksum(step)))
+    return True
+
+
+def migrate():
+    """
+    Brings the database schema up to date.
+
+    Returns the list of versions applied by this call (empty if the schema was
+    already current). After migrating, upcoming history partitions are ensured.
+    """
+    if is_up_to_date():
+        return []
+
+    applied = []
+    for version, name, step in MIGRATIONS:
+        with transaction() as cursor:
+            if _apply(cursor, version, name, step):
+                applied.append(version)
+                logging.info(f"Applied migration {version}: {name}")
+
+    with transaction() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK_ID,))
+        cursor.execute("SELECT max(version) FROM schema_version;")
+        latest = cursor.fetchone()[0]
+        if latest > MIGRATIONS[-1][0]:
+            raise MigrationError(f"Database schema version {latest} is newer than this code.")
+        cursor.execute("COMMENT ON TABLE schema_version IS %s;", (schema_stamp(),))
+    history.ensure_upcoming_partitions()
+    return applied
+
+
+if __name__ == "__main__":
+    print(f"Applied migrations: {migrate() or 'none, schema is up to date'}")
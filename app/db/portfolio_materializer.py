@@ -0,0 +1,168 @@
+"""
+Set-based UserPortfolio materializer.
+
+UserPortfolio is derived from UserWallets x WalletTokenBalances x TokenCatalog. Each
+rebuild is one statement: a data-modifying CTE computes the positions in scope,
+deletes positions in scope that no longer exist (token sold, balance gone,
+wallet unlinked) and upserts the rest with the usual IS DISTINCT FROM guard.
+
+Scopes:
+- full: every user (`materialize_portfolio()`).
+- users: the given user ids (`materialize_portfolio(user_ids=[...])`).
+- incremental: only wallets whose balances, tokens or totals changed, that
+  lost balances (wallet_balance_deletions) or that were newly linked to a user
+  (UserWallets.linked_at) since the previous run
+  (`materialize_portfolio(incremental=True)`), tracked through the watermark
+  in portfolio_materializer_state.
+
+The per-user/per-chain totals of all users live in the user_chain_aggregates
+materialized view; refresh it with `refresh_chain_aggregates()` after an
+ingest or full rebuild. A single user's totals are read live
+(db.app_user_operations.USER_CHAIN_AGGREGATES_QUERY), so per-user rebuilds
+skip the refresh.
+"""
+
+import logging
+import sys
+from datetime import timedelta
+
+from decouple import config
+
+from db.connection import transaction
+from db.write_stats import write_stats, RETURNING_INSERTED
+
+logging.basicConfig(level=logging.INFO)
+
+# Incremental runs look back this far before the previous watermark, so rows
+# written by transactions that were still open during that run are not missed.
+PORTFOLIO_WATERMARK_OVERLAP = config('PORTFOLIO_WATERMARK_OVERLAP', default=60, cast=int)
+
+# Positions per (user, chain, token, wallet); zero or unknown amounts are not held.
+PORTFOLIO_SOURCE_QUERY = """
+    SELECT
+        uw.user_id,
+        wtb.token_id,
+        t.name,
+        SUM(wtb.amount) AS total_token_amount,
+        SUM(wtb.amount * t.price) AS total_usd_value,
+        uw.wallet_address,
+        wtb.chain
+    FROM UserWallets uw
+    JOIN WalletTokenBalances wtb ON uw.wallet_address = wtb.wallet_address
+    JOIN TokenCatalog t ON t.chain = wtb.chain AND t.token_id = wtb.token_id
+    WHERE wtb.amount <> 0 AND ({scope})
+    GROUP BY uw.user_id, wtb.chain, wtb.token_id, t.name, uw.wallet_address
+"""
+
+MATERIALIZE_PORTFOLIO = """
+    WITH {touched}source AS ({source}),
+    deleted AS (
+        DELETE FROM UserPortfolio up
+        WHERE ({delete_scope})
+          AND NOT EXISTS (
+              SELECT 1 FROM source s
+              WHERE s.user_id = up.user_id AND s.chain = up.chain AND s.token_id = up.token_id
+                AND s.wallet_address = up.wallet_address
+          )
+        RETURNING 1
+    ),
+    merged AS (
+        INSERT INTO UserPortfolio (user_id, token_id, name, total_token_amount, total_usd_value, wallet_address, chain)
+        SELECT * FROM source
+        ON CONFLICT (user_id, chain, token_id, wallet_address)
+        DO UPDATE SET
+            name = EXCLUDED.name,
+            total_token_amount = EXCLUDED.total_token_amount,
+            total_usd_value = EXCLUDED.total_usd_value
+        WHERE (UserPortfolio.name, UserPortfolio.total_token_amount, UserPortfolio.total_usd_value)
+            IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.total_token_amount, EXCLUDED.total_usd_value)
+        {returning}
+    )
+    SELECT (SELECT count(*) FROM source),
+           count(*) FILTER (WHERE inserted),
+           count(*) FILTER (WHERE NOT inserted),
+           (SELECT count(*) FROM deleted)
+    FROM merged;
+"""
+
+# Wallets whose portfolio rows may be stale since %(since)s.
+TOUCHED_WALLETS = """touched AS (
+        SELECT wallet_address FROM WalletTokenBalances WHERE updated_at > %(since)s
+        UNION
+        SELECT wtb.wallet_address
+        FROM TokenCatalog t
+        JOIN WalletTokenBalances wtb ON wtb.chain = t.chain AND wtb.token_id = t.token_id
+        WHERE t.updated_at > %(since)s
+        UNION
+        SELECT address FROM Wallets WHERE updated_at > %(since)s
+        UNION
+        SELECT wallet_address FROM wallet_balance_deletions WHERE deleted_at > %(since)s
+        UNION
+        SELECT wallet_address FROM UserWallets WHERE linked_at > %(since)s
+    ),
+    """
+
+SCOPES = {
+    "full": ("", "TRUE", "TRUE"),
+    "users": ("", "uw.user_id = ANY(%(user_ids)s)", "up.user_id = ANY(%(user_ids)s)"),
+    "incremental": (TOUCHED_WALLETS,
+                    "uw.wallet_address IN (SELECT wallet_address FROM touched)",
+                    "up.wallet_address IN (SELECT wallet_address FROM touched)"),
+}
+
+
+def materialize_sql(scope):
+    touched, source_scope, delete_scope = SCOPES[scope]
+    return MATERIALIZE_PORTFOLIO.format(touched=touched, source=PORTFOLIO_SOURCE_QUERY.format(scope=source_scope),
+                                        delete_scope=delete_scope, returning=RETURNING_INSERTED)
+
+
+def _run(cursor, scope, params):
+    cursor.execute(materialize_sql(scope), params)
+    total, inserted, updated, deleted = cursor.fetchone()
+    write_stats.record("UserPortfolio", total, inserted, updated)
+    return {"scope": scope, "total": total, "inserted": inserted, "updated": updated,
+            "unchanged": total - inserted - updated, "deleted": deleted}
+
+
+def materialize_portfolio(user_ids=None, incremental=False):
+    """
+    Rebuilds UserPortfolio in one transaction and returns row counts.
+
+    Args:
+    - user_ids (list): Only rebuild these users.
+    - incremental (bool): Only rebuild wallets changed since the previous
+      incremental or full run; falls back to a full rebuild on the first run.
+    """
+    with transaction() as cursor:
+        if user_ids is not None:
+            return _run(cursor, "users", {"user_ids": list(user_ids)})
+
+        # The state row lock serializes full and incremental runs.
+        cursor.execute("SELECT last_run_at FROM portfolio_materializer_state WHERE id FOR UPDATE;")
+        row = cursor.fetchone()
+        if incremental and row is not None and row[0] is not None:
+            stats = _run(cursor, "incremental",
+                         {"since": row[0] - timedelta(seconds=PORTFOLIO_WATERMARK_OVERLAP)})
+        else:
+            stats = _run(cursor, "full", {})
+        cursor.execute('''
+            INSERT INTO portfolio_materializer_state (id, last_run_at) VALUES (TRUE, transaction_timestamp())
+            ON CONFLICT (id) DO UPDATE SET last_run_at = EXCLUDED.last_run_at;
+        ''')
+    logging.info(f"Portfolio materialized: {stats}")
+    return stats
+
+
+def refresh_chain_aggregates():
+    """
+    Refreshes the user_chain_aggregates materialized view without blocking
+    dashboard reads (CONCURRENTLY needs its unique index).
+    """
+    with transaction() as cursor:
+        cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY user_chain_aggregates;")
+
+
+if __name__ == "__main__":
+    print(materialize_portfolio(incremental="--incremental" in sys.argv))
+    refresh_chain_aggregates()
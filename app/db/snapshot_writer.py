@@ -0,0 +1,315 @@
+"""
+Batched writer for a wallet's full DeBank snapshot.
+
+`save_wallet_snapshot` upserts Wallets, Chains, WalletChainBalances,
+TokenCatalog and WalletTokenBalances in a single transaction using multi-row
+VALUES batches, so a wallet with hundreds of tokens costs a handful of round
+trips and one commit. Rows whose values did not change are left alone (see
+db.write_stats).
+
+Token metadata and prices go to TokenCatalog, keyed by (chain, token_id) and
+shared by every wallet holding the token; balances reference it. Writers that
+are given a RunCatalog upsert each catalog row once per ingest run.
+
+`write_snapshot_batch` does the same for already-normalized snapshots of many
+wallets at once (one transaction per batch), for the ingestion pipeline's
+write stage.
+
+`save_wallet_snapshot_stream` takes the token list as an iterator (see
+services.debank_data_fetcher.iter_all_token_list) and writes it
+SNAPSHOT_PAGE_SIZE tokens at a time, so memory stays bounded for wallets
+with very large token lists.
+"""
+
+from itertools import islice
+
+from decouple import config
+from psycopg2.extras import execute_values
+
+from db.connection import transaction
+from db.write_stats import write_stats, RETURNING_INSERTED
+from utils.debank_utils import to_decimal, normalize_chain_rows, normalize_token_rows
+
+# Rows per multi-row INSERT statement.
+SNAPSHOT_PAGE_SIZE = config('SNAPSHOT_PAGE_SIZE', default=500, cast=int)
+
+UPSERT_WALLETS = '''
+    INSERT INTO Wallets (address, total_usd_value)
+    VALUES %s
+    ON CONFLICT (address)
+    DO UPDATE SET total_usd_value = EXCLUDED.total_usd_value
+    WHERE Wallets.total_usd_value IS DISTINCT FROM EXCLUDED.total_usd_value
+'''
+
+UPSERT_CHAINS = '''
+    INSERT INTO Chains (id, wallet_address, name, logo_url, wrapped_token_id, community_id, native_token_id, is_support_pre_exec, usd_value)
+    VALUES %s
+    ON CONFLICT (id, wallet_address)
+    DO UPDATE SET
+        name = EXCLUDED.name,
+        logo_url = EXCLUDED.logo_url,
+        wrapped_token_id = EXCLUDED.wrapped_token_id,
+        community_id = EXCLUDED.community_id,
+        native_token_id = EXCLUDED.native_token_id,
+        is_support_pre_exec = EXCLUDED.is_support_pre_exec,
+        usd_value = EXCLUDED.usd_value
+    WHERE (Chains.name, Chains.logo_url, Chains.wrapped_token_id, Chains.community_id, Chains.native_token_id, Chains.is_support_pre_exec, Chains.usd_value)
+        IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.logo_url, EXCLUDED.wrapped_token_id, EXCLUDED.community_id, EXCLUDED.native_token_id, EXCLUDED.is_support_pre_exec, EXCLUDED.usd_value)
+'''
+
+UPSERT_WALLET_CHAIN_BALANCES = '''
+    INSERT INTO WalletChainBalances (wallet_address, chain_id, usd_value)
+    VALUES %s
+    ON CONFLICT (wallet_address, chain_id)
+    DO UPDATE SET usd_value = EXCLUDED.usd_value
+    WHERE WalletChainBalances.usd_value IS DISTINCT FROM EXCLUDED.usd_value
+'''
+
+UPSERT_TOKEN_CATALOG = '''
+    INSERT INTO TokenCatalog (chain, token_id, name, symbol, display_symbol, optimized_symbol, decimals, logo_url, protocol_id, price, price_24h_change, is_verified, is_core, is_wallet, time_at)
+    VALUES %s
+    ON CONFLICT (chain, token_id)
+    DO UPDATE SET
+        name = EXCLUDED.name,
+        symbol = EXCLUDED.symbol,
+        display_symbol = EXCLUDED.display_symbol,
+        optimized_symbol = EXCLUDED.optimized_symbol,
+        decimals = EXCLUDED.decimals,
+        logo_url = EXCLUDED.logo_url,
+        protocol_id = EXCLUDED.protocol_id,
+        price = EXCLUDED.price,
+        price_24h_change = EXCLUDED.price_24h_change,
+        is_verified = EXCLUDED.is_verified,
+        is_core = EXCLUDED.is_core,
+        is_wallet = EXCLUDED.is_wallet,
+        time_at = EXCLUDED.time_at
+    WHERE (TokenCatalog.name, TokenCatalog.symbol, TokenCatalog.display_symbol, TokenCatalog.optimized_symbol, TokenCatalog.decimals, TokenCatalog.logo_url, TokenCatalog.protocol_id, TokenCatalog.price, TokenCatalog.price_24h_change, TokenCatalog.is_verified, TokenCatalog.is_core, TokenCatalog.is_wallet, TokenCatalog.time_at)
+        IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.symbol, EXCLUDED.display_symbol, EXCLUDED.optimized_symbol, EXCLUDED.decimals, EXCLUDED.logo_url, EXCLUDED.protocol_id, EXCLUDED.price, EXCLUDED.price_24h_change, EXCLUDED.is_verified, EXCLUDED.is_core, EXCLUDED.is_wallet, EXCLUDED.time_at)
+'''
+
+# CTE that records the wallets of a `deleted AS (DELETE ... RETURNING wallet_address)` CTE.
+RECORD_BALANCE_DELETIONS = '''recorded AS (
+        INSERT INTO wallet_balance_deletions (wallet_address, deleted_at)
+        SELECT DISTINCT wallet_address, now() FROM deleted
+        ON CONFLICT (wallet_address) DO UPDATE SET deleted_at = EXCLUDED.deleted_at
+    )'''
+
+UPSERT_WALLET_TOKEN_BALANCES = '''
+    INSERT INTO WalletTokenBalances (wallet_address, chain, token_id, amount)
+    VALUES %s
+    ON CONFLICT (wallet_address, chain, token_id)
+    DO UPDATE SET amount = EXCLUDED.amount
+    WHERE WalletTokenBalances.amount IS DISTINCT FROM EXCLUDED.amount
+'''
+
+# Balances of tokens a wallet no longer holds: rows of the fetched wallets (on
+# every chain, or only on the chains whose token lists were fetched) that the
+# new payloads do not contain. Deletions leave no updated_at behind, so the
+# wallets are recorded for incremental portfolio runs; returns the row count.
+DELETE_STALE_BALANCES = f'''
+    WITH deleted AS (
+        DELETE FROM WalletTokenBalances wtb
+        USING unnest(%(wallets)s::varchar[], %(chains)s::varchar[]) AS fetched (wallet_address, chain)
+        WHERE wtb.wallet_address = fetched.wallet_address
+          AND (fetched.chain IS NULL OR wtb.chain = fetched.chain)
+          AND NOT EXISTS (
+              SELECT 1
+              FROM unnest(%(kept_wallets)s::varchar[], %(kept_chains)s::varchar[], %(kept_tokens)s::varchar[])
+                  AS kept (wallet_address, chain, token_id)
+              WHERE kept.wallet_address = wtb.wallet_address AND kept.chain = wtb.chain
+                AND kept.token_id = wtb.token_id
+          )
+        RETURNING wtb.wallet_address
+    ),
+    {RECORD_BALANCE_DELETIONS}
+    SELECT count(*) FROM deleted;
+'''
+
+
+def catalog_rows(token_rows, catalog=None):
+    """
+    TokenCatalog rows for normalized token rows, one per (chain, token_id);
+    the last row wins. Keys `catalog` already wrote in this run are left out.
+    """
+    rows = {(row[2], row[0]): (row[2], row[0]) + tuple(row[3:16]) for row in token_rows}
+    if catalog is not None:
+        return [row for key, row in rows.items() if key not in catalog]
+    return list(rows.values())
+
+
+def balance_rows(token_rows):
+    """WalletTokenBalances rows (wallet_address, chain, token_id, amount) for normalized token rows."""
+    return [(row[1], row[2], row[0], row[16]) for row in token_rows]
+
+
+class RunCatalog:
+    """
+    The (chain, token_id) keys of TokenCatalog written during one ingest run.
+
+    Metadata and prices are the same for every wallet holding a token, so the
+    first batch of the run that sees a token upserts its catalog row and later
+    batches only write their balances. Keys are added once the writing
+    transaction has committed, so a rolled-back batch is written again.
+    """
+
+    def __init__(self, written=()):
+        self.written = set(written)
+
+    def __contains__(self, key):
+        return key in self.written
+
+    def __len__(self):
+        return len(self.written)
+
+    def add(self, rows):
+        self.written.update((row[0], row[1]) for row in rows)
+
+
+def upsert_rows(cursor, table, query, rows, page_size=SNAPSHOT_PAGE_SIZE):
+    """Runs a VALUES %s upsert for all rows, page_size rows per statement, and counts changes."""
+    if rows:
+        returned = execute_values(cursor, f"{query} {RETURNING_INSERTED}", rows, page_size=page_size, fetch=True)
+        write_stats.record_returned(table, len(rows), returned)
+
+
+def write_token_rows(cursor, token_rows, catalog=None):
+    """
+    Upserts the catalog rows, then the balances, of normalized token rows using
+    the caller's transaction. Returns the catalog rows written, for
+    RunCatalog.add once the transaction has committed.
+    """
+    written = catalog_rows(token_rows, catalog)
+    upsert_rows(cursor, "TokenCatalog", UPSERT_TOKEN_CATALOG, written)
+    upsert_rows(cursor, "WalletTokenBalances", UPSERT_WALLET_TOKEN_BALANCES, balance_rows(token_rows))
+    return written
+
+
+def delete_stale_balances(cursor, scopes, kept):
+    """
+    Deletes the balances that freshly fetched token lists no longer contain,
+    using the caller's transaction, and returns how many were deleted.
+
+    Args:
+    - scopes (iterable): (wallet_address, token_chains) per written wallet; token_chains is None when
+      the full token list was fetched, otherwise the chains whose token lists were fetched.
+    - kept (iterable): (wallet_address, chain, token_id, ...) of every balance in the payloads.
+    """
+    fetched = [(wallet_address, chain) for wallet_address, token_chains in scopes
+               for chain in ([None] if token_chains is None else token_chains)]
+    if not fetched:
+        return 0
+    kept = list(kept)
+    cursor.execute(DELETE_STALE_BALANCES, {
+        "wallets": [wallet_address for wallet_address, _ in fetched],
+        "chains": [chain for _, chain in fetched],
+        "kept_wallets": [row[0] for row in kept],
+        "kept_chains": [row[1] for row in kept],
+        "kept_tokens": [row[2] for row in kept],
+    })
+    deleted = cursor.fetchone()[0]
+    write_stats.record_deleted("WalletTokenBalances", deleted)
+    return deleted
+
+
+def write_snapshot_rows(cursor, wallet_address, total_usd_value, chain_rows, token_rows, catalog=None):
+    """Writes already-normalized snapshot rows using the caller's transaction; returns the catalog rows written."""
+    upsert_rows(cursor, "Wallets", UPSERT_WALLETS, [(wallet_address, total_usd_value)])
+    upsert_rows(cursor, "Chains", UPSERT_CHAINS, chain_rows)
+    upsert_rows(cursor, "WalletChainBalances", UPSERT_WALLET_CHAIN_BALANCES,
+                [(wallet_address, row[0], row[8]) for row in chain_rows])
+    return write_token_rows(cursor, token_rows, catalog)
+
+
+def normalize_snapshot(wallet_address, raw_balance_data, raw_token_data, token_chains=None):
+    """
+    Returns (wallet_address, total_usd_value, chain_rows, token_rows, token_chains) for
+    write_snapshot_batch; token_chains lists the chains raw_token_data covers (None: all of them).
+    """
+    return (wallet_address, to_decimal(raw_balance_data['total_usd_value']),
+            normalize_chain_rows(wallet_address, raw_balance_data),
+            normalize_token_rows(wallet_address, raw_token_data), token_chains)
+
+
+def write_snapshot_batch(snapshots, catalog=None):
+    """
+    Writes normalized snapshots of many wallets in one transaction.
+
+    A token held by several wallets of the batch gets one catalog row (a
+    multi-row upsert may not touch the same row twice); with a RunCatalog,
+    tokens an earlier batch of the run wrote are skipped altogether.
+
+    Balances the new token lists no longer contain are deleted, limited to the
+    chains that were fetched for per-chain (incremental) snapshots.
+    """
+    chain_rows = [row for _, _, rows, _, _ in snapshots for row in rows]
+    token_rows = [row for _, _, _, rows, _ in snapshots for row in rows]
+    with transaction() as cursor:
+        upsert_rows(cursor, "Wallets", UPSERT_WALLETS,
+                    [(wallet_address, total) for wallet_address, total, _, _, _ in snapshots])
+        upsert_rows(cursor, "Chains", UPSERT_CHAINS, chain_rows)
+        upsert_rows(cursor, "WalletChainBalances", UPSERT_WALLET_CHAIN_BALANCES,
+                    [(row[1], row[0], row[8]) for row in chain_rows])
+        written = write_token_rows(cursor, token_rows, catalog)
+        delete_stale_balances(cursor, [(snapshot[0], snapshot[4]) for snapshot in snapshots],
+                              balance_rows(token_rows))
+    if catalog is not None:
+        catalog.add(written)
+
+
+def save_wallet_snapshot(wallet_address, raw_balance_data, raw_token_data):
+    """
+    Upserts a wallet's total_balance and token list payloads in one transaction.
+
+    Args:
+    - wallet_address (str): Wallet the payloads belong to.
+    - raw_balance_data (dict): DeBank total_balance response.
+    - raw_token_data (list): DeBank all_token_list response.
+    """
+    chain_rows = normalize_chain_rows(wallet_address, raw_balance_data)
+    token_rows = normalize_token_rows(wallet_address, raw_token_data)
+    with transaction() as cursor:
+        write_snapshot_rows(cursor, wallet_address, to_decimal(raw_balance_data['total_usd_value']),
+                            chain_rows, token_rows)
+        delete_stale_balances(cursor, [(wallet_address, None)], balance_rows(token_rows))
+
+
+def save_wallet_snapshot_stream(stored_addresses, raw_balance_data, tokens, chunk_size=SNAPSHOT_PAGE_SIZE, catalog=None):
+    """
+    Upserts a wallet's snapshot in one transaction, consuming `tokens` chunk by chunk.
+
+    Args:
+    - stored_addresses (iterable): Spellings the wallet is stored under; each gets the same rows.
+    - raw_balance_data (dict): DeBank total_balance response.
+    - tokens (iterator): Token records, e.g. from iter_all_token_list.
+    - chunk_size (int): Tokens normalized and written per step.
+    - catalog (RunCatalog): Catalog keys already written in this run.
+
+    Balances the full token list no longer contains are deleted at the end.
+
+    Returns the number of token records written.
+    """
+    stored_addresses = list(stored_addresses)
+    tokens = iter(tokens)
+    written = 0
+    kept = set()
+    # Keys written by this transaction, so the other spellings and later
+    # chunks skip them too; they only join `catalog` after the commit.
+    pending = RunCatalog(catalog.written if catalog is not None else ())
+    with transaction() as cursor:
+        total_usd_value = to_decimal(raw_balance_data['total_usd_value'])
+        for wallet_address in stored_addresses:
+            write_snapshot_rows(cursor, wallet_address, total_usd_value,
+                                normalize_chain_rows(wallet_address, raw_balance_data), [])
+        while True:
+            chunk = list(islice(tokens, chunk_size))
+            if not chunk:
+                break
+            for wallet_address in stored_addresses:
+                token_rows = normalize_token_rows(wallet_address, chunk)
+                pending.add(write_token_rows(cursor, token_rows, pending))
+                kept.update((row[1], row[2], row[0]) for row in token_rows)
+            written += len(chunk)
+        delete_stale_balances(cursor, [(wallet_address, None) for wallet_address in stored_addresses], kept)
+    if catalog is not None:
+        catalog.written |= pending.written
+    return written
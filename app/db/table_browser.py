@@ -0,0 +1,113 @@
+"""
+Paginated, streaming table reads.
+
+`fetch_page` returns one keyset page ordered by the table's primary key:
+pass the returned `next_key` as `after` to get the following page, so every
+page costs an index range scan no matter how deep it is. `iter_rows` streams
+a whole table, `itersize` rows per round trip. Both read through server-side
+(named) cursors, only hold one page or batch in memory and can project a
+subset of columns.
+
+Table and column names are checked against the catalog and quoted, so they are
+safe to take from the UI.
+"""
+
+from psycopg2 import sql
+
+from db.connection import connection, transaction
+
+DEFAULT_PAGE_SIZE = 100
+STREAM_BATCH_SIZE = 1000
+
+
+def table_columns(table):
+    """Returns the column names of `table` in column order (empty if it does not exist)."""
+    with transaction() as cursor:
+        cursor.execute('''
+            SELECT attname FROM pg_attribute
+            WHERE attrelid = to_regclass(%s) AND attnum > 0 AND NOT attisdropped
+            ORDER BY attnum;
+        ''', (table.lower(),))
+        return [row[0] for row in cursor.fetchall()]
+
+
+def primary_key_columns(table):
+    """Returns the primary key columns of `table` in key order."""
+    with transaction() as cursor:
+        cursor.execute('''
+            SELECT a.attname
+            FROM pg_index i
+            JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, position) ON TRUE
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+            WHERE i.indrelid = to_regclass(%s) AND i.indisprimary
+            ORDER BY k.position;
+        ''', (table.lower(),))
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _resolve(table, columns):
+    available = table_columns(table)
+    if not available:
+        raise ValueError(f"Unknown table: {table}")
+    if not columns:
+        return available
+    unknown = [column for column in columns if column not in available]
+    if unknown:
+        raise ValueError(f"Unknown columns for {table}: {', '.join(unknown)}")
+    return list(columns)
+
+
+def _identifiers(names):
+    return sql.SQL(", ").join(sql.Identifier(name) for name in names)
+
+
+def fetch_page(table, page_size=DEFAULT_PAGE_SIZE, after=None, columns=None):
+    """
+    Fetches one page of `table` in primary key order.
+
+    Args:
+    - table (str): Table name.
+    - page_size (int): Maximum rows on the page.
+    - after (tuple): Primary key of the last row of the previous page (None for the first page).
+    - columns (list): Columns to return (default: all).
+
+    Returns (columns, rows, next_key); next_key is None on the last page.
+    """
+    columns = _resolve(table, columns)
+    key = primary_key_columns(table)
+    if not key:
+        raise ValueError(f"{table} has no primary key to paginate on.")
+
+    # Key columns are always selected so the next page can start after this one.
+    selected = columns + [column for column in key if column not in columns]
+    query = sql.SQL("SELECT {selected} FROM {table} {where} ORDER BY {key} LIMIT %s").format(
+        selected=_identifiers(selected),
+        table=sql.Identifier(table.lower()),
+        where=sql.SQL("WHERE ({key}) > ({values})").format(
+            key=_identifiers(key), values=sql.SQL(", ").join(sql.Placeholder() * len(key)),
+        ) if after is not None else sql.SQL(""),
+        key=_identifiers(key),
+    )
+    params = (list(after) if after is not None else []) + [page_size + 1]
+
+    with connection() as conn:
+        with conn.cursor(name=f"page_{table.lower()}") as cursor:
+            cursor.execute(query, params)
+            rows = cursor.fetchmany(page_size + 1)
+
+    key_positions = [selected.index(column) for column in key]
+    next_key = tuple(rows[page_size - 1][i] for i in key_positions) if len(rows) > page_size else None
+    return columns, [row[:len(columns)] for row in rows[:page_size]], next_key
+
+
+def iter_rows(table, columns=None, batch_size=STREAM_BATCH_SIZE):
+    """Yields the rows of `table` through a named cursor, `batch_size` rows per round trip."""
+    columns = _resolve(table, columns)
+    query = sql.SQL("SELECT {columns} FROM {table}").format(
+        columns=_identifiers(columns), table=sql.Identifier(table.lower()),
+    )
+    with connection() as conn:
+        with conn.cursor(name=f"browse_{table.lower()}") as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(query)
+            yield from cursor
@@ -0,0 +1,77 @@
+"""
+Per-run counters of inserted, updated and unchanged rows.
+
+Every upsert only updates rows whose values actually differ (`IS DISTINCT FROM`
+guards), so unchanged rows produce no dead tuples and no history rows. The
+counters here make that visible: history growth should track `updated`.
+
+Upserts report through `RETURNING (xmax = 0) AS inserted`: rows skipped by
+the guard return nothing, so unchanged = rows sent - rows returned. Rows
+removed because the source no longer has them are counted as deleted.
+"""
+
+import threading
+
+RETURNING_INSERTED = "RETURNING (xmax = 0) AS inserted"
+
+
+class WriteStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables = {}
+
+    def record(self, table, total, inserted, updated):
+        with self._lock:
+            counts = self._counts(table)
+            counts["inserted"] += inserted
+            counts["updated"] += updated
+            counts["unchanged"] += max(total - inserted - updated, 0)
+
+    def record_deleted(self, table, deleted):
+        with self._lock:
+            self._counts(table)["deleted"] += deleted
+
+    def _counts(self, table):
+        return self._tables.setdefault(table, {"inserted": 0, "updated": 0, "unchanged": 0, "deleted": 0})
+
+    def record_returned(self, table, total, returned_rows):
+        """Records the result of an upsert that ended with RETURNING_INSERTED."""
+        inserted = sum(1 for row in returned_rows if row[0])
+        self.record(table, total, inserted, len(returned_rows) - inserted)
+
+    def reset(self):
+        with self._lock:
+            self._tables = {}
+
+    def report(self):
+        with self._lock:
+            report = {table: dict(counts) for table, counts in self._tables.items()}
+        changed = sum(c["inserted"] + c["updated"] + c["deleted"] for c in report.values())
+        unchanged = sum(c["unchanged"] for c in report.values())
+        return {"tables": report, "changed": changed, "unchanged": unchanged}
+
+
+write_stats = WriteStats()
+
+
+def run_counted_merge(cursor, table, source_sql, insert_sql, conflict_sql, values=None):
+    """
+    Runs `insert_sql SELECT * FROM (source_sql) conflict_sql` and records how
+    many source rows were inserted, updated or left unchanged.
+    """
+    cursor.execute(f'''
+        WITH source AS ({source_sql}),
+        merged AS (
+            {insert_sql}
+            SELECT * FROM source
+            {conflict_sql}
+            {RETURNING_INSERTED}
+        )
+        SELECT (SELECT count(*) FROM source),
+               count(*) FILTER (WHERE inserted),
+               count(*) FILTER (WHERE NOT inserted)
+        FROM merged;
+    ''', values)
+    total, inserted, updated = cursor.fetchone()
+    write_stats.record(table, total, inserted, updated)
+    return {"total": total, "inserted": inserted, "updated": updated, "unchanged": total - inserted - updated}
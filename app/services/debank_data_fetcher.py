@@ -1,90 +1,145 @@
+import time
 import requests
-from utils.debank_utils import headers, DEBANK_API_URL, to_decimal
-from db.debank_db_setup import execute_query, execute_query_with_result
+from utils.http_client import http_get
+from utils.rate_limiter import ComputeUnitLimiter
+from utils.response_cache import cached_fetch, cached_payload, cached_stream
+from utils.debank_utils import (headers, DEBANK_API_URL, DEBANK_PROCESS_UNITS_PER_SECOND, DEBANK_MAX_RETRIES,
+                                DebankAPIError, endpoint_units)
+from db.connection import execute_query_with_result
+from db.snapshot_writer import save_wallet_snapshot
 
 DEBUG = False # This can be sourced from environment variables, config files, or set as per your needs
 
-def debug_print(msg):
+# Shared by every fetch in the process so concurrent wallets stay within quota;
+# sized to this process's share when several refresh workers run.
+debank_limiter = ComputeUnitLimiter(DEBANK_PROCESS_UNITS_PER_SECOND)
+
+def debug_print(msg, *args):
+    # Formatting is deferred so large payloads are never stringified when DEBUG is off.
     if DEBUG:
-        print(msg)
+        print(msg % args if args else msg)
+
+def is_retryable_status(status_code):
+    return status_code == 429 or status_code >= 500
 
-def fetch_data_from_api(url, address=None):
-    debug_print(f"Fetching data from {url}...")
-    params = {}
+def request_api(url, address=None, extra_params=None, stream=False):
+    """Issues a rate-limited DeBank GET with retries and returns the successful response."""
+    debug_print("Fetching data from %s...", url)
+    params = dict(extra_params or {})
     if address:
         sanitized_address = address.strip('{}')
         params['id'] = sanitized_address
 
+    units = endpoint_units(url)
+    last_error = None
+    for attempt in range(DEBANK_MAX_RETRIES + 1):
+        debank_limiter.acquire(units)
+        try:
+            response = http_get(url, headers=headers, params=params, stream=stream)
+        except requests.RequestException as e:
+            last_error = e
+        else:
+            if response.ok:
+                debank_limiter.on_success()
+                return response
+            if not is_retryable_status(response.status_code):
+                raise DebankAPIError(f"{url} returned {response.status_code}: {response.text[:200]}")
+            debank_limiter.on_throttled()
+            last_error = DebankAPIError(f"{url} returned {response.status_code}")
+            response.close()
+
+        if attempt < DEBANK_MAX_RETRIES:
+            delay = debank_limiter.backoff_delay(attempt)
+            debug_print("Retrying %s in %.2fs after: %s", url, delay, last_error)
+            time.sleep(delay)
+
+    raise DebankAPIError(f"Giving up on {url} after {DEBANK_MAX_RETRIES + 1} attempts: {last_error}")
+
+def fetch_data_from_api(url, address=None, extra_params=None):
+    data = request_api(url, address=address, extra_params=extra_params).json()
+    debug_print("Data fetched: %s", data)
+    return data
+
+def stream_data_from_api(url, cache_endpoint, cache_key, address=None, extra_params=None, use_cache=True):
+    """
+    Yields the records of a DeBank array response one at a time, parsed from
+    the response stream (or the cached copy) instead of loading the whole body.
+    """
+    responses = []
+
+    def open_body():
+        response = request_api(url, address=address, extra_params=extra_params, stream=True)
+        responses.append(response)
+        response.raw.decode_content = True
+        return response.raw
+
+    try:
+        yield from cached_stream(cache_endpoint, cache_key, open_body, use_cache=use_cache)
+    finally:
+        for response in responses:
+            response.close()
+
+def fetch_payload_from_api(url, cache_endpoint, cache_key, address=None, extra_params=None, use_cache=True):
+    """
+    Reads a DeBank response (or the cached copy) to the end and returns its
+    zlib-compressed body, so the connection is released right away however
+    slowly the records are consumed afterwards.
+    """
+    responses = []
+
+    def open_body():
+        response = request_api(url, address=address, extra_params=extra_params, stream=True)
+        responses.append(response)
+        response.raw.decode_content = True
+        return response.raw
+
     try:
-        response = requests.get(url, headers=headers, params=params)
-        debug_print(f"Data fetched: {response.json()}")
-        return response.json()
-    except Exception as e:
-        debug_print(f"Error fetching data: {e}")
-        return []
-
-def fetch_all_token_list(address):
-    debug_print(f"Fetching all tokens for address: {address}...")
-    url = f"{DEBANK_API_URL}/v1/user/all_token_list"
-    return fetch_data_from_api(url, address=address)
-
-def fetch_total_balance(address):
+        return cached_payload(cache_endpoint, cache_key, open_body, use_cache=use_cache)
+    finally:
+        for response in responses:
+            response.close()
+
+def iter_all_token_list(address, use_cache=True):
+    """Streams the tokens held by `address` on all chains, one record at a time."""
+    return stream_data_from_api(f"{DEBANK_API_URL}/v1/user/all_token_list", "debank:all_token_list",
+                                address.strip().lower(), address=address, use_cache=use_cache)
+
+def fetch_all_token_list_payload(address, use_cache=True):
+    """The all_token_list body of `address`, zlib-compressed (see fetch_payload_from_api)."""
+    return fetch_payload_from_api(f"{DEBANK_API_URL}/v1/user/all_token_list", "debank:all_token_list",
+                                  address.strip().lower(), address=address, use_cache=use_cache)
+
+def fetch_all_token_list(address, use_cache=True):
+    debug_print("Fetching all tokens for address: %s...", address)
+    return list(iter_all_token_list(address, use_cache=use_cache))
+
+def fetch_token_list(address, chain_id, use_cache=True):
+    """Fetches the tokens held by `address` on a single chain."""
+    url = f"{DEBANK_API_URL}/v1/user/token_list"
+    return cached_fetch("debank:token_list", f"{address.strip().lower()}:{chain_id}",
+                        lambda: fetch_data_from_api(url, address=address, extra_params={'chain_id': chain_id, 'is_all': 'true'}),
+                        use_cache=use_cache)
+
+def fetch_total_balance(address, use_cache=True):
     url = f"{DEBANK_API_URL}/v1/user/total_balance"
-    return fetch_data_from_api(url, address=address)
+    return cached_fetch("debank:total_balance", address.strip().lower(),
+                        lambda: fetch_data_from_api(url, address=address), use_cache=use_cache)
 
 def save_raw_data_to_db(wallet_address, raw_balance_data, raw_token_data):
-    print("hereis raw balance date", raw_balance_data)
-    # 1. Insert or Update Wallet's data
-    execute_query('''
-        INSERT INTO Wallets (address, total_usd_value)
-        VALUES (%s, %s)
-        ON CONFLICT (address)
-        DO UPDATE SET total_usd_value = EXCLUDED.total_usd_value;
-    ''', (wallet_address, to_decimal(raw_balance_data['total_usd_value'])))
-
-    # 2. Insert or Update Chains
-    for chain in raw_balance_data['chain_list']:
-        execute_query('''
-            INSERT INTO Chains (id, name, logo_url, wrapped_token_id)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (id)
-            DO UPDATE SET name = EXCLUDED.name, logo_url = EXCLUDED.logo_url, wrapped_token_id = EXCLUDED.wrapped_token_id;
-        ''', (chain['id'], chain['name'], chain['logo_url'], chain['wrapped_token_id']))
-
-        # 3. Insert or Update WalletChainBalances
-        execute_query('''
-            INSERT INTO WalletChainBalances (wallet_address, chain_id, usd_value)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (wallet_address, chain_id)
-            DO UPDATE SET usd_value = EXCLUDED.usd_value;
-        ''', (wallet_address, chain['id'], to_decimal(chain['usd_value'])))
-
-    # 4. Insert or Update Tokens
-    for token in raw_token_data:
-        execute_query('''
-            INSERT INTO Tokens (id, chain, name, symbol)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (id)
-            DO UPDATE SET chain = EXCLUDED.chain, name = EXCLUDED.name, symbol = EXCLUDED.symbol;
-        ''', (token['id'], token['chain'], token['name'], token['symbol']))
-
-        # 5. Insert or Update WalletTokenBalances
-        execute_query('''
-            INSERT INTO WalletTokenBalances (wallet_address, token_id, amount)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (wallet_address, token_id)
-            DO UPDATE SET amount = EXCLUDED.amount;
-        ''', (wallet_address, token['id'], to_decimal(token['amount'])))
+    save_wallet_snapshot(wallet_address, raw_balance_data, raw_token_data)
 
 
 def get_all_wallet_addresses():
-    return [row[0] for row in execute_query_with_result("SELECT wallet_address FROM UserWallets;")]
+    return [row[0] for row in execute_query_with_result("SELECT DISTINCT wallet_address FROM UserWallets;")]
 
 
 if __name__ == "__main__":
-    wallet_addresses = get_all_wallet_addresses()
-    
-    for wallet_address in wallet_addresses:
-        raw_balance_data = fetch_total_balance(wallet_address)
-        raw_token_data = fetch_all_token_list(wallet_address)
-        save_raw_data_to_db(wallet_address, raw_balance_data, raw_token_data)
+    import sys
+    from db.app_user_operations import refresh_all_portfolios
+    from services.ingestion_engine import run_ingestion
+    from services.refresh_planner import plan_from_addresses
+
+    plan = plan_from_addresses(get_all_wallet_addresses())
+    summary = run_ingestion(plan, incremental="--incremental" in sys.argv, bulk="--bulk" in sys.argv)
+    if summary["saved"]:
+        refresh_all_portfolios(incremental=True)
@@ -0,0 +1,425 @@
+"""
+Asyncio ingestion engine for refreshing DeBank wallet data.
+
+Work comes from a refresh plan (see services.refresh_planner), so a wallet
+shared by several users is fetched once and written under every stored
+spelling, and each owner's portfolio is refreshed afterwards.
+
+A run is a streaming pipeline of three stages connected by bounded queues:
+
+- fetch: INGEST_CONCURRENCY workers pull `total_balance` and `all_token_list`
+  for one wallet at a time;
+- normalize: PIPELINE_NORMALIZE_WORKERS threads turn the payloads into rows
+  (to_decimal / to_timestamp conversion);
+- write: a single writer drains up to PIPELINE_WRITE_BATCH wallets at a time
+  and upserts them in one transaction.
+
+When a queue is full the stage feeding it waits, so network I/O, parsing and
+Postgres writes overlap while at most PIPELINE_QUEUE_SIZE payloads per queue
+are held in memory, however many wallets the plan has. Each stage reports its
+utilization (busy time over available worker time) and how long it was blocked
+by the next stage in the run summary.
+
+In incremental mode only `total_balance` is fetched up front; token lists are
+pulled just for wallets (or chains) whose value moved since the last run.
+
+Token lists are parsed incrementally from the response stream. With the
+default writer, a wallet holding more than PIPELINE_STREAM_TOKENS tokens is
+not materialized at all: the fetch stage reads its response to the end into a
+compressed buffer, so no connection waits behind the queues, and the writer
+parses the tokens from that buffer chunk by chunk
+(db.snapshot_writer.save_wallet_snapshot_stream).
+
+Token metadata and prices are shared by every wallet holding a token: the
+default writer keeps a RunCatalog, so each TokenCatalog row is upserted by the
+first batch of the run that sees the token and later batches only write
+balances.
+
+In bulk mode the writer buffers rows and loads them with COPY + set-based
+merges (see db.bulk_loader) every BULK_LOAD_WALLETS wallets. Buffered wallets
+are only reported once their load commits; a failed load fails just its own
+wallets and the run carries on with a fresh buffer.
+"""
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from decouple import config
+
+from db.app_user_operations import fetch_stored_wallet_balances
+from db import history
+from db.bulk_loader import BulkLoadBuffer, bulk_load
+from db.snapshot_writer import RunCatalog, normalize_snapshot, save_wallet_snapshot_stream, write_snapshot_batch
+from db.write_stats import write_stats
+from services.debank_data_fetcher import (fetch_total_balance, fetch_all_token_list, fetch_token_list,
+                                          fetch_all_token_list_payload, debank_limiter)
+from services.refresh_planner import changed_chains, MAX_PER_CHAIN_FETCHES
+from utils.json_stream import DecompressingReader, iter_json_items
+
+logging.basicConfig(level=logging.INFO)
+
+# Number of wallets fetched in parallel. Each wallet issues two requests.
+INGEST_CONCURRENCY = config('INGEST_CONCURRENCY', default=16, cast=int)
+# Wallets buffered per COPY load in bulk mode.
+BULK_LOAD_WALLETS = config('BULK_LOAD_WALLETS', default=1000, cast=int)
+# Wallets held by each inter-stage queue.
+PIPELINE_QUEUE_SIZE = config('PIPELINE_QUEUE_SIZE', default=64, cast=int)
+PIPELINE_NORMALIZE_WORKERS = config('PIPELINE_NORMALIZE_WORKERS', default=2, cast=int)
+# Wallets written per transaction by the write stage.
+PIPELINE_WRITE_BATCH = config('PIPELINE_WRITE_BATCH', default=50, cast=int)
+# Token lists longer than this are streamed into the writer instead of being held in memory.
+PIPELINE_STREAM_TOKENS = config('PIPELINE_STREAM_TOKENS', default=5000, cast=int)
+
+# End-of-stream marker passed down the queues.
+_DONE = object()
+
+
+class StageStats:
+    """Counters of one pipeline stage."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+
+    def report(self, elapsed):
+        capacity = max(elapsed * self.workers, 1e-9)
+        return {"workers": self.workers, "items": self.items, "busy_seconds": round(self.busy, 2),
+                "blocked_seconds": round(self.blocked, 2), "utilization": round(self.busy / capacity, 3)}
+
+
+async def _put(queue, item, stats):
+    """Puts into a bounded queue, counting the time spent waiting on the next stage."""
+    started = time.monotonic()
+    await queue.put(item)
+    stats.blocked += time.monotonic() - started
+
+
+async def _run_stages(*stages):
+    """Runs the stages together; if one fails the others are cancelled instead of blocking on its queue."""
+    tasks = [asyncio.create_task(stage) for stage in stages]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+class StreamedTokens:
+    """A token list too large to materialize, held as its compressed response body."""
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    @property
+    def tokens(self):
+        """A fresh iterator over the tokens, parsed from the payload as it is consumed."""
+        return iter_json_items(DecompressingReader(self.payload))
+
+
+def _fetch_token_list_bounded(wallet_address, use_cache, limit):
+    """Returns the token list, or StreamedTokens if it has more than `limit` tokens."""
+    payload = fetch_all_token_list_payload(wallet_address, use_cache)
+    tokens = list(islice(StreamedTokens(payload).tokens, limit + 1))
+    if len(tokens) <= limit:
+        return tokens
+    return StreamedTokens(payload)
+
+
+async def _fetch_wallet(loop, fetch_executor, wallet_address, use_cache, stream_tokens=False):
+    """Fetches both DeBank endpoints for one wallet, concurrently."""
+    if stream_tokens:
+        fetch_tokens = loop.run_in_executor(fetch_executor, _fetch_token_list_bounded, wallet_address, use_cache,
+                                            PIPELINE_STREAM_TOKENS)
+    else:
+        fetch_tokens = loop.run_in_executor(fetch_executor, fetch_all_token_list, wallet_address, use_cache)
+    raw_balance_data, raw_token_data = await asyncio.gather(
+        loop.run_in_executor(fetch_executor, fetch_total_balance, wallet_address, use_cache),
+        fetch_tokens,
+    )
+    return raw_balance_data, raw_token_data
+
+
+async def _fetch_wallet_incremental(loop, fetch_executor, wallet_address, use_cache, stored_balance):
+    """
+    Fetches total_balance and only the token lists of chains that changed.
+
+    Returns (raw_balance_data, raw_token_data, token_chains): raw_token_data is
+    None when nothing moved beyond the threshold, token_chains the chains the
+    token list covers (None when the full list was fetched).
+    """
+    raw_balance_data = await loop.run_in_executor(fetch_executor, fetch_total_balance, wallet_address, use_cache)
+    if not isinstance(raw_balance_data, dict):
+        return raw_balance_data, [], None
+
+    chains = changed_chains(raw_balance_data, stored_balance)
+    if chains is not None and not chains:
+        return raw_balance_data, None, None
+
+    if chains is None or len(chains) > MAX_PER_CHAIN_FETCHES:
+        raw_token_data = await loop.run_in_executor(fetch_executor, fetch_all_token_list, wallet_address, use_cache)
+        return raw_balance_data, raw_token_data, None
+    per_chain = await asyncio.gather(*(
+        loop.run_in_executor(fetch_executor, fetch_token_list, wallet_address, chain_id, use_cache)
+        for chain_id in chains
+    ))
+    return raw_balance_data, [token for tokens in per_chain for token in tokens], sorted(chains)
+
+
+def _normalize_wallet(stored_addresses, raw_balance_data, raw_token_data, token_chains):
+    return [normalize_snapshot(stored_address, raw_balance_data, raw_token_data, token_chains)
+            for stored_address in stored_addresses]
+
+
+async def ingest_wallets(plan, save_fn=None, concurrency=INGEST_CONCURRENCY, use_cache=True, incremental=False,
+                         refresh_portfolio_fn=None, bulk=False, progress_fn=None, outcome_fn=None):
+    """
+    Fetches and stores data for all wallets in a refresh plan.
+
+    Args:
+    - plan (dict): Refresh plan from build_refresh_plan / plan_from_addresses.
+    - save_fn (callable): Optional custom writer called as save_fn(wallet_address, raw_balance_data, raw_token_data)
+      for each wallet; by default wallets are normalized and written in batches.
+    - concurrency (int): Maximum number of wallets being fetched at the same time.
+    - use_cache (bool): Set to False to bypass the on-disk response cache.
+    - incremental (bool): Only pull token lists for wallets/chains whose balance moved.
+    - refresh_portfolio_fn (callable): Called once per owning user of a saved wallet.
+    - bulk (bool): Buffer rows and load them with COPY instead of upserting batches.
+    - progress_fn (callable): Called with a copy of the running summary after every wallet.
+    - outcome_fn (callable): Called as outcome_fn(wallet_address, outcome, error) after every wallet,
+      with outcome "saved", "unchanged" or "failed".
+
+    Returns a summary dict with the number of wallets saved, unchanged and
+    failed, the DeBank compute units spent, the changed vs. unchanged rows
+    written by the run, the TokenCatalog rows it upserted and per-stage
+    utilization.
+    """
+    loop = asyncio.get_running_loop()
+    summary = {"wallets": len(plan), "saved": 0, "unchanged": 0, "failed": 0}
+    affected_users = set()
+    started = time.monotonic()
+    debank_limiter.reset_usage()
+    write_stats.reset()
+    stages = {"fetch": StageStats(concurrency), "normalize": StageStats(PIPELINE_NORMALIZE_WORKERS),
+              "write": StageStats(1)}
+    fetched = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    normalized = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    buffer = BulkLoadBuffer() if bulk else None
+    # Wallets whose rows sit in `buffer`; recorded once their bulk load commits.
+    buffered_wallets = []
+    catalog = RunCatalog()
+    if bulk:
+        summary["bulk_loads"] = []
+
+    def record(wallet_address, outcome, error=None):
+        # Only ever called on the event loop thread.
+        summary[outcome] += 1
+        if outcome == "saved":
+            affected_users.update(plan[wallet_address]["user_ids"])
+        if outcome_fn is not None:
+            outcome_fn(wallet_address, outcome, None if error is None else str(error))
+        if progress_fn is not None:
+            progress_fn(dict(summary))
+
+    def write_batch(batch):
+        """Runs on the write thread; returns [(wallet_address, error or None)]."""
+        if save_fn is not None:
+            results = []
+            for wallet_address, (raw_balance_data, raw_token_data) in batch:
+                try:
+                    for stored_address in plan[wallet_address]["stored_addresses"]:
+                        save_fn(stored_address, raw_balance_data, raw_token_data)
+                    results.append((wallet_address, None))
+                except Exception as e:
+                    logging.warning(f"Error saving data for {wallet_address}: {e}")
+                    results.append((wallet_address, e))
+            return results
+
+        if bulk:
+            for wallet_address, snapshots in batch:
+                for snapshot in snapshots:
+                    buffer.add_snapshot(*snapshot)
+                buffered_wallets.append(wallet_address)
+            return []
+
+        results = []
+        for wallet_address, item in batch:
+            if isinstance(item, tuple):
+                raw_balance_data, streamed = item
+                try:
+                    save_wallet_snapshot_stream(plan[wallet_address]["stored_addresses"], raw_balance_data,
+                                                streamed.tokens, catalog=catalog)
+                    results.append((wallet_address, None))
+                except Exception as e:
+                    logging.warning(f"Error saving data for {wallet_address}: {e}")
+                    results.append((wallet_address, e))
+        batch = [(wallet_address, item) for wallet_address, item in batch if not isinstance(item, tuple)]
+        if not batch:
+            return results
+
+        try:
+            write_snapshot_batch([snapshot for _, snapshots in batch for snapshot in snapshots], catalog)
+            return results + [(wallet_address, None) for wallet_address, _ in batch]
+        except Exception as e:
+            logging.warning(f"Batch write of {len(batch)} wallets failed ({e}), retrying wallet by wallet.")
+
+        # One bad payload must not fail its whole batch.
+        for wallet_address, snapshots in batch:
+            try:
+                write_snapshot_batch(snapshots, catalog)
+                results.append((wallet_address, None))
+            except Exception as e:
+                logging.warning(f"Error saving data for {wallet_address}: {e}")
+                results.append((wallet_address, e))
+        return results
+
+    # Blocking HTTP calls run on their own pool, normalization on another; writes
+    # go through a single thread so the DB sees one writer while fetches keep flowing.
+    with ThreadPoolExecutor(max_workers=concurrency * 2) as fetch_executor, \
+            ThreadPoolExecutor(max_workers=PIPELINE_NORMALIZE_WORKERS) as normalize_executor, \
+            ThreadPoolExecutor(max_workers=1) as write_executor:
+        # History triggers insert into the current month's partition; make sure it exists.
+        await loop.run_in_executor(write_executor, history.ensure_upcoming_partitions)
+        stored_balances = (await loop.run_in_executor(write_executor, fetch_stored_wallet_balances)
+                           if incremental else None)
+        # Streaming needs the default writer; custom writers and bulk loads get whole lists.
+        stream_tokens = save_fn is None and not bulk
+        # Shared by the fetch workers: each wallet is taken by exactly one of them.
+        pending_wallets = iter(plan.items())
+
+        async def fetch_worker():
+            for wallet_address, entry in pending_wallets:
+                fetch_started = time.monotonic()
+                token_chains = None
+                try:
+                    if incremental:
+                        stored_balance = next((stored_balances[a] for a in entry["stored_addresses"]
+                                               if a in stored_balances), None)
+                        raw_balance_data, raw_token_data, token_chains = await _fetch_wallet_incremental(
+                            loop, fetch_executor, wallet_address, use_cache, stored_balance)
+                    else:
+                        raw_balance_data, raw_token_data = await _fetch_wallet(
+                            loop, fetch_executor, wallet_address, use_cache, stream_tokens=stream_tokens)
+                except Exception as e:
+                    logging.warning(f"Error fetching wallet data for {wallet_address}: {e}")
+                    record(wallet_address, "failed", e)
+                    continue
+                finally:
+                    stages["fetch"].busy += time.monotonic() - fetch_started
+                stages["fetch"].items += 1
+
+                if raw_token_data is None:
+                    record(wallet_address, "unchanged")
+                elif not isinstance(raw_balance_data, dict) or not isinstance(raw_token_data, (list, StreamedTokens)):
+                    logging.warning(f"Skipping {wallet_address}: incomplete API response.")
+                    record(wallet_address, "failed", "incomplete API response")
+                else:
+                    await _put(fetched, (wallet_address, raw_balance_data, raw_token_data, token_chains),
+                               stages["fetch"])
+
+        async def normalize_worker():
+            while True:
+                item = await fetched.get()
+                if item is _DONE:
+                    return
+                wallet_address, raw_balance_data, raw_token_data, token_chains = item
+                if isinstance(raw_token_data, StreamedTokens):
+                    # Normalized by the writer, chunk by chunk, as the tokens are read.
+                    await _put(normalized, (wallet_address, (raw_balance_data, raw_token_data)), stages["normalize"])
+                    continue
+                if save_fn is not None:
+                    await _put(normalized, (wallet_address, (raw_balance_data, raw_token_data)), stages["normalize"])
+                    continue
+
+                normalize_started = time.monotonic()
+                try:
+                    snapshots = await loop.run_in_executor(
+                        normalize_executor, _normalize_wallet,
+                        plan[wallet_address]["stored_addresses"], raw_balance_data, raw_token_data, token_chains)
+                except Exception as e:
+                    logging.warning(f"Error normalizing data for {wallet_address}: {e}")
+                    record(wallet_address, "failed", e)
+                    continue
+                finally:
+                    stages["normalize"].busy += time.monotonic() - normalize_started
+                stages["normalize"].items += 1
+                await _put(normalized, (wallet_address, snapshots), stages["normalize"])
+
+        async def fetch_stage():
+            await asyncio.gather(*(fetch_worker() for _ in range(concurrency)))
+            for _ in range(PIPELINE_NORMALIZE_WORKERS):
+                await fetched.put(_DONE)
+
+        async def normalize_stage():
+            await asyncio.gather(*(normalize_worker() for _ in range(PIPELINE_NORMALIZE_WORKERS)))
+            await normalized.put(_DONE)
+
+        async def flush_bulk_load():
+            """Loads the buffer and records its wallets; a failed load fails only those wallets."""
+            nonlocal buffer, buffered_wallets
+            loading, wallets = buffer, buffered_wallets
+            buffer, buffered_wallets = BulkLoadBuffer(), []
+            try:
+                summary["bulk_loads"].append(await loop.run_in_executor(write_executor, bulk_load, loading))
+            except Exception as e:
+                logging.warning(f"Bulk load of {len(wallets)} wallets failed: {e}")
+                for wallet_address in wallets:
+                    record(wallet_address, "failed", e)
+                return
+            for wallet_address in wallets:
+                record(wallet_address, "saved")
+
+        async def write_stage():
+            finished = False
+            while not finished:
+                # Wait for one wallet, then take whatever else is already queued.
+                batch = [await normalized.get()]
+                while len(batch) < PIPELINE_WRITE_BATCH and not normalized.empty():
+                    batch.append(normalized.get_nowait())
+                if batch[-1] is _DONE:
+                    batch.pop()
+                    finished = True
+                if not batch:
+                    continue
+
+                write_started = time.monotonic()
+                results = await loop.run_in_executor(write_executor, write_batch, batch)
+                if bulk and len(buffer) >= BULK_LOAD_WALLETS:
+                    await flush_bulk_load()
+                stages["write"].busy += time.monotonic() - write_started
+                stages["write"].items += len(batch)
+                for wallet_address, error in results:
+                    record(wallet_address, "failed" if error is not None else "saved", error)
+
+        await _run_stages(fetch_stage(), normalize_stage(), write_stage())
+
+        if bulk and buffered_wallets:
+            await flush_bulk_load()
+
+        if refresh_portfolio_fn is not None:
+            for user_id in affected_users:
+                await loop.run_in_executor(write_executor, refresh_portfolio_fn, user_id)
+
+    elapsed = time.monotonic() - started
+    summary["affected_users"] = len(affected_users)
+    summary["elapsed_seconds"] = round(elapsed, 2)
+    summary["catalog_tokens"] = len(catalog)
+    summary["stages"] = {name: stats.report(elapsed) for name, stats in stages.items()}
+    summary["debank_usage"] = debank_limiter.usage_report()
+    summary["write_stats"] = write_stats.report()
+    logging.info(f"Ingestion finished: {summary}")
+    return summary
+
+
+def run_ingestion(plan, save_fn=None, concurrency=INGEST_CONCURRENCY, use_cache=True, incremental=False,
+                  refresh_portfolio_fn=None, bulk=False, progress_fn=None, outcome_fn=None):
+    """Synchronous entry point for scripts, the job runner, the refresh queue workers and the Streamlit UI."""
+    return asyncio.run(ingest_wallets(plan, save_fn, concurrency=concurrency, use_cache=use_cache,
+                                      incremental=incremental, refresh_portfolio_fn=refresh_portfolio_fn, bulk=bulk,
+                                      progress_fn=progress_fn, outcome_fn=outcome_fn))
@@ -0,0 +1,231 @@
+"""
+Background ingestion jobs.
+
+The UI only inserts a row into `ingest_jobs` (`submit_ingest_job`) and polls
+it (`get_job` / `list_jobs`); a local worker process runs the jobs one after
+another, so a browser refresh never kills a refresh halfway and any number of
+jobs can queue up.
+
+The worker (`python -m services.job_runner`, or started on demand with
+`ensure_worker`) holds a session advisory lock for its lifetime, so at most
+one worker runs per database and liveness is a single pg_locks lookup. Jobs
+are claimed with FOR UPDATE SKIP LOCKED; progress (wallets done/failed) is
+written every JOB_PROGRESS_INTERVAL seconds and turned into throughput and
+ETA figures when read. Jobs still marked running when no worker holds the
+lock were orphaned by a dead worker; reading them, or starting a worker,
+marks them failed.
+"""
+
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from decouple import config
+
+from db.app_user_operations import fetch_user_wallet_pairs, refresh_all_portfolios
+from db.connection import connection, transaction
+from services.ingestion_engine import run_ingestion
+from services.refresh_planner import build_refresh_plan
+
+logging.basicConfig(level=logging.INFO)
+
+JOB_POLL_INTERVAL = config('JOB_POLL_INTERVAL', default=2.0, cast=float)
+JOB_PROGRESS_INTERVAL = config('JOB_PROGRESS_INTERVAL', default=1.0, cast=float)
+# The worker exits after this long without jobs; ensure_worker starts a new one.
+JOB_WORKER_IDLE_EXIT = config('JOB_WORKER_IDLE_EXIT', default=300.0, cast=float)
+
+# Arbitrary key for the worker's session-level advisory lock.
+JOB_WORKER_LOCK_ID = 72_640_020
+
+JOB_COLUMNS = ["id", "status", "options", "wallets_total", "wallets_done", "wallets_failed", "summary", "error",
+               "created_at", "started_at", "updated_at", "finished_at"]
+
+CLAIM_NEXT_JOB = '''
+    UPDATE ingest_jobs
+    SET status = 'running', started_at = now(), updated_at = now()
+    WHERE id = (
+        SELECT id FROM ingest_jobs
+        WHERE status = 'queued'
+        ORDER BY id
+        FOR UPDATE SKIP LOCKED
+        LIMIT 1
+    )
+    RETURNING id, options;
+'''
+
+# Only the lock holder runs jobs, so anything still "running" without one was orphaned by a dead worker.
+FAIL_ORPHANED_JOBS = '''
+    UPDATE ingest_jobs SET status = 'failed', error = 'worker stopped', updated_at = now(), finished_at = now()
+    WHERE status = 'running';
+'''
+
+
+def submit_ingest_job(use_cache=True, incremental=False, bulk=False):
+    """Queues a refresh of every tracked wallet and returns the job id."""
+    options = {"use_cache": use_cache, "incremental": incremental, "bulk": bulk}
+    with transaction() as cursor:
+        cursor.execute("INSERT INTO ingest_jobs (options) VALUES (%s) RETURNING id;", (json.dumps(options),))
+        return cursor.fetchone()[0]
+
+
+def _with_progress(job):
+    """Adds percent, throughput (wallets/s) and ETA (seconds) to a job dict."""
+    total, processed = job["wallets_total"], job["wallets_done"] + job["wallets_failed"]
+    job["percent"] = round(100 * processed / total, 1) if total else None
+    job["throughput"] = job["eta_seconds"] = None
+    if job["started_at"] and processed:
+        elapsed = ((job["finished_at"] or job["updated_at"]) - job["started_at"]).total_seconds()
+        if elapsed > 0:
+            job["throughput"] = round(processed / elapsed, 2)
+            if job["status"] == "running" and total:
+                job["eta_seconds"] = round((total - processed) / job["throughput"])
+    return job
+
+
+def _select_jobs(query, values):
+    with transaction() as cursor:
+        cursor.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM ingest_jobs {query};", values)
+        return [dict(zip(JOB_COLUMNS, row)) for row in cursor.fetchall()]
+
+
+def _select_live_jobs(query, values):
+    """Selects jobs; if some show as running without a live worker, fails them first and reads again."""
+    jobs = _select_jobs(query, values)
+    if any(job["status"] == "running" for job in jobs) and not worker_alive() and fail_orphaned_jobs():
+        jobs = _select_jobs(query, values)
+    return [_with_progress(job) for job in jobs]
+
+
+def get_job(job_id):
+    jobs = _select_live_jobs("WHERE id = %s", (job_id,))
+    return jobs[0] if jobs else None
+
+
+def list_jobs(limit=10):
+    """Returns the most recent jobs, newest first."""
+    return _select_live_jobs("ORDER BY id DESC LIMIT %s", (limit,))
+
+
+def worker_alive():
+    with transaction() as cursor:
+        cursor.execute('''
+            SELECT EXISTS (
+                SELECT 1 FROM pg_locks
+                WHERE locktype = 'advisory' AND granted
+                  AND classid = 0 AND objid = %s AND objsubid = 1
+                  AND database = (SELECT oid FROM pg_database WHERE datname = current_database())
+            );
+        ''', (JOB_WORKER_LOCK_ID,))
+        return cursor.fetchone()[0]
+
+
+def fail_orphaned_jobs():
+    """Marks jobs left running by a dead worker as failed and returns how many; a no-op while a worker runs."""
+    with transaction() as cursor:
+        # Conflicts with the worker's session lock: succeeds only while no worker
+        # runs, and keeps one from starting until this transaction ends.
+        cursor.execute("SELECT pg_try_advisory_xact_lock(%s);", (JOB_WORKER_LOCK_ID,))
+        if not cursor.fetchone()[0]:
+            return 0
+        cursor.execute(FAIL_ORPHANED_JOBS)
+        return cursor.rowcount
+
+
+def ensure_worker():
+    """Starts a detached local worker process unless one is already running."""
+    if worker_alive():
+        return False
+    fail_orphaned_jobs()
+    app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.Popen([sys.executable, "-m", "services.job_runner"], cwd=app_dir,
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    return True
+
+
+class _ProgressWriter:
+    """progress_fn for the engine: writes the job's counters at most every JOB_PROGRESS_INTERVAL seconds."""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.last_write = 0.0
+
+    def __call__(self, summary, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_write < JOB_PROGRESS_INTERVAL:
+            return
+        self.last_write = now
+        with transaction() as cursor:
+            cursor.execute('''
+                UPDATE ingest_jobs SET wallets_done = %s, wallets_failed = %s, updated_at = now() WHERE id = %s;
+            ''', (summary["saved"] + summary["unchanged"], summary["failed"], self.job_id))
+
+
+def run_job(job_id, options):
+    """Runs one claimed job to completion and records its outcome."""
+    try:
+        plan = build_refresh_plan(fetch_user_wallet_pairs())
+        with transaction() as cursor:
+            cursor.execute("UPDATE ingest_jobs SET wallets_total = %s, updated_at = now() WHERE id = %s;",
+                           (len(plan), job_id))
+        progress = _ProgressWriter(job_id)
+        summary = run_ingestion(plan, use_cache=options.get("use_cache", True),
+                                incremental=options.get("incremental", False), bulk=options.get("bulk", False),
+                                progress_fn=progress)
+        progress(summary, force=True)
+        if summary["saved"]:
+            summary["portfolio"] = refresh_all_portfolios(incremental=True)
+        with transaction() as cursor:
+            cursor.execute('''
+                UPDATE ingest_jobs SET status = 'succeeded', summary = %s, updated_at = now(), finished_at = now()
+                WHERE id = %s;
+            ''', (json.dumps(summary, default=str), job_id))
+    except Exception as e:
+        logging.exception(f"Ingest job {job_id} failed")
+        with transaction() as cursor:
+            cursor.execute('''
+                UPDATE ingest_jobs SET status = 'failed', error = %s, updated_at = now(), finished_at = now()
+                WHERE id = %s;
+            ''', (str(e), job_id))
+
+
+def claim_next_job():
+    with transaction() as cursor:
+        cursor.execute(CLAIM_NEXT_JOB)
+        return cursor.fetchone()
+
+
+def run_worker(idle_exit=JOB_WORKER_IDLE_EXIT):
+    """Processes queued jobs until the queue has been empty for `idle_exit` seconds."""
+    with connection() as lock_conn:
+        lock_conn.autocommit = True
+        try:
+            with lock_conn.cursor() as cursor:
+                cursor.execute("SELECT pg_try_advisory_lock(%s);", (JOB_WORKER_LOCK_ID,))
+                if not cursor.fetchone()[0]:
+                    logging.info("Another ingest worker is running.")
+                    return
+
+            with transaction() as cursor:
+                cursor.execute(FAIL_ORPHANED_JOBS)
+
+            idle_since = time.monotonic()
+            while time.monotonic() - idle_since < idle_exit:
+                job = claim_next_job()
+                if job is None:
+                    time.sleep(JOB_POLL_INTERVAL)
+                    continue
+                job_id, options = job
+                logging.info(f"Running ingest job {job_id} with {options}")
+                run_job(job_id, options)
+                idle_since = time.monotonic()
+        finally:
+            with lock_conn.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock_all();")
+            lock_conn.autocommit = False
+
+
+if __name__ == "__main__":
+    run_worker()
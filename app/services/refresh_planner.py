@@ -0,0 +1,90 @@
+"""
+Refresh planning for the ingestion engine.
+
+`build_refresh_plan` turns the UserWallets associations into a deduplicated
+work set: each wallet is fetched once per run, however many users track it,
+and the result is fanned out to every owner.
+
+In incremental mode the engine only calls the cheap `total_balance` endpoint
+for every wallet and uses `changed_chains` to decide whether (and for which
+chains) the expensive token lists need to be pulled again.
+"""
+
+from decimal import Decimal
+
+from decouple import config
+
+from utils.debank_utils import to_decimal, normalize_address
+
+# A chain counts as changed when its USD value moved by more than both of these.
+CHANGE_ABS_THRESHOLD_USD = Decimal(config('CHANGE_ABS_THRESHOLD_USD', default='1'))
+CHANGE_REL_THRESHOLD = Decimal(config('CHANGE_REL_THRESHOLD', default='0.005'))
+
+# Above this many changed chains one all_token_list call is cheaper than per-chain calls.
+MAX_PER_CHAIN_FETCHES = config('MAX_PER_CHAIN_FETCHES', default=2, cast=int)
+
+
+def _value_changed(old_value, new_value, abs_threshold, rel_threshold):
+    old_value = old_value or Decimal(0)
+    new_value = new_value or Decimal(0)
+    delta = abs(new_value - old_value)
+    if delta <= abs_threshold:
+        return False
+    return delta > abs(old_value) * rel_threshold
+
+
+def changed_chains(raw_balance_data, stored_balance, abs_threshold=CHANGE_ABS_THRESHOLD_USD,
+                   rel_threshold=CHANGE_REL_THRESHOLD):
+    """
+    Compares a fresh total_balance payload with the stored wallet balances.
+
+    Args:
+    - raw_balance_data (dict): DeBank total_balance response.
+    - stored_balance (tuple): (total_usd_value, {chain_id: usd_value}) as stored, or None.
+
+    Returns the set of chain ids whose value changed (including chains that
+    appeared or disappeared), or None if the wallet has never been stored and
+    needs a full refresh.
+    """
+    if stored_balance is None or stored_balance[0] is None:
+        return None
+
+    stored_total, stored_chains = stored_balance
+    new_chains = {chain['id']: to_decimal(chain.get('usd_value')) for chain in raw_balance_data.get('chain_list', [])}
+
+    changed = {
+        chain_id for chain_id in new_chains.keys() | stored_chains.keys()
+        if _value_changed(stored_chains.get(chain_id), new_chains.get(chain_id), abs_threshold, rel_threshold)
+    }
+    if not changed and _value_changed(stored_total, to_decimal(raw_balance_data.get('total_usd_value')),
+                                      abs_threshold, rel_threshold):
+        # Total moved but no single chain crossed the threshold: refresh everything.
+        return set(new_chains)
+    return changed
+
+
+def build_refresh_plan(user_wallet_pairs):
+    """
+    Builds the deduplicated refresh work set.
+
+    Args:
+    - user_wallet_pairs (iterable): (user_id, wallet_address) rows from UserWallets.
+
+    Returns a dict of {normalized_address: {"stored_addresses": set, "user_ids": set}}
+    where stored_addresses are the spellings the address is stored under.
+    """
+    plan = {}
+    for user_id, wallet_address in user_wallet_pairs:
+        entry = plan.setdefault(normalize_address(wallet_address), {"stored_addresses": set(), "user_ids": set()})
+        entry["stored_addresses"].add(wallet_address)
+        entry["user_ids"].add(user_id)
+    return plan
+
+
+def plan_from_addresses(wallet_addresses):
+    """Builds a refresh plan for a plain list of addresses with no known owners."""
+    plan = {}
+    for wallet_address in wallet_addresses:
+        entry = plan.setdefault(normalize_address(wallet_address), {"stored_addresses": set(), "user_ids": set()})
+        entry["stored_addresses"].add(wallet_address)
+    return plan
@@ -0,0 +1,260 @@
+"""
+Sharded wallet refresh through a Postgres work queue.
+
+`enqueue_refresh` turns a refresh plan (services.refresh_planner) into rows of
+`wallet_refresh_tasks`, one per wallet. Any number of worker processes, on any
+number of machines, then run `run_queue_worker` against the same database:
+
+- a worker claims up to REFRESH_BATCH_SIZE due tasks with FOR UPDATE SKIP
+  LOCKED, so concurrent workers never claim the same wallet and never wait on
+  each other;
+- a claim is a lease of REFRESH_LEASE_SECONDS, extended by a heartbeat thread
+  while the batch is being fetched; tasks whose lease ran out (a crashed or
+  stuck worker) become claimable again;
+- each claim counts as an attempt; failed wallets are retried with exponential
+  backoff until REFRESH_MAX_ATTEMPTS, then parked as 'failed'.
+
+Each batch goes through the regular ingestion engine and rebuilds the
+portfolios of the affected users; the dashboard aggregates are refreshed when
+a worker finds the queue drained. The heartbeat keeps running until the
+batch's outcomes are recorded, so a slow portfolio rebuild never lets the
+leases lapse.
+
+Every worker has its own DeBank rate limiter. Set REFRESH_WORKERS to the
+number of workers running against the same API key (on all machines): each
+one then spends DEBANK_UNITS_PER_SECOND / REFRESH_WORKERS.
+
+    python -m services.refresh_queue --enqueue   # queue every tracked wallet, then work
+    python -m services.refresh_queue             # start another worker
+"""
+
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+from decouple import config
+from psycopg2.extras import execute_values
+
+from db.app_user_operations import fetch_user_wallet_pairs
+from db.connection import transaction
+from db.portfolio_materializer import materialize_portfolio, refresh_chain_aggregates
+from services.ingestion_engine import run_ingestion
+from services.refresh_planner import build_refresh_plan
+
+logging.basicConfig(level=logging.INFO)
+
+REFRESH_BATCH_SIZE = config('REFRESH_BATCH_SIZE', default=50, cast=int)
+REFRESH_LEASE_SECONDS = config('REFRESH_LEASE_SECONDS', default=120.0, cast=float)
+REFRESH_MAX_ATTEMPTS = config('REFRESH_MAX_ATTEMPTS', default=5, cast=int)
+REFRESH_RETRY_BACKOFF = config('REFRESH_RETRY_BACKOFF', default=30.0, cast=float)
+REFRESH_POLL_INTERVAL = config('REFRESH_POLL_INTERVAL', default=2.0, cast=float)
+# Workers exit after this long without claimable tasks (0 = exit as soon as the queue is drained).
+REFRESH_WORKER_IDLE_EXIT = config('REFRESH_WORKER_IDLE_EXIT', default=0.0, cast=float)
+
+# Re-queues finished tasks; tasks that are still queued or leased only pick up the new owners.
+ENQUEUE_TASKS = '''
+    INSERT INTO wallet_refresh_tasks (wallet_address, stored_addresses, user_ids)
+    VALUES %s
+    ON CONFLICT (wallet_address) DO UPDATE SET
+        stored_addresses = EXCLUDED.stored_addresses,
+        user_ids = EXCLUDED.user_ids,
+        status = CASE WHEN wallet_refresh_tasks.status IN ('done', 'failed') THEN 'queued'
+                      ELSE wallet_refresh_tasks.status END,
+        attempts = CASE WHEN wallet_refresh_tasks.status IN ('done', 'failed') THEN 0
+                        ELSE wallet_refresh_tasks.attempts END,
+        available_at = CASE WHEN wallet_refresh_tasks.status IN ('done', 'failed') THEN now()
+                            ELSE wallet_refresh_tasks.available_at END,
+        enqueued_at = now(),
+        updated_at = now()
+'''
+
+# Leases that ran out on their last attempt are parked instead of being claimed again.
+PARK_EXHAUSTED_LEASES = '''
+    UPDATE wallet_refresh_tasks
+    SET status = 'failed', lease_owner = NULL, lease_expires_at = NULL,
+        last_error = coalesce(last_error, 'lease expired'), updated_at = now(), finished_at = now()
+    WHERE status = 'leased' AND lease_expires_at < now() AND attempts >= %(max_attempts)s;
+'''
+
+CLAIM_TASKS = '''
+    UPDATE wallet_refresh_tasks
+    SET status = 'leased', lease_owner = %(worker)s,
+        lease_expires_at = now() + make_interval(secs => %(lease)s),
+        attempts = attempts + 1, updated_at = now()
+    WHERE wallet_address IN (
+        SELECT wallet_address FROM wallet_refresh_tasks
+        WHERE (status = 'queued' AND available_at <= now())
+           OR (status = 'leased' AND lease_expires_at < now())
+        ORDER BY available_at
+        FOR UPDATE SKIP LOCKED
+        LIMIT %(batch)s
+    )
+    RETURNING wallet_address, stored_addresses, user_ids, attempts;
+'''
+
+EXTEND_LEASES = '''
+    UPDATE wallet_refresh_tasks
+    SET lease_expires_at = now() + make_interval(secs => %(lease)s), updated_at = now()
+    WHERE status = 'leased' AND lease_owner = %(worker)s AND wallet_address = ANY(%(wallets)s);
+'''
+
+# Only the current lease holder may finish a task; a worker that lost its lease is ignored.
+COMPLETE_TASKS = '''
+    UPDATE wallet_refresh_tasks
+    SET status = 'done', lease_owner = NULL, lease_expires_at = NULL, last_error = NULL,
+        updated_at = now(), finished_at = now()
+    WHERE status = 'leased' AND lease_owner = %(worker)s AND wallet_address = ANY(%(wallets)s);
+'''
+
+FAIL_TASK = '''
+    UPDATE wallet_refresh_tasks
+    SET status = CASE WHEN attempts >= %(max_attempts)s THEN 'failed' ELSE 'queued' END,
+        available_at = now() + make_interval(secs => %(backoff)s * power(2, attempts - 1)),
+        finished_at = CASE WHEN attempts >= %(max_attempts)s THEN now() END,
+        lease_owner = NULL, lease_expires_at = NULL, last_error = %(error)s, updated_at = now()
+    WHERE status = 'leased' AND lease_owner = %(worker)s AND wallet_address = %(wallet)s;
+'''
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def enqueue_refresh(plan):
+    """Queues one task per wallet of a refresh plan and returns the number of wallets."""
+    rows = [(wallet_address, sorted(entry["stored_addresses"]), sorted(entry["user_ids"]))
+            for wallet_address, entry in plan.items()]
+    if rows:
+        with transaction() as cursor:
+            execute_values(cursor, ENQUEUE_TASKS, rows)
+    return len(rows)
+
+
+def enqueue_all_wallets():
+    return enqueue_refresh(build_refresh_plan(fetch_user_wallet_pairs()))
+
+
+def queue_status():
+    """Returns {status: task count}."""
+    with transaction() as cursor:
+        cursor.execute("SELECT status, count(*) FROM wallet_refresh_tasks GROUP BY status;")
+        return dict(cursor.fetchall())
+
+
+def claim_tasks(worker, batch_size=REFRESH_BATCH_SIZE, lease_seconds=REFRESH_LEASE_SECONDS):
+    """Leases up to `batch_size` due tasks and returns them as a refresh plan."""
+    with transaction() as cursor:
+        cursor.execute(PARK_EXHAUSTED_LEASES, {"max_attempts": REFRESH_MAX_ATTEMPTS})
+        cursor.execute(CLAIM_TASKS, {"worker": worker, "lease": lease_seconds, "batch": batch_size})
+        rows = cursor.fetchall()
+    return {wallet_address: {"stored_addresses": set(stored_addresses), "user_ids": set(user_ids)}
+            for wallet_address, stored_addresses, user_ids, _ in rows}
+
+
+def extend_leases(worker, wallets, lease_seconds=REFRESH_LEASE_SECONDS):
+    with transaction() as cursor:
+        cursor.execute(EXTEND_LEASES, {"worker": worker, "wallets": list(wallets), "lease": lease_seconds})
+
+
+def finish_tasks(worker, outcomes):
+    """Records a batch's outcomes: {wallet_address: (outcome, error)} from the ingestion engine."""
+    done = [wallet for wallet, (outcome, _) in outcomes.items() if outcome != "failed"]
+    with transaction() as cursor:
+        if done:
+            cursor.execute(COMPLETE_TASKS, {"worker": worker, "wallets": done})
+        for wallet, (outcome, error) in outcomes.items():
+            if outcome == "failed":
+                cursor.execute(FAIL_TASK, {"worker": worker, "wallet": wallet, "error": error,
+                                           "max_attempts": REFRESH_MAX_ATTEMPTS, "backoff": REFRESH_RETRY_BACKOFF})
+
+
+class _Heartbeat(threading.Thread):
+    """Extends the batch's leases every third of the lease period until stopped."""
+
+    def __init__(self, worker, wallets):
+        super().__init__(daemon=True)
+        self.worker = worker
+        self.wallets = list(wallets)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(REFRESH_LEASE_SECONDS / 3):
+            try:
+                extend_leases(self.worker, self.wallets)
+            except Exception as e:
+                logging.warning(f"Lease heartbeat failed: {e}")
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def process_batch(worker, plan, use_cache=True, incremental=False, bulk=False):
+    """Ingests one claimed batch, records per-wallet outcomes and rebuilds the affected portfolios."""
+    outcomes = {}
+    heartbeat = _Heartbeat(worker, plan)
+    heartbeat.start()
+    try:
+        try:
+            summary = run_ingestion(plan, use_cache=use_cache, incremental=incremental, bulk=bulk,
+                                    outcome_fn=lambda wallet, outcome, error: outcomes.__setitem__(wallet, (outcome, error)))
+        except Exception as e:
+            # Nothing is known to be stored: retry the whole batch.
+            logging.exception(f"Batch of {len(plan)} wallets failed")
+            outcomes = {wallet: ("failed", str(e)) for wallet in plan}
+            summary = None
+
+        # Wallets the engine never reported on count as failed too.
+        for wallet in plan:
+            outcomes.setdefault(wallet, ("failed", "no result"))
+
+        affected_users = {user_id for wallet, (outcome, _) in outcomes.items() if outcome == "saved"
+                          for user_id in plan[wallet]["user_ids"]}
+        if affected_users:
+            materialize_portfolio(user_ids=affected_users)
+        # The leases must outlive the rebuild, or another worker could claim the batch meanwhile.
+        finish_tasks(worker, outcomes)
+    finally:
+        heartbeat.stop()
+    return summary
+
+
+def run_queue_worker(worker=None, batch_size=REFRESH_BATCH_SIZE, idle_exit=REFRESH_WORKER_IDLE_EXIT,
+                     use_cache=True, incremental=False, bulk=False):
+    """
+    Claims and processes batches until no task has been claimable for `idle_exit` seconds.
+
+    Returns the number of wallets this worker processed.
+    """
+    worker = worker or worker_name()
+    processed = 0
+    aggregates_stale = False
+    idle_since = time.monotonic()
+    while True:
+        plan = claim_tasks(worker, batch_size)
+        if plan:
+            logging.info(f"{worker} claimed {len(plan)} wallets")
+            process_batch(worker, plan, use_cache=use_cache, incremental=incremental, bulk=bulk)
+            processed += len(plan)
+            aggregates_stale = True
+            idle_since = time.monotonic()
+            continue
+
+        if aggregates_stale:
+            refresh_chain_aggregates()
+            aggregates_stale = False
+        if time.monotonic() - idle_since >= idle_exit:
+            break
+        time.sleep(REFRESH_POLL_INTERVAL)
+
+    logging.info(f"{worker} processed {processed} wallets; queue: {queue_status()}")
+    return processed
+
+
+if __name__ == "__main__":
+    if "--enqueue" in sys.argv:
+        print(f"Queued {enqueue_all_wallets()} wallets.")
+    run_queue_worker(incremental="--incremental" in sys.argv, bulk="--bulk" in sys.argv)
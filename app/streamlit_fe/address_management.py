@@ -1,8 +1,8 @@
 import streamlit as st
-from db.app_user_operations import (add_address_to_user, 
-                                   fetch_user_ids, 
-                                   fetch_addresses_for_user, 
-                                   remove_address_from_user)
+from data_cache import (save_address,
+                        cached_user_ids,
+                        cached_addresses_for_user,
+                        delete_address)
 
 
 def is_valid_ethereum_address(address):
@@ -16,7 +16,7 @@ def manage_addresses():
     """
     st.markdown("# Ethereum Address Manager")
     
-    all_user_ids = fetch_user_ids()
+    all_user_ids = cached_user_ids()
     all_user_ids.append("Create New")
 
     selected_user_id = st.selectbox("Select User ID", all_user_ids, key="user_id_selectbox_4")
@@ -30,7 +30,7 @@ def manage_addresses():
     st.markdown("## Existing Addresses")
 
     # Display existing addresses with delete button
-    saved_addresses = fetch_addresses_for_user(selected_user_id)
+    saved_addresses = cached_addresses_for_user(selected_user_id)
     deleted_addresses = []
     for address in saved_addresses:
         col1, col2 = st.columns(2)
@@ -44,7 +44,7 @@ def manage_addresses():
         try:
             
             saved_addresses.remove(addr)
-            remove_address_from_user(selected_user_id, addr)
+            delete_address(selected_user_id, addr)
             print(saved_addresses)
             st.write(f"Address {addr} removed for {selected_user_id}!")
             st.experimental_rerun()
@@ -58,7 +58,7 @@ def manage_addresses():
     if st.button("Save Address", key="save_address") and new_address:
         if is_valid_ethereum_address(new_address):
             try:
-                add_address_to_user(selected_user_id, [new_address])
+                save_address(selected_user_id, new_address)
                 st.write(f"Address {new_address} saved for {selected_user_id}!")
                 st.experimental_rerun()
             except Exception as e:
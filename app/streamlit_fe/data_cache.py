@@ -0,0 +1,165 @@
+"""
+Cached read layer for the Streamlit app.
+
+Streamlit reruns the whole script on every interaction, so the read functions
+below are memoized with st.cache_data (TTL and entry caps). Cache keys carry:
+- a generation counter per (scope, user) that the write helpers in this module
+  bump, so a write invalidates exactly the entries it affects;
+- for portfolio data, a cheap data-version stamp of the user's UserPortfolio
+  rows (max updated_at, row count), so writes made by other processes (CLI
+  ingests, workers) are picked up too. The stamp itself is cached for
+  STAMP_TTL_SECONDS.
+
+The UI should read and write through this module instead of calling
+db.app_user_operations directly.
+"""
+
+import threading
+
+import streamlit as st
+from decouple import config
+
+from db.app_user_operations import (
+    add_address_to_user,
+    fetch_addresses_for_user,
+    fetch_aggregated_data_for_user,
+    fetch_spam_tokens_for_users,
+    fetch_user_ids,
+    fetch_users_with_addresses,
+    fill_user_portfolio,
+    get_tokens_for_user,
+    portfolio_version,
+    refresh_all_portfolios,
+    remove_address_from_user,
+    update_spam_tokens_in_db,
+)
+
+CACHE_TTL_SECONDS = config('STREAMLIT_CACHE_TTL', default=300, cast=int)
+CACHE_MAX_ENTRIES = config('STREAMLIT_CACHE_MAX_ENTRIES', default=256, cast=int)
+STAMP_TTL_SECONDS = config('STREAMLIT_STAMP_TTL', default=5, cast=int)
+
+# Process-wide, like st.cache_data itself, so invalidation reaches every session.
+_generations = {}
+_generations_lock = threading.Lock()
+
+
+def _generation(scope, user_id=None):
+    with _generations_lock:
+        return _generations.get((scope, user_id), 0)
+
+
+def invalidate(scope, user_id=None):
+    """Drops the cached entries of one scope ("users", "addresses", "portfolio", "spam") for one user."""
+    with _generations_lock:
+        _generations[(scope, user_id)] = _generations.get((scope, user_id), 0) + 1
+
+
+def invalidate_all_portfolios():
+    """After ingests and full rebuilds every user's portfolio may have changed."""
+    invalidate("portfolio")
+
+
+@st.cache_data(ttl=STAMP_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def _portfolio_stamp(user_id, generation, global_generation):
+    return portfolio_version(user_id)
+
+
+def _portfolio_key(user_id):
+    """Cache key part that changes whenever the user's portfolio may have changed."""
+    generation = _generation("portfolio", user_id)
+    global_generation = _generation("portfolio")
+    return generation, global_generation, _portfolio_stamp(user_id, generation, global_generation)
+
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def _user_ids(generation):
+    return fetch_user_ids()
+
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def _addresses_for_user(user_id, generation):
+    return fetch_addresses_for_user(user_id)
+
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def _tokens_for_user(user_id, version):
+    return get_tokens_for_user(user_id)
+
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def _aggregated_data_for_user(user_id, version):
+    return fetch_aggregated_data_for_user(user_id)
+
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def _users_with_addresses(users_generation, addresses_generation):
+    return fetch_users_with_addresses()
+
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def _spam_tokens(user_id, generation):
+    return fetch_spam_tokens_for_users([user_id])[user_id]
+
+
+def cached_user_ids():
+    return list(_user_ids(_generation("users")))
+
+
+def cached_addresses_for_user(user_id):
+    return list(_addresses_for_user(user_id, _generation("addresses", user_id)))
+
+
+def cached_users_with_addresses():
+    """All users with their wallet lists (one grouped query per invalidation)."""
+    return dict(_users_with_addresses(_generation("users"), _generation("addresses")))
+
+
+def cached_tokens_for_user(user_id):
+    return _tokens_for_user(user_id, _portfolio_key(user_id))
+
+
+def cached_aggregated_data_for_user(user_id):
+    return _aggregated_data_for_user(user_id, _portfolio_key(user_id))
+
+
+def cached_spam_tokens(user_id):
+    return set(_spam_tokens(user_id, _generation("spam", user_id)))
+
+
+# Writes: run the operation, then invalidate exactly what it touched.
+
+# Linking or unlinking an address changes the user's portfolio and the
+# dashboard aggregates, so both are rebuilt for that user right away.
+
+def save_address(user_id, address):
+    add_address_to_user(user_id, address)
+    fill_user_portfolio(user_id)
+    invalidate("users")
+    invalidate("addresses", user_id)
+    invalidate("addresses")
+    invalidate("portfolio", user_id)
+
+
+def delete_address(user_id, address):
+    remove_address_from_user(user_id, address)
+    fill_user_portfolio(user_id)
+    invalidate("addresses", user_id)
+    invalidate("addresses")
+    invalidate("portfolio", user_id)
+
+
+def save_spam_tokens(user_id, spam_tokens):
+    update_spam_tokens_in_db(user_id, spam_tokens)
+    invalidate("spam", user_id)
+
+
+def rebuild_user_portfolio(user_id):
+    stats = fill_user_portfolio(user_id)
+    invalidate("portfolio", user_id)
+    return stats
+
+
+def rebuild_all_portfolios(incremental=True):
+    stats = refresh_all_portfolios(incremental=incremental)
+    invalidate_all_portfolios()
+    return stats
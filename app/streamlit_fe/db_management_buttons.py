@@ -1,25 +1,27 @@
 import streamlit as st
 import pandas as pd
 from db.app_user_operations import (
-    fetch_user_ids,
-    fetch_addresses_for_user,
-    get_all_wallet_addresses,
-    save_raw_data_to_db,
-    get_data_from_table,
-    fetch_aggregated_data_for_user,
-    fill_user_portfolio,
     get_tokens_for_user_without_spam,
-    get_tokens_for_user,
 )
 from db.debank_db_setup import (
     initialize_db,
     drop_tables,
-    initialize_history_tables,
-    create_updated_at_trigger,
-    create_backup_triggers,
     initialize_specific_tables,
     drop_specific_tables )
-from services.debank_data_fetcher import fetch_total_balance, fetch_all_token_list
+from db.migrations import MigrationError
+from db.history import run_history_retention
+from db.table_browser import fetch_page, table_columns
+from data_cache import (
+    cached_user_ids,
+    cached_users_with_addresses,
+    cached_aggregated_data_for_user,
+    cached_tokens_for_user,
+    cached_spam_tokens,
+    rebuild_user_portfolio,
+    rebuild_all_portfolios,
+    invalidate_all_portfolios,
+)
+from services.job_runner import submit_ingest_job, ensure_worker, list_jobs
 from datetime import datetime
 
 # General Utilities
@@ -35,8 +37,7 @@ def display_status_message(message, status="info"):
 
 # Database Management Operations
 def get_database_status():
-    user_ids = fetch_user_ids()
-    return {user_id: fetch_addresses_for_user(user_id) for user_id in user_ids}
+    return cached_users_with_addresses()
 
 def display_database_status(user_data):
     st.write("## Database Status")
@@ -45,29 +46,81 @@ def display_database_status(user_data):
         df = pd.DataFrame(addresses, columns=["Addresses"])
         st.write(df)
 
-def fetch_and_load_data():
-    wallet_addresses = get_all_wallet_addresses()
-    
-    for wallet_address in wallet_addresses:
-        raw_balance_data = fetch_total_balance(wallet_address)
-        raw_token_data = fetch_all_token_list(wallet_address)
-        save_raw_data_to_db(wallet_address, raw_balance_data, raw_token_data)
-    display_status_message("Data fetched and loaded into the database!", "success")
+def fetch_and_load_data(use_cache=True, incremental=False, bulk=False):
+    """Queues an ingest job and makes sure a worker is running; progress shows in the jobs panel."""
+    job_id = submit_ingest_job(use_cache=use_cache, incremental=incremental, bulk=bulk)
+    started = ensure_worker()
+    display_status_message(f"Queued ingest job {job_id}" + (" and started a worker." if started else "."), "success")
+
+def format_eta(seconds):
+    if seconds is None:
+        return "-"
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}m {seconds:02d}s" if minutes else f"{seconds}s"
+
+def display_ingest_jobs():
+    st.write("## Ingest Jobs")
+    st.button("Refresh job status", key="refresh_jobs")
+    jobs = list_jobs()
+    if not jobs:
+        st.write("No ingest jobs yet.")
+        return
+
+    # Portfolios change when a job finishes; drop cached portfolio reads once per finished job.
+    seen = st.session_state.setdefault("finished_jobs_seen", set())
+    for job in jobs:
+        if job["status"] == "succeeded" and job["id"] not in seen:
+            seen.add(job["id"])
+            invalidate_all_portfolios()
+
+    for job in jobs:
+        st.write(f"**Job {job['id']}** ({job['created_at']:%Y-%m-%d %H:%M:%S}): {job['status']}")
+        if job["percent"] is not None:
+            st.progress(min(job["percent"], 100.0) / 100)
+        st.write(f"Wallets: {job['wallets_done']}/{job['wallets_total'] or '?'} done, {job['wallets_failed']} failed"
+                 f" | Throughput: {job['throughput'] or '-'} wallets/s | ETA: {format_eta(job['eta_seconds'])}")
+        if job["error"]:
+            display_status_message(job["error"], "error")
+        elif job["summary"]:
+            rows = job["summary"]["write_stats"]
+            st.write(f"Rows changed: {rows['changed']}, unchanged (skipped): {rows['unchanged']}")
 
 def initialize_database():
-    initialize_db()
-    initialize_history_tables()
-    create_updated_at_trigger()
-    create_backup_triggers()
-    display_status_message("Database tables initialized!", "success")
+    try:
+        applied = initialize_db()
+    except MigrationError as e:
+        display_status_message(f"Database migration failed: {e}", "error")
+        return
+    if applied:
+        display_status_message(f"Applied migrations: {', '.join(map(str, applied))}", "success")
+    else:
+        display_status_message("Database schema is up to date.", "success")
 
 def display_all_tables_data():
-    tables = ["users", "Wallets", "Chains", "Tokens", "UserWallets", "WalletChainBalances", "WalletTokenBalances", "UserSpamFilters", "UserPortfolio"]
-    for table in tables:
-        data = get_data_from_table(table)
-        df = pd.DataFrame(data)
-        st.write(f"Data from {table}:")
-        st.write(df)
+    """Keyset-paginated table browser: only the current page is ever loaded."""
+    tables = ["users", "Wallets", "Chains", "TokenCatalog", "Tokens", "UserWallets", "WalletChainBalances", "WalletTokenBalances", "UserSpamFilters", "UserPortfolio"]
+    table = st.selectbox("Table:", tables, key="browse_table")
+    page_size = st.select_slider("Rows per page:", options=[25, 50, 100, 250, 500], value=100, key="browse_page_size")
+    columns = st.multiselect("Columns (all if empty):", table_columns(table), key=f"browse_columns_{table}")
+
+    # Stack of page start keys, so "Previous" can go back without OFFSET.
+    page_keys = st.session_state.setdefault(f"browse_keys_{table}", [None])
+    try:
+        shown_columns, rows, next_key = fetch_page(table, page_size=page_size, after=page_keys[-1], columns=columns)
+    except ValueError as e:
+        display_status_message(str(e), "error")
+        return
+
+    st.write(f"Data from {table} (page {len(page_keys)}):")
+    st.write(pd.DataFrame(rows, columns=shown_columns))
+
+    previous_col, next_col = st.columns(2)
+    if previous_col.button("Previous", key="browse_previous", disabled=len(page_keys) == 1):
+        page_keys.pop()
+        st.experimental_rerun()
+    if next_col.button("Next", key="browse_next", disabled=next_key is None):
+        page_keys.append(next_key)
+        st.experimental_rerun()
 
 def display_user_data_from_db(user_id):
     if user_id:
@@ -84,16 +137,15 @@ def handle_db_management():
     st.title("Database Management")
     
     # List of all the tables available for operations
-    all_tables = ["users", "Wallets", "UserWallets", "Chains", "Tokens", 
+    all_tables = ["users", "Wallets", "UserWallets", "Chains", "TokenCatalog", "Tokens", 
                   "WalletChainBalances", "WalletTokenBalances", "UserSpamFilters", 
                   "UserPortfolio"]
 
-    all_user_ids = fetch_user_ids()
+    all_user_ids = cached_user_ids()
 
     # Database Initialization and Debugging operations
     if st.sidebar.button('Initialize Database', key="init_db"):
         initialize_database()
-        display_status_message("Database initialized!", "success")
 
     # Section for initializing specific tables
     tables_to_init = st.sidebar.multiselect('Select tables to initialize:', all_tables, key="init_select_tables")
@@ -120,12 +172,23 @@ def handle_db_management():
         user_data = get_database_status()
         display_database_status(user_data)
 
+    bypass_cache = st.sidebar.checkbox('Bypass response cache', value=False, key="bypass_cache")
+    incremental = st.sidebar.checkbox('Only refresh changed wallets', value=True, key="incremental_refresh")
+    bulk = st.sidebar.checkbox('Bulk load (COPY)', value=False, key="bulk_load")
     if st.sidebar.button('Fetch and Load Data', key="fetch_and_load"):
-        fetch_and_load_data()
+        fetch_and_load_data(use_cache=not bypass_cache, incremental=incremental, bulk=bulk)
 
-    if st.sidebar.button('Display All Tables', key="display_all_tables"):
+    if st.sidebar.checkbox('Show Ingest Jobs', value=True, key="show_ingest_jobs"):
+        display_ingest_jobs()
+
+    if st.sidebar.checkbox('Browse Tables', key="display_all_tables"):
         display_all_tables_data()
 
+    if st.sidebar.button('Run History Retention', key="history_retention"):
+        report = run_history_retention()
+        rolled_up = sum(len(partitions) for partitions in report.values())
+        display_status_message(f"Rolled up and dropped {rolled_up} history partitions.", "success")
+
 # Note: You'll need to implement the function `drop_specific_tables` in your db management code. 
 # This function would drop only the tables that are passed as arguments.
 
@@ -144,7 +207,7 @@ def mark_tokens_as_spam(tokens_for_address, address):
 
 def display_chain_aggregated_data(user_id):
     # Fetch aggregated chain data for user
-    aggregated_data = fetch_aggregated_data_for_user(user_id)
+    aggregated_data = cached_aggregated_data_for_user(user_id)
     
     # Let the user set a threshold value for filtering
     threshold = st.slider("Set a USD threshold for displaying chains:", 0, 500, 10)
@@ -165,11 +228,11 @@ def display_chain_aggregated_data(user_id):
     st.write("**Aggregate Portfolio by Chain Compared with Reported Values**")
     st.table(aggregated_data)
 
-def display_tokens_for_chain(user_id, user_data, chain, token_threshold):
+def display_tokens_for_chain(user_id, user_data, chain, token_threshold, spam_tokens):
     tokens_for_chain_raw = user_data[user_data['chain'] == chain]
     
     # Filter spam tokens and those with a value below the threshold
-    tokens_for_chain = get_tokens_for_user_without_spam(user_id, tokens_for_chain_raw)
+    tokens_for_chain = get_tokens_for_user_without_spam(user_id, tokens_for_chain_raw, spam_tokens)
     tokens_for_chain = tokens_for_chain[tokens_for_chain['total_usd_value'] > token_threshold]
     
     st.write(f"**Tokens for Chain {chain}:**")
@@ -178,7 +241,7 @@ def display_tokens_for_chain(user_id, user_data, chain, token_threshold):
 
 
 
-def display_chain_and_token_data_for_address(user_id, user_data, address, usc_threshold, token_threshold):
+def display_chain_and_token_data_for_address(user_id, user_data, address, usc_threshold, token_threshold, spam_tokens):
     # Display the chosen address and its total USD value
     st.subheader(f"Data for Address: {address}")
     total_usd_value_for_address = user_data[user_data['wallet_address'] == address]['total_usd_value'].sum()
@@ -195,7 +258,7 @@ def display_chain_and_token_data_for_address(user_id, user_data, address, usc_th
     
     # Display tokens associated with the selected chain
     tokens_for_chain_raw = user_data[(user_data['wallet_address'] == address) & (user_data['chain'] == selected_chain)]
-    tokens_for_chain = get_tokens_for_user_without_spam(user_id, tokens_for_chain_raw)
+    tokens_for_chain = get_tokens_for_user_without_spam(user_id, tokens_for_chain_raw, spam_tokens)
     tokens_for_chain = tokens_for_chain[tokens_for_chain['total_usd_value'] > token_threshold]  # Apply the token threshold here
     
     st.write(f"**Tokens for Chain {selected_chain}**")
@@ -206,7 +269,7 @@ def handle_portfolio_management():
     st.title("Portfolio Management")
     
     # Fetching user details
-    all_user_ids = fetch_user_ids()
+    all_user_ids = cached_user_ids()
     if not all_user_ids:
         st.warning("No User IDs found in the database.")
         return
@@ -217,11 +280,17 @@ def handle_portfolio_management():
     
     # Now place the button execution
     if st.sidebar.button('Fill User Portfolio'):
-        fill_user_portfolio(selected_user_id)
+        rebuild_user_portfolio(selected_user_id)
         st.success('User portfolio filled successfully!')
 
-    # Fetch user token data
-    user_data = get_tokens_for_user(selected_user_id).drop_duplicates()
+    if st.sidebar.button('Rebuild All Portfolios'):
+        stats = rebuild_all_portfolios(incremental=False)
+        if stats:
+            st.success(f"Portfolios rebuilt: {stats['total']} positions, {stats['deleted']} stale positions removed.")
+
+    # Fetch user token data and the spam set once per render
+    user_data = cached_tokens_for_user(selected_user_id).drop_duplicates()
+    spam_tokens = cached_spam_tokens(selected_user_id)
 
     # Display amalgamated data
     with st.container():
@@ -237,7 +306,7 @@ def handle_portfolio_management():
 
     # Now pass the usc_threshold value to the function call along with a placeholder for token_threshold
     # We'll get the actual token_threshold value from within the function
-    display_chain_and_token_data_for_address(selected_user_id, user_data, selected_address, usc_threshold, None)
+    display_chain_and_token_data_for_address(selected_user_id, user_data, selected_address, usc_threshold, None, spam_tokens)
 
 
 
@@ -1,9 +1,7 @@
 import streamlit as st
-from db.app_user_operations import (update_spam_tokens_in_db,
-                                    get_previously_marked_spam_tokens,
-                                    get_all_unique_tokens_for_user,
-                                      get_non_spam_tokens_for_user,
-                                        get_tokens_for_user)
+from data_cache import (save_spam_tokens,
+                        cached_spam_tokens,
+                        cached_tokens_for_user)
 
 def get_block_explorer_url(chain, token_id):
     # Dictionary mapping chains to block explorer URLs
@@ -74,10 +72,10 @@ def handle_spam_token_management(selected_user_id):
     st.title("Manage Spam Tokens")
 
     # Fetch tokens data for the user
-    tokens_data = get_tokens_for_user(selected_user_id)
+    tokens_data = cached_tokens_for_user(selected_user_id)
 
     # Get previously marked spam tokens
-    previously_marked_spam_tokens = get_previously_marked_spam_tokens(selected_user_id)
+    previously_marked_spam_tokens = cached_spam_tokens(selected_user_id)
 
     # Identify tokens that should be considered as spam by default
     default_spam_criteria = (~tokens_data['is_verified']) & (~tokens_data['is_core']) & (~tokens_data['is_wallet'])
@@ -100,7 +98,7 @@ def handle_spam_token_management(selected_user_id):
         
     if st.button("Save Spam Token Choices"):
         new_spam_tokens = {token_name for token_name, is_spam in st.session_state.spam_selection.items() if is_spam}
-        update_spam_tokens_in_db(selected_user_id, new_spam_tokens)
+        save_spam_tokens(selected_user_id, new_spam_tokens)
         st.success("Spam token choices updated successfully!")
 
     if not hasattr(st.session_state, 'spam_selection'):
@@ -21,7 +21,7 @@ if str(portfolio_meta_dir_path) not in sys.path:
 from address_management import manage_addresses
 from db_management_buttons import handle_db_management, handle_portfolio_management
 from spam_token_management import handle_spam_token_management
-from db.app_user_operations import fetch_user_ids
+from data_cache import cached_user_ids
 
 # Load .env variables and ensure crucial variables are present
 load_dotenv()
@@ -41,7 +41,7 @@ def select_user_id():
     Streamlit UI component for selecting a User ID.
     Returns the selected user ID or None if no User IDs are available.
     """
-    all_user_ids = fetch_user_ids()
+    all_user_ids = cached_user_ids()
     if not all_user_ids:
         display_status_message("No User IDs found in the database.", "warning")
         return None
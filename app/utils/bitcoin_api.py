@@ -1,11 +1,15 @@
-import requests
+from utils.http_client import http_get
+from utils.response_cache import cached_fetch
 
-def get_bitcoin_address_info(address):
+def fetch_bitcoin_address_info(address):
     url = f"https://chain.api.btc.com/v3/address/{address}"
-    response = requests.get(url)
+    response = http_get(url)
     
     if response.status_code == 200:
         return response.json()
     else:
         print(f"Failed to retrieve data: {response.status_code}")
         return None
+
+def get_bitcoin_address_info(address, use_cache=True):
+    return cached_fetch("btc:address", address.strip(), lambda: fetch_bitcoin_address_info(address), use_cache=use_cache)
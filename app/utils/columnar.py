@@ -0,0 +1,116 @@
+"""
+Columnar (NumPy) normalization of DeBank token payloads.
+
+`token_columns` pulls the numeric and timestamp fields of a batch of token
+dicts out as columns and coerces each column with NumPy array operations,
+instead of calling Decimal(str(value)) and
+datetime.utcfromtimestamp(...).strftime(...) per field per row. `token_rows`
+assembles the token rows the writers (execute_values upserts, COPY) take in
+one pass around those columns.
+
+The output matches the row-wise conversion (utils.debank_utils
+.normalize_token_rows_rowwise) value for value:
+- numeric fields are Python floats, whose repr has the same digits as
+  Decimal(str(value)); integers stay ints and numeric strings become Decimals,
+  so nothing loses precision; falsy values (None, 0, ""), booleans and
+  NaN/Infinity become None as with to_decimal;
+- time_at becomes a naive UTC datetime at whole seconds (stored, and written
+  to COPY CSV, exactly like the 'YYYY-MM-DD HH:MM:SS' string to_timestamp
+  returns), or None when it is not a number or out of range;
+- text and flag fields (is_verified, is_core, is_wallet) are passed through.
+"""
+
+from decimal import Decimal, InvalidOperation
+
+import numpy as np
+
+# Seconds since the epoch of 0001-01-01 and 10000-01-01 (datetime's range).
+_MIN_TIMESTAMP = -62_135_596_800
+_MAX_TIMESTAMP = 253_402_300_800
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError, OverflowError):
+        return np.nan
+
+
+def _with_nulls(values, valid):
+    """Object array of Python scalars with None where `valid` is False, as a list."""
+    out = values.astype(object)
+    out[~valid] = None
+    return out.tolist()
+
+
+def decimal_column(values):
+    """Vectorized to_decimal: floats (ints stay exact ints), with None for falsy or non-numeric values."""
+    types = set(map(type, values))
+    if str in types:
+        # Numeric strings may carry more digits than a float: keep them exact.
+        numbers = decimal_column([None if isinstance(value, str) else value for value in values])
+        return [_string_decimal(value) if isinstance(value, str) else number for value, number in zip(values, numbers)]
+    try:
+        array = np.array(values, dtype=float)
+    except (TypeError, ValueError, OverflowError):
+        array = np.fromiter((_to_float(value) for value in values), dtype=float, count=len(values))
+    column = _with_nulls(array, np.isfinite(array) & (array != 0))
+    if int in types or bool in types:
+        # Integers of any size pass through exactly; to_decimal rejects booleans.
+        column = [None if type(value) is bool else value if type(value) is int and value else number
+                  for value, number in zip(values, column)]
+    return column
+
+
+def _string_decimal(value):
+    try:
+        number = Decimal(value)
+    except InvalidOperation:
+        return None
+    # Like to_decimal, a non-empty string is kept even when it is zero ("0").
+    return number if number.is_finite() else None
+
+
+def timestamp_column(values):
+    """Vectorized to_timestamp: UNIX seconds to naive UTC datetimes (None for non-numbers)."""
+    if str in set(map(type, values)):
+        # to_timestamp only takes numbers, even numeric strings.
+        values = [None if isinstance(value, str) else value for value in values]
+    try:
+        array = np.array(values, dtype=float)
+    except (TypeError, ValueError, OverflowError):
+        array = np.fromiter((value if isinstance(value, (int, float)) else np.nan for value in values),
+                            dtype=float, count=len(values))
+    valid = np.isfinite(array) & (array >= _MIN_TIMESTAMP) & (array < _MAX_TIMESTAMP)
+    # utcfromtimestamp rounds to microseconds before strftime drops them.
+    seconds = np.floor(np.round(np.where(valid, array, 0), 6)).astype(np.int64)
+    return _with_nulls(seconds.astype("datetime64[s]"), valid)
+
+
+def token_columns(tokens):
+    """The coerced columns of a batch of token dicts: {"price", "price_24h_change", "time_at", "amount": list}."""
+    return {
+        "price": decimal_column([token['price'] for token in tokens]),
+        "price_24h_change": decimal_column([token.get('price_24h_change') for token in tokens]),
+        "time_at": timestamp_column([token.get('time_at') for token in tokens]),
+        "amount": decimal_column([token.get('amount') for token in tokens]),
+    }
+
+
+def token_rows(wallet_address, tokens):
+    """
+    Normalizes token dicts into token rows, one per (chain, token id).
+
+    When the same token shows up more than once the last occurrence wins (at
+    the position of the first), as in normalize_token_rows_rowwise.
+    """
+    tokens = list({(token['chain'], token['id']): token for token in tokens}.values())
+    columns = token_columns(tokens)
+    return [
+        (token['id'], wallet_address, token['chain'], token['name'], token['symbol'], token.get('display_symbol'),
+         token.get('optimized_symbol'), token.get('decimals'), token.get('logo_url'), token.get('protocol_id'),
+         price, price_24h_change, token.get('is_verified'), token.get('is_core'), token.get('is_wallet'),
+         time_at, amount)
+        for token, price, price_24h_change, time_at, amount in zip(
+            tokens, columns["price"], columns["price_24h_change"], columns["time_at"], columns["amount"])
+    ]
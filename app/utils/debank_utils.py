@@ -1,6 +1,8 @@
 import os
 from dotenv import load_dotenv
+from datetime import datetime
 from decimal import Decimal, InvalidOperation
+from utils.columnar import token_rows
 
 # Load environment variables from .env file
 load_dotenv()
@@ -14,14 +16,99 @@ headers = {
     "accept": "application/json",
     "AccessKey": DEBANK_KEY,
 }
+
+# DeBank Pro compute-unit quota and the unit cost of each endpoint we call.
+DEBANK_UNITS_PER_SECOND = float(os.getenv("DEBANK_UNITS_PER_SECOND", "100"))
+# Processes sharing that quota, e.g. refresh queue workers (services.refresh_queue).
+# Every process limits itself to an equal share, so set it to the number of
+# workers started across all machines.
+REFRESH_WORKERS = max(int(os.getenv("REFRESH_WORKERS", "1")), 1)
+DEBANK_PROCESS_UNITS_PER_SECOND = DEBANK_UNITS_PER_SECOND / REFRESH_WORKERS
+DEBANK_MAX_RETRIES = int(os.getenv("DEBANK_MAX_RETRIES", "5"))
+DEBANK_ENDPOINT_UNITS = {
+    "/v1/user/total_balance": int(os.getenv("DEBANK_TOTAL_BALANCE_UNITS", "5")),
+    "/v1/user/all_token_list": int(os.getenv("DEBANK_ALL_TOKEN_LIST_UNITS", "5")),
+    "/v1/user/token_list": int(os.getenv("DEBANK_TOKEN_LIST_UNITS", "5")),
+}
+DEBANK_DEFAULT_UNITS = 1
+
+
+class DebankAPIError(Exception):
+    """Raised when a DeBank request fails after all retries."""
+
+
+def endpoint_units(url):
+    """Returns the compute-unit cost of the DeBank endpoint in `url`."""
+    for path, units in DEBANK_ENDPOINT_UNITS.items():
+        if url.endswith(path):
+            return units
+    return DEBANK_DEFAULT_UNITS
+
+def normalize_address(address):
+    """Trims an address and lower-cases it if it is an EVM (0x) address."""
+    address = address.strip()
+    if address[:2].lower() == "0x":
+        return address.lower()
+    return address
+
+
 def to_decimal(value):
+    """Decimal of a payload number; None for falsy, non-numeric and non-finite (NaN, Infinity) values."""
     if not value:
         return None
     try:
-        return Decimal(str(value))
+        number = Decimal(str(value))
     except InvalidOperation:
         print(f"Failed to convert value '{value}' to Decimal.")
         return None
+    return number if number.is_finite() else None
+
+
+def to_timestamp(value):
+    """Converts a UNIX timestamp from the DeBank API to a UTC timestamp string."""
+    if not isinstance(value, (int, float)):
+        return None
+    try:
+        return datetime.utcfromtimestamp(value).strftime('%Y-%m-%d %H:%M:%S')
+    except (OverflowError, OSError, ValueError):
+        return None
+
+
+def normalize_chain_rows(wallet_address, raw_balance_data):
+    """Turns a total_balance payload into Chains rows (one per chain)."""
+    return [
+        (chain['id'], wallet_address, chain['name'], chain['logo_url'], chain['wrapped_token_id'],
+         chain.get('community_id'), chain.get('native_token_id'), chain.get('is_support_pre_exec'),
+         to_decimal(chain['usd_value']))
+        for chain in raw_balance_data['chain_list']
+    ]
+
+
+def normalize_token_rows(wallet_address, raw_token_data):
+    """
+    Turns a token list payload into token rows, converting whole columns at
+    once (see utils.columnar). The writers split each row into its
+    TokenCatalog and WalletTokenBalances parts (db.snapshot_writer).
+
+    Rows are keyed by (chain, id), so when the same token shows up more than
+    once the last occurrence wins, as it did with one upsert per token.
+    """
+    return token_rows(wallet_address, raw_token_data)
+
+
+def normalize_token_rows_rowwise(wallet_address, raw_token_data):
+    """Row-by-row reference for normalize_token_rows (see utils.normalize_benchmark)."""
+    rows = {}
+    for token in raw_token_data:
+        rows[token['chain'], token['id']] = (
+            token['id'], wallet_address, token['chain'], token['name'],
+            token['symbol'], token.get('display_symbol'), token.get('optimized_symbol'),
+            token.get('decimals'), token.get('logo_url'), token.get('protocol_id'),
+            to_decimal(token['price']), to_decimal(token.get('price_24h_change')),
+            token.get('is_verified'), token.get('is_core'), token.get('is_wallet'),
+            to_timestamp(token.get('time_at')), to_decimal(token.get('amount'))
+        )
+    return list(rows.values())
 
 
 def check_schema(df, expected_columns, default_value=0):
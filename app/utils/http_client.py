@@ -0,0 +1,69 @@
+"""
+Shared HTTP client for the provider fetchers (DeBank, BTC.com, Moralis).
+
+One `requests.Session` is kept per host, each with its own connection pool,
+so repeated calls reuse keep-alive connections instead of doing a new TCP+TLS
+handshake every time. Responses are requested gzip-compressed and every call
+gets a connect/read timeout.
+"""
+
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from decouple import config
+from requests.adapters import HTTPAdapter
+
+HTTP_CONNECT_TIMEOUT = config('HTTP_CONNECT_TIMEOUT', default=5.0, cast=float)
+HTTP_READ_TIMEOUT = config('HTTP_READ_TIMEOUT', default=30.0, cast=float)
+HTTP_POOL_MAXSIZE = config('HTTP_POOL_MAXSIZE', default=32, cast=int)
+
+DEFAULT_HEADERS = {
+    "Accept-Encoding": "gzip, deflate",
+    "Connection": "keep-alive",
+}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_MAXSIZE, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(DEFAULT_HEADERS)
+    return session
+
+
+def get_session(url):
+    """Returns the pooled session for the host of the given URL."""
+    host = urlsplit(url).netloc
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = _sessions[host] = _create_session()
+        return session
+
+
+def http_get(url, params=None, headers=None, timeout=None, **kwargs):
+    """
+    Issues a GET through the pooled session for the URL's host.
+
+    Args:
+    - url (str): Full request URL.
+    - params (dict): Query string parameters.
+    - headers (dict): Extra headers merged over the session defaults.
+    - timeout (tuple|float): Overrides the configured (connect, read) timeout.
+    """
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    return get_session(url).get(url, params=params, headers=headers, timeout=timeout, **kwargs)
+
+
+def close_sessions():
+    """Closes all pooled sessions, e.g. at the end of a run."""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -0,0 +1,98 @@
+"""
+Incremental JSON parsing for large provider responses.
+
+`iter_json_items` walks a JSON document with ijson and yields the elements of
+one array (the top-level array by default) as they are parsed, so only the
+current element is held in memory, not the raw body, its decoded text and the
+full object tree as `response.json()` does. Numbers come out as ints and
+floats, like `json.loads`, so downstream conversion (to_decimal,
+to_timestamp) is unchanged.
+
+`CompressingReader` wraps a byte stream and zlib-compresses everything read
+through it, so a streamed response can be stored in the response cache without
+keeping the uncompressed body around; `DecompressingReader` streams such a
+cached payload back.
+"""
+
+import zlib
+from decimal import Decimal
+
+import ijson
+
+READ_CHUNK_BYTES = 64 * 1024
+
+
+def _floats(value):
+    """Turns the Decimals ijson yields for non-integer numbers into floats, as json.loads does."""
+    if isinstance(value, dict):
+        return {key: _floats(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_floats(item) for item in value]
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def iter_json_items(stream, prefix="item"):
+    """Yields the elements of the array at `prefix` ("item" = top-level array) from a binary file-like object."""
+    # Not use_float=True: the C backend then rejects integers beyond 64 bits
+    # (raw token amounts), which json.loads and ijson's default keep as ints.
+    for item in ijson.items(stream, prefix):
+        yield _floats(item)
+
+
+class CompressingReader:
+    """File-like reader that tees what it reads into a zlib stream, up to max_bytes compressed."""
+
+    def __init__(self, raw, max_bytes, level=6):
+        self.raw = raw
+        self.max_bytes = max_bytes
+        self._compressor = zlib.compressobj(level)
+        self._chunks = []
+        self._size = 0
+
+    def read(self, size=READ_CHUNK_BYTES):
+        data = self.raw.read(size)
+        if data and self._compressor is not None:
+            compressed = self._compressor.compress(data)
+            self._chunks.append(compressed)
+            self._size += len(compressed)
+            if self._size > self.max_bytes:
+                # Too large to cache: stop buffering instead of growing with the payload.
+                self._compressor, self._chunks = None, []
+        return data
+
+    def compressed(self):
+        """The complete compressed payload, or None if it exceeded max_bytes."""
+        if self._compressor is None:
+            return None
+        # zlib holds back output until flushed, so the cap is checked again here.
+        self._chunks.append(self._compressor.flush())
+        self._size += len(self._chunks[-1])
+        if self._size > self.max_bytes:
+            self._compressor, self._chunks = None, []
+            return None
+        return b"".join(self._chunks)
+
+
+class DecompressingReader:
+    """File-like reader over a zlib-compressed payload, decompressed chunk by chunk."""
+
+    def __init__(self, payload):
+        self.payload = memoryview(payload)
+        self.position = 0
+        self._decompressor = zlib.decompressobj()
+
+    def read(self, size=READ_CHUNK_BYTES):
+        if size is None or size < 0:
+            size = len(self.payload)
+        if size == 0:
+            # ijson probes with read(0) to tell bytes from text streams.
+            return b""
+        while self.position < len(self.payload):
+            chunk = self.payload[self.position:self.position + size]
+            self.position += len(chunk)
+            data = self._decompressor.decompress(chunk)
+            if data:
+                return data
+        return self._decompressor.flush()
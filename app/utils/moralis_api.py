@@ -1,12 +1,16 @@
 import os
-from moralis import sol_api
+from utils.http_client import http_get
 
-def get_solana_portfolio(address):
+MORALIS_SOLANA_API_URL = "https://solana-gateway.moralis.io"
+
+def get_solana_portfolio(address, network="mainnet"):
     api_key = os.getenv("MORALIS_API_KEY")
-    params = {
-        "network": "mainnet",
-        "address": address
+    url = f"{MORALIS_SOLANA_API_URL}/account/{network}/{address}/portfolio"
+    headers = {
+        "accept": "application/json",
+        "X-API-Key": api_key,
     }
-    
-    result = sol_api.account.get_portfolio(api_key=api_key, params=params)
-    return result
+
+    response = http_get(url, headers=headers)
+    response.raise_for_status()
+    return response.json()
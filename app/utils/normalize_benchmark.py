@@ -0,0 +1,117 @@
+"""
+Row-wise vs. columnar normalization of DeBank token payloads.
+
+Builds N synthetic all_token_list records (the shape DeBank returns, including
+zero amounts, missing fields and duplicate ids), normalizes them with
+normalize_token_rows_rowwise and with the columnar normalize_token_rows,
+checks that both produce the same rows (floats compared through
+Decimal(str(value)) and datetimes through their string form, as they reach
+Postgres) and prints the CPU time of each: end to end, and for the numeric and
+timestamp coercion alone (the part that is vectorized; pulling fields out of
+the dicts costs the same either way).
+No database or API access is needed:
+
+    python -m utils.normalize_benchmark [N]
+"""
+
+import random
+import sys
+import time
+from datetime import datetime
+from decimal import Decimal
+
+from utils.columnar import token_columns
+from utils.debank_utils import normalize_token_rows, normalize_token_rows_rowwise, to_decimal, to_timestamp
+
+BENCHMARK_TOKENS = 100_000
+
+
+def synthetic_tokens(count, seed=0):
+    rng = random.Random(seed)
+    tokens = []
+    for i in range(count):
+        token = {
+            "id": f"0x{i % (count - count // 50):040x}",
+            "chain": rng.choice(["eth", "bsc", "arb", "op", "matic"]),
+            "name": f"Token {i}",
+            "symbol": f"T{i}",
+            "display_symbol": None,
+            "optimized_symbol": f"T{i}",
+            "decimals": 18,
+            "logo_url": f"https://static.debank.com/token/{i}.png",
+            "protocol_id": "",
+            "price": rng.choice([0, rng.random() * 3000, rng.random() * 1e-6]),
+            "price_24h_change": rng.choice([None, rng.uniform(-0.5, 0.5)]),
+            "is_verified": rng.random() < 0.8,
+            "is_core": rng.random() < 0.5,
+            "is_wallet": True,
+            "time_at": rng.choice([None, rng.uniform(1.4e9, 1.75e9), int(rng.uniform(1.4e9, 1.75e9))]),
+            "amount": rng.choice([0, rng.random() * 1e6, rng.random() * 1e-9, rng.randint(1, 10**6)]),
+        }
+        if i % 7 == 0:
+            del token["price_24h_change"]
+        if i % 1000 == 0:
+            token["amount"] = rng.randint(2**53, 10**24)
+        tokens.append(token)
+    return tokens
+
+
+def _comparable(value):
+    if isinstance(value, float):
+        return Decimal(str(value))
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+
+def _comparable_row(row):
+    return tuple(_comparable(value) for value in row)
+
+
+def _timed(fn, *args):
+    started = time.process_time()
+    result = fn(*args)
+    return result, time.process_time() - started
+
+
+def _coerce_rowwise(tokens):
+    return [(to_decimal(token['price']), to_decimal(token.get('price_24h_change')), to_timestamp(token.get('time_at')),
+             to_decimal(token.get('amount'))) for token in tokens]
+
+
+def _coerce_columnar(tokens):
+    return token_columns(tokens)
+
+
+def run_benchmark(count=BENCHMARK_TOKENS):
+    tokens = synthetic_tokens(count)
+    rowwise, rowwise_seconds = _timed(normalize_token_rows_rowwise, "0xwallet", tokens)
+    columnar, columnar_seconds = _timed(normalize_token_rows, "0xwallet", tokens)
+    _, coerce_rowwise_seconds = _timed(_coerce_rowwise, tokens)
+    _, coerce_columnar_seconds = _timed(_coerce_columnar, tokens)
+
+    mismatches = sum(1 for a, b in zip(rowwise, columnar) if _comparable_row(a) != _comparable_row(b))
+    mismatches += abs(len(rowwise) - len(columnar))
+    return {
+        "tokens": count,
+        "rows": len(columnar),
+        "rowwise_seconds": round(rowwise_seconds, 3),
+        "columnar_seconds": round(columnar_seconds, 3),
+        "speedup": round(rowwise_seconds / max(columnar_seconds, 1e-9), 1),
+        "coerce_rowwise_seconds": round(coerce_rowwise_seconds, 3),
+        "coerce_columnar_seconds": round(coerce_columnar_seconds, 3),
+        "coerce_speedup": round(coerce_rowwise_seconds / max(coerce_columnar_seconds, 1e-9), 1),
+        "mismatches": mismatches,
+    }
+
+
+if __name__ == "__main__":
+    result = run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else BENCHMARK_TOKENS)
+    print(f"{result['tokens']:,} tokens -> {result['rows']:,} rows")
+    print(f"normalize: row-wise {result['rowwise_seconds']}s CPU, columnar {result['columnar_seconds']}s CPU "
+          f"({result['speedup']}x)")
+    print(f"coercion only: row-wise {result['coerce_rowwise_seconds']}s CPU, "
+          f"columnar {result['coerce_columnar_seconds']}s CPU ({result['coerce_speedup']}x)")
+    if result["mismatches"]:
+        print(f"{result['mismatches']} rows differ between the two normalizations")
+        sys.exit(1)
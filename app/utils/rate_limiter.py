@@ -0,0 +1,80 @@
+"""
+Adaptive token-bucket rate limiter for APIs billed in compute units.
+
+The bucket refills continuously at `rate` units per second, so requests are
+spread evenly over the quota instead of bursting. On throttling (429/5xx) the
+rate is halved and then recovers additively on every successful call.
+"""
+
+import random
+import threading
+import time
+
+
+class ComputeUnitLimiter:
+    def __init__(self, units_per_second, burst_seconds=1.0, min_rate_fraction=0.1, recovery_fraction=0.02):
+        self.max_rate = float(units_per_second)
+        self.min_rate = self.max_rate * min_rate_fraction
+        self.recovery_step = self.max_rate * recovery_fraction
+        self.burst_seconds = burst_seconds
+        self.rate = self.max_rate
+        self._tokens = self.max_rate * burst_seconds
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+        self.reset_usage()
+
+    def _refill(self, now, units):
+        capacity = max(self.rate * self.burst_seconds, units)
+        self._tokens = min(capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self, units):
+        """Blocks until `units` compute units are available, then spends them."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now, units)
+                if self._tokens >= units:
+                    self._tokens -= units
+                    self._usage["units"] += units
+                    self._usage["requests"] += 1
+                    return
+                wait = (units - self._tokens) / self.rate
+                self._usage["wait_seconds"] += wait
+            time.sleep(wait)
+
+    def on_success(self):
+        """Additively raises the fill rate back towards the configured quota."""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.recovery_step)
+
+    def on_throttled(self):
+        """Halves the fill rate and drains the bucket after a 429/5xx."""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0.0
+            self._usage["throttled"] += 1
+
+    def backoff_delay(self, attempt, base=0.5, cap=30.0):
+        """Exponential backoff with full jitter for the given retry attempt."""
+        with self._lock:
+            self._usage["retries"] += 1
+        return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+    def reset_usage(self):
+        with self._lock:
+            self._usage = {"units": 0, "requests": 0, "throttled": 0, "retries": 0, "wait_seconds": 0.0}
+            self._usage_started = time.monotonic()
+
+    def usage_report(self):
+        """Returns the units spent since the last reset_usage()."""
+        with self._lock:
+            report = dict(self._usage)
+            elapsed = max(time.monotonic() - self._usage_started, 1e-9)
+            rate = self.rate
+        report["wait_seconds"] = round(report["wait_seconds"], 2)
+        report["elapsed_seconds"] = round(elapsed, 2)
+        report["units_per_second"] = round(report["units"] / elapsed, 2)
+        report["quota_utilization"] = round(report["units"] / (elapsed * self.max_rate), 3)
+        report["current_rate"] = round(rate, 2)
+        return report
@@ -0,0 +1,227 @@
+"""
+Persistent TTL cache for provider API responses.
+
+Responses are stored zlib-compressed in a local SQLite file, keyed by
+endpoint + address, so re-running a refresh (or resuming after a crash) does
+not spend API quota on wallets fetched moments ago. Each endpoint has its own
+TTL and the file is kept under a size cap by evicting least-recently-used
+entries. Set RESPONSE_CACHE_BYPASS=1, or pass use_cache=False to a fetcher,
+to always hit the API.
+
+`cached_stream` is the streaming variant for large array responses: records
+are parsed and yielded one at a time, both from the API and from the cache,
+and the compressed body is written to the cache once the stream is complete.
+`cached_payload` reads a large response to the end up front but keeps only its
+compressed body, so the connection is released before the records are
+consumed (with `iter_json_items(DecompressingReader(payload))`).
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from decouple import config
+
+from utils.json_stream import CompressingReader, DecompressingReader, iter_json_items
+
+RESPONSE_CACHE_PATH = config(
+    'RESPONSE_CACHE_PATH',
+    default=str(Path(__file__).resolve().parents[2] / '.response_cache.sqlite3'),
+)
+RESPONSE_CACHE_MAX_BYTES = config('RESPONSE_CACHE_MAX_BYTES', default=256 * 1024 * 1024, cast=int)
+# Streamed responses larger than this (compressed) are not cached.
+RESPONSE_CACHE_MAX_ENTRY_BYTES = config('RESPONSE_CACHE_MAX_ENTRY_BYTES', default=16 * 1024 * 1024, cast=int)
+RESPONSE_CACHE_BYPASS = config('RESPONSE_CACHE_BYPASS', default=False, cast=bool)
+
+# Seconds a response stays fresh, per endpoint.
+ENDPOINT_TTLS = {
+    "debank:total_balance": config('CACHE_TTL_TOTAL_BALANCE', default=300, cast=int),
+    "debank:all_token_list": config('CACHE_TTL_ALL_TOKEN_LIST', default=300, cast=int),
+    "debank:token_list": config('CACHE_TTL_TOKEN_LIST', default=300, cast=int),
+    "btc:address": config('CACHE_TTL_BTC_ADDRESS', default=600, cast=int),
+}
+DEFAULT_TTL = 300
+
+
+class ResponseCache:
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._conn = None
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    endpoint TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    payload BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    PRIMARY KEY (endpoint, key)
+                )
+            ''')
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+            self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        return self._conn
+
+    def get(self, endpoint, key):
+        """Returns the cached value, or None if missing or older than the endpoint TTL."""
+        payload = self.get_compressed(endpoint, key)
+        return None if payload is None else json.loads(zlib.decompress(payload))
+
+    def get_compressed(self, endpoint, key):
+        """Returns the cached zlib-compressed JSON payload, or None if missing or stale."""
+        ttl = ENDPOINT_TTLS.get(endpoint, DEFAULT_TTL)
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT payload, created_at FROM responses WHERE endpoint = ? AND key = ?", (endpoint, key)
+            ).fetchone()
+            if row is None or now - row[1] > ttl:
+                return None
+            conn.execute("UPDATE responses SET accessed_at = ? WHERE endpoint = ? AND key = ?", (now, endpoint, key))
+        return row[0]
+
+    def put(self, endpoint, key, value):
+        payload = zlib.compress(json.dumps(value, separators=(",", ":")).encode(), 6)
+        self.put_compressed(endpoint, key, payload)
+
+    def put_compressed(self, endpoint, key, payload):
+        """Stores an already zlib-compressed JSON payload."""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            previous = conn.execute(
+                "SELECT size FROM responses WHERE endpoint = ? AND key = ?", (endpoint, key)
+            ).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (endpoint, key, payload, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (endpoint, key, payload, len(payload), now, now),
+            )
+            self._total_bytes += len(payload) - (previous[0] if previous else 0)
+            if self._total_bytes > self.max_bytes:
+                self._evict(conn)
+
+    def _evict(self, conn):
+        """Drops least-recently-used entries until the cache is at 90% of its cap."""
+        target = self.max_bytes * 0.9
+        rows = conn.execute("SELECT endpoint, key, size FROM responses ORDER BY accessed_at").fetchall()
+        evicted = []
+        for endpoint, key, size in rows:
+            if self._total_bytes <= target:
+                break
+            evicted.append((endpoint, key))
+            self._total_bytes -= size
+        conn.executemany("DELETE FROM responses WHERE endpoint = ? AND key = ?", evicted)
+        logging.info(f"Response cache evicted {len(evicted)} entries.")
+
+    def clear(self):
+        with self._lock:
+            self._connect().execute("DELETE FROM responses")
+            self._total_bytes = 0
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_BYTES)
+
+
+def cached_fetch(endpoint, key, fetch_fn, use_cache=True):
+    """
+    Returns the cached response for endpoint+key, calling fetch_fn() on a miss.
+
+    Failed (None) responses are not cached.
+    """
+    if not use_cache or RESPONSE_CACHE_BYPASS:
+        return fetch_fn()
+
+    try:
+        cached = response_cache.get(endpoint, key)
+    except sqlite3.Error as e:
+        logging.warning(f"Response cache read failed: {e}")
+        cached = None
+    if cached is not None:
+        return cached
+
+    value = fetch_fn()
+    if value is not None:
+        try:
+            response_cache.put(endpoint, key, value)
+        except sqlite3.Error as e:
+            logging.warning(f"Response cache write failed: {e}")
+    return value
+
+
+def cached_stream(endpoint, key, open_fn, prefix="item", use_cache=True):
+    """
+    Yields the records of a JSON array response one at a time.
+
+    Args:
+    - endpoint (str), key (str): Cache key, as for cached_fetch.
+    - open_fn (callable): Returns a binary file-like body (e.g. an HTTP response's raw stream) on a miss.
+    - prefix (str): ijson path of the array to stream ("item" = top-level array).
+    - use_cache (bool): Set to False to always stream from the API.
+
+    The response is only cached if it was read to the end.
+    """
+    if not use_cache or RESPONSE_CACHE_BYPASS:
+        yield from iter_json_items(open_fn(), prefix)
+        return
+
+    try:
+        cached = response_cache.get_compressed(endpoint, key)
+    except sqlite3.Error as e:
+        logging.warning(f"Response cache read failed: {e}")
+        cached = None
+    if cached is not None:
+        yield from iter_json_items(DecompressingReader(cached), prefix)
+        return
+
+    reader = CompressingReader(open_fn(), RESPONSE_CACHE_MAX_ENTRY_BYTES)
+    yield from iter_json_items(reader, prefix)
+    payload = reader.compressed()
+    if payload is not None:
+        try:
+            response_cache.put_compressed(endpoint, key, payload)
+        except sqlite3.Error as e:
+            logging.warning(f"Response cache write failed: {e}")
+
+
+def cached_payload(endpoint, key, open_fn, use_cache=True):
+    """
+    Returns the zlib-compressed JSON body for endpoint+key, from the cache or
+    by reading open_fn() to the end through a compressor.
+
+    Bodies up to RESPONSE_CACHE_MAX_ENTRY_BYTES (compressed) are cached.
+    """
+    use_cache = use_cache and not RESPONSE_CACHE_BYPASS
+    if use_cache:
+        try:
+            cached = response_cache.get_compressed(endpoint, key)
+        except sqlite3.Error as e:
+            logging.warning(f"Response cache read failed: {e}")
+            cached = None
+        if cached is not None:
+            return cached
+
+    reader = CompressingReader(open_fn(), float("inf"))
+    while reader.read():
+        pass
+    payload = reader.compressed()
+    if use_cache and len(payload) <= RESPONSE_CACHE_MAX_ENTRY_BYTES:
+        try:
+            response_cache.put_compressed(endpoint, key, payload)
+        except sqlite3.Error as e:
+            logging.warning(f"Response cache write failed: {e}")
+    return payload
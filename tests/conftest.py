@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The app modules import each other as top-level packages (db, services, utils).
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+# db.connection reads DATABASE_URL at import; the pool only connects on first use.
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/portfolio_tests")
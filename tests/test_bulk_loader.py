@@ -0,0 +1,71 @@
+from decimal import Decimal
+
+from db.bulk_loader import TOKEN_COLUMNS, _csv_buffer
+from db.snapshot_writer import balance_rows, catalog_rows
+from utils.debank_utils import normalize_token_rows
+
+
+def parse_copy_csv(text, null=r"\N"):
+    """Parses CSV the way COPY ... (FORMAT csv, NULL '\\N') does: only an unquoted NULL marker is NULL."""
+    rows, row, field, quoted, in_quotes, i = [], [], "", False, False, 0
+    while i < len(text):
+        char = text[i]
+        if in_quotes:
+            if char == '"' and text[i + 1:i + 2] == '"':
+                field += '"'
+                i += 1
+            elif char == '"':
+                in_quotes = False
+            else:
+                field += char
+        elif char == '"':
+            in_quotes = quoted = True
+        elif char in ",\n":
+            row.append(None if not quoted and field == null else field)
+            field, quoted = "", False
+            if char == "\n":
+                rows.append(row)
+                row = []
+        else:
+            field += char
+        i += 1
+    return rows
+
+
+def as_text(rows):
+    return [[None if value is None else str(value) for value in row] for row in rows]
+
+
+TOKENS = [
+    {"id": "eth", "chain": "eth", "name": "ETH", "symbol": "ETH", "display_symbol": None, "optimized_symbol": "ETH",
+     "decimals": 18, "logo_url": "", "protocol_id": "", "price": 3000.5, "price_24h_change": None,
+     "is_verified": True, "is_core": True, "is_wallet": True, "time_at": 1483200000, "amount": 1.25},
+    {"id": "0xabc", "chain": "arb", "name": 'Quote "Token", with comma', "symbol": "\\N", "display_symbol": "",
+     "optimized_symbol": "line\nbreak", "decimals": 6, "logo_url": None, "protocol_id": "uniswap", "price": 0,
+     "price_24h_change": -0.5, "is_verified": False, "is_core": None, "is_wallet": False, "time_at": None,
+     "amount": 0},
+]
+
+
+def test_copy_csv_round_trips_strings_and_nulls():
+    rows = [("", None, "\\N", 'a "b", c', "x\ny", Decimal("1.50"), True)]
+    assert parse_copy_csv(_csv_buffer(rows).getvalue()) == as_text(rows)
+
+
+def test_bulk_and_batch_paths_store_identical_token_rows():
+    token_rows = normalize_token_rows("0xwallet", TOKENS)
+    staged = parse_copy_csv(_csv_buffer(token_rows).getvalue())
+    column = {name: index for index, name in enumerate(TOKEN_COLUMNS)}
+
+    # The bulk merges select these stage_tokens columns for TokenCatalog and WalletTokenBalances.
+    catalog_columns = ["chain", "token_id", "name", "symbol", "display_symbol", "optimized_symbol", "decimals",
+                       "logo_url", "protocol_id", "price", "price_24h_change", "is_verified", "is_core", "is_wallet",
+                       "time_at"]
+    staged_catalog = [[row[column[name]] for name in catalog_columns] for row in staged]
+    staged_balances = [[row[column[name]] for name in ["wallet_address", "chain", "token_id", "amount"]]
+                       for row in staged]
+
+    assert staged_catalog == as_text(catalog_rows(token_rows))
+    assert staged_balances == as_text(balance_rows(token_rows))
+    assert staged_catalog[0][catalog_columns.index("protocol_id")] == ""
+    assert staged_catalog[1][catalog_columns.index("logo_url")] is None
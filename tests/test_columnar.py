@@ -0,0 +1,71 @@
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+from utils.debank_utils import normalize_token_rows, normalize_token_rows_rowwise
+
+NUMERIC = (10, 11, 16)  # price, price_24h_change, amount
+TIME_AT = 15
+
+
+def as_stored(row):
+    """The values Postgres ends up with: numerics as exact decimal text, time_at as 'YYYY-MM-DD HH:MM:SS'."""
+    row = list(row)
+    for index in NUMERIC:
+        row[index] = None if row[index] is None else str(Decimal(str(row[index])))
+    if isinstance(row[TIME_AT], datetime):
+        row[TIME_AT] = row[TIME_AT].strftime('%Y-%m-%d %H:%M:%S')
+    return row
+
+
+def token(token_id, chain="eth", **fields):
+    base = {"id": token_id, "chain": chain, "name": token_id, "symbol": token_id.upper(), "price": 1.5,
+            "amount": 2, "time_at": 1_700_000_000}
+    base.update(fields)
+    return base
+
+
+EDGE_VALUES = [
+    None, 0, 0.0, -0.0, "", "0", "0.0", "1.2300", " 7 ", "abc", "1e400", "12345678901234567890.123456789",
+    True, False, 2 ** 70, -(2 ** 64), 1e-300, 0.1 + 0.2, 123456789.123456789, float("nan"), float("inf"),
+    float("-inf"), "NaN", "Infinity",
+]
+
+EDGE_TIMES = [
+    None, 0, -1, 1.5, 1_700_000_000.9999999, "1700000000", True, 2 ** 40, 10 ** 20, -10 ** 12,
+    253_402_300_799, 253_402_300_800, float("nan"), float("inf"),
+]
+
+
+def compare(tokens):
+    assert [as_stored(row) for row in normalize_token_rows("0xw", tokens)] == \
+           [as_stored(row) for row in normalize_token_rows_rowwise("0xw", tokens)]
+
+
+@pytest.mark.parametrize("field", ["price", "price_24h_change", "amount"])
+def test_numeric_edge_values(field):
+    compare([token(f"t{i}", **{field: value}) for i, value in enumerate(EDGE_VALUES)])
+
+
+@pytest.mark.parametrize("value", EDGE_VALUES, ids=repr)
+def test_numeric_edge_value_alone(value):
+    # Columns of a single type take NumPy's fast path; mixed columns the fallback.
+    compare([token("t", price=value, amount=value)])
+
+
+def test_time_at_edge_values():
+    compare([token(f"t{i}", time_at=value) for i, value in enumerate(EDGE_TIMES)])
+
+
+@pytest.mark.parametrize("value", EDGE_TIMES, ids=repr)
+def test_time_at_edge_value_alone(value):
+    compare([token("t", time_at=value)])
+
+
+def test_duplicate_chain_and_id_keep_last_occurrence_at_first_position():
+    compare([token("a", amount=1), token("b"), token("a", amount=3), token("a", chain="arb", amount=4)])
+
+
+def test_empty_token_list():
+    assert normalize_token_rows("0xw", []) == normalize_token_rows_rowwise("0xw", []) == []
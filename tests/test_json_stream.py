@@ -0,0 +1,57 @@
+import gzip
+import io
+import json
+
+import pytest
+
+from services import ingestion_engine
+from services.ingestion_engine import StreamedTokens, _fetch_token_list_bounded
+from utils.json_stream import CompressingReader, DecompressingReader, iter_json_items
+from utils.response_cache import cached_payload
+
+TOKENS = [{"id": f"0x{i:040x}", "chain": "eth", "name": f"Token \"{i}\"", "price": i / 7, "amount": 10 ** 20 + i,
+           "is_core": i % 2 == 0, "logo_url": None, "protocol_id": ""} for i in range(2000)]
+
+
+def gzipped_body(tokens):
+    """A gzip'd HTTP body as requests exposes it with decode_content=True."""
+    return gzip.GzipFile(fileobj=io.BytesIO(gzip.compress(json.dumps(tokens).encode())))
+
+
+def test_compressing_reader_round_trips_a_gzipped_token_list():
+    reader = CompressingReader(gzipped_body(TOKENS), max_bytes=float("inf"))
+    assert list(iter_json_items(reader)) == TOKENS
+    assert list(iter_json_items(DecompressingReader(reader.compressed()))) == TOKENS
+
+
+def test_compressing_reader_gives_up_above_max_bytes():
+    reader = CompressingReader(gzipped_body(TOKENS), max_bytes=1024)
+    assert list(iter_json_items(reader)) == TOKENS
+    assert reader.compressed() is None
+
+
+@pytest.mark.parametrize("size", [0, 1, 7, 64 * 1024])
+def test_decompressing_reader_read_sizes(size):
+    payload = cached_payload("test", "key", lambda: gzipped_body(TOKENS), use_cache=False)
+    reader = DecompressingReader(payload)
+    if size == 0:
+        assert reader.read(0) == b""
+        size = 1024
+    chunks = iter(lambda: reader.read(size), b"")
+    assert json.loads(b"".join(chunks)) == TOKENS
+
+
+@pytest.mark.parametrize("count, streamed", [(99, False), (100, False), (101, True), (2000, True)])
+def test_fetch_token_list_bounded_cuts_over_above_the_limit(monkeypatch, count, streamed):
+    tokens = TOKENS[:count]
+    monkeypatch.setattr(ingestion_engine, "fetch_all_token_list_payload",
+                        lambda address, use_cache: cached_payload("test", address, lambda: gzipped_body(tokens),
+                                                                  use_cache=False))
+    result = _fetch_token_list_bounded("0xwallet", use_cache=False, limit=100)
+    assert isinstance(result, StreamedTokens) is streamed
+    if streamed:
+        # The buffered payload can be read more than once, from the first token.
+        assert list(result.tokens) == tokens
+        assert list(result.tokens) == tokens
+    else:
+        assert result == tokens
@@ -0,0 +1,119 @@
+import threading
+
+import pytest
+
+from utils import rate_limiter
+from utils.rate_limiter import ComputeUnitLimiter
+
+
+class FakeClock:
+    """Stands in for the time module: sleep() only moves monotonic() forward."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter, "time", clock)
+    return clock
+
+
+def test_acquire_spends_the_burst_then_waits_for_refill(clock):
+    limiter = ComputeUnitLimiter(100)
+    limiter.acquire(100)
+    assert clock.sleeps == []
+
+    limiter.acquire(50)
+    assert clock.sleeps == [pytest.approx(0.5)]
+
+    clock.now += 0.2
+    limiter.acquire(20)
+    assert clock.sleeps == [pytest.approx(0.5)]
+
+
+def test_refill_is_capped_at_the_burst_size(clock):
+    limiter = ComputeUnitLimiter(100, burst_seconds=2)
+    limiter.acquire(200)
+    clock.now += 60
+    limiter.acquire(200)
+    limiter.acquire(50)
+    assert clock.sleeps == [pytest.approx(0.5)]
+
+
+def test_request_larger_than_the_bucket_still_goes_through(clock):
+    limiter = ComputeUnitLimiter(10)
+    limiter.acquire(10)
+    limiter.acquire(30)
+    assert clock.sleeps == [pytest.approx(3.0)]
+
+
+def test_throttling_halves_the_rate_and_drains_the_bucket(clock):
+    limiter = ComputeUnitLimiter(100)
+    limiter.on_throttled()
+    assert limiter.rate == 50
+
+    limiter.acquire(25)
+    assert clock.sleeps == [pytest.approx(0.5)]
+
+    for _ in range(10):
+        limiter.on_throttled()
+    assert limiter.rate == pytest.approx(10)  # min_rate_fraction=0.1
+
+
+def test_success_recovers_the_rate_additively(clock):
+    limiter = ComputeUnitLimiter(100)
+    limiter.on_throttled()
+    limiter.on_success()
+    assert limiter.rate == pytest.approx(52)
+    for _ in range(100):
+        limiter.on_success()
+    assert limiter.rate == 100
+
+    limiter.on_throttled()
+    limiter.on_success()
+    limiter.acquire(26)
+    assert clock.sleeps == [pytest.approx(0.5)]
+
+
+def test_usage_report(clock):
+    limiter = ComputeUnitLimiter(100)
+    limiter.acquire(100)
+    limiter.acquire(50)
+    limiter.on_throttled()
+    limiter.backoff_delay(1)
+    clock.now += 1.5
+
+    report = limiter.usage_report()
+    assert report == {
+        "units": 150, "requests": 2, "throttled": 1, "retries": 1, "wait_seconds": 0.5,
+        "elapsed_seconds": 2.0, "units_per_second": 75.0, "quota_utilization": 0.75, "current_rate": 50.0,
+    }
+
+    report["units"] = 0
+    assert limiter.usage_report()["units"] == 150
+
+    limiter.reset_usage()
+    assert limiter.usage_report()["units"] == 0
+
+
+def test_usage_report_waits_for_the_lock(clock):
+    limiter = ComputeUnitLimiter(100)
+    reports = []
+    with limiter._lock:
+        reader = threading.Thread(target=lambda: reports.append(limiter.usage_report()))
+        reader.start()
+        reader.join(0.1)
+        assert reader.is_alive()
+        limiter._usage["units"] = 7
+    reader.join()
+    assert reports[0]["units"] == 7
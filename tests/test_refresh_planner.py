@@ -0,0 +1,95 @@
+from decimal import Decimal
+
+from services.refresh_planner import build_refresh_plan, changed_chains, plan_from_addresses
+
+
+def balance(total, **chains):
+    """A total_balance payload as DeBank returns it."""
+    return {"total_usd_value": total,
+            "chain_list": [{"id": chain_id, "usd_value": usd_value} for chain_id, usd_value in chains.items()]}
+
+
+def stored(total, **chains):
+    return Decimal(str(total)), {chain_id: Decimal(str(usd_value)) for chain_id, usd_value in chains.items()}
+
+
+def test_never_stored_wallet_needs_full_refresh():
+    assert changed_chains(balance(100, eth=100), None) is None
+    assert changed_chains(balance(100, eth=100), (None, {})) is None
+
+
+def test_unchanged_wallet():
+    assert changed_chains(balance(300, eth=200, bsc=100), stored(300, eth=200, bsc=100)) == set()
+
+
+def test_only_chains_over_both_thresholds_change():
+    raw = balance(10_000 + 500 + 1.5, eth=10_000.5, bsc=501, arb=0)
+    # eth moved 0.5 USD (under the absolute floor), arb 0 -> 0, bsc 1% (over both).
+    assert changed_chains(raw, stored(10_500, eth=10_000, bsc=496, arb=0)) == {"bsc"}
+    # A large absolute move that is small relative to the chain is ignored.
+    assert changed_chains(balance(1_000_040, eth=1_000_040), stored(1_000_000, eth=1_000_000)) == set()
+
+
+def test_total_under_threshold():
+    # Every chain moved 0.25 USD and so did the total: nothing to refetch.
+    raw = balance(200.5, eth=100.25, bsc=100.25)
+    assert changed_chains(raw, stored(200, eth=100, bsc=100)) == set()
+
+
+def test_total_over_threshold_refreshes_every_chain():
+    # No chain crossed the 1 USD floor on its own, but the total moved 1.8 USD (0.9%).
+    raw = balance(201.8, eth=100.9, bsc=100.9)
+    assert changed_chains(raw, stored(200, eth=100, bsc=100)) == {"eth", "bsc"}
+
+
+def test_new_chain():
+    raw = balance(350, eth=200, bsc=100, base=50)
+    assert changed_chains(raw, stored(300, eth=200, bsc=100)) == {"base"}
+
+
+def test_new_chain_below_threshold_is_ignored():
+    raw = balance(300.5, eth=200, bsc=100, base=0.5)
+    assert changed_chains(raw, stored(300, eth=200, bsc=100)) == set()
+
+
+def test_disappeared_chain():
+    raw = balance(200, eth=200)
+    assert changed_chains(raw, stored(300, eth=200, bsc=100)) == {"bsc"}
+
+
+def test_thresholds_can_be_overridden():
+    raw = balance(100.5, eth=100.5)
+    assert changed_chains(raw, stored(100, eth=100)) == set()
+    assert changed_chains(raw, stored(100, eth=100), abs_threshold=Decimal("0.1"),
+                          rel_threshold=Decimal("0.001")) == {"eth"}
+
+
+def test_build_refresh_plan_dedupes_wallets_across_users():
+    plan = build_refresh_plan([
+        ("alice", "0xAbC"),
+        ("bob", "0xabc"),
+        ("bob", " 0xABC "),
+        ("carol", "0xdef"),
+        ("alice", "0xdef"),
+    ])
+    assert plan == {
+        "0xabc": {"stored_addresses": {"0xAbC", "0xabc", " 0xABC "}, "user_ids": {"alice", "bob"}},
+        "0xdef": {"stored_addresses": {"0xdef"}, "user_ids": {"carol", "alice"}},
+    }
+
+
+def test_build_refresh_plan_keeps_non_evm_addresses_case():
+    plan = build_refresh_plan([("alice", "SoLAddr"), ("bob", "soladdr")])
+    assert plan == {
+        "SoLAddr": {"stored_addresses": {"SoLAddr"}, "user_ids": {"alice"}},
+        "soladdr": {"stored_addresses": {"soladdr"}, "user_ids": {"bob"}},
+    }
+
+
+def test_plan_from_addresses_has_no_owners():
+    plan = plan_from_addresses(["0xAbC", "0xabc ", "0xdef"])
+    assert plan == {
+        "0xabc": {"stored_addresses": {"0xAbC", "0xabc "}, "user_ids": set()},
+        "0xdef": {"stored_addresses": {"0xdef"}, "user_ids": set()},
+    }
+    assert plan_from_addresses([]) == {}
@@ -0,0 +1,149 @@
+import pytest
+
+from utils import response_cache as response_cache_module
+from utils.response_cache import ENDPOINT_TTLS, ResponseCache, cached_fetch
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(response_cache_module, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def cache(tmp_path, clock):
+    return ResponseCache(str(tmp_path / "responses.sqlite3"), max_bytes=1000)
+
+
+def stored_keys(cache):
+    return {key for (key,) in cache._connect().execute("SELECT key FROM responses")}
+
+
+def test_round_trip(cache):
+    value = {"total_usd_value": 12.5, "chain_list": [{"id": "eth", "usd_value": 12.5}]}
+    cache.put("debank:total_balance", "0xabc", value)
+    assert cache.get("debank:total_balance", "0xabc") == value
+    assert cache.get("debank:total_balance", "0xdef") is None
+    assert cache.get("debank:token_list", "0xabc") is None
+
+
+def test_entries_expire_after_the_endpoint_ttl(cache, clock):
+    ttl = ENDPOINT_TTLS["btc:address"]
+    cache.put("btc:address", "bc1q", {"balance": 1})
+    cache.put("unknown:endpoint", "bc1q", {"balance": 2})
+
+    clock.now += response_cache_module.DEFAULT_TTL
+    assert cache.get("unknown:endpoint", "bc1q") == {"balance": 2}
+    clock.now += 1
+    assert cache.get("unknown:endpoint", "bc1q") is None
+
+    clock.now += ttl - response_cache_module.DEFAULT_TTL - 1
+    assert cache.get("btc:address", "bc1q") == {"balance": 1}
+    clock.now += 1
+    assert cache.get("btc:address", "bc1q") is None
+
+
+def test_reads_do_not_extend_the_ttl(cache, clock):
+    ttl = ENDPOINT_TTLS["debank:token_list"]
+    cache.put("debank:token_list", "0xabc", [1])
+    clock.now += ttl
+    assert cache.get("debank:token_list", "0xabc") == [1]
+    clock.now += 1
+    assert cache.get("debank:token_list", "0xabc") is None
+
+
+def test_evicts_least_recently_used_down_to_90_percent(cache, clock):
+    for key in ("a", "b", "c"):
+        cache.put_compressed("debank:token_list", key, bytes(300))
+        clock.now += 1
+    cache.get_compressed("debank:token_list", "a")
+    clock.now += 1
+
+    cache.put_compressed("debank:token_list", "d", bytes(300))
+    assert stored_keys(cache) == {"a", "c", "d"}
+    assert cache._total_bytes == 900
+
+    # A bigger entry pushes out as many of the oldest as it takes.
+    clock.now += 1
+    cache.put_compressed("debank:token_list", "e", bytes(500))
+    assert stored_keys(cache) == {"d", "e"}
+    assert cache._total_bytes == 800
+
+
+def test_replacing_an_entry_counts_only_the_new_size(cache):
+    cache.put_compressed("debank:token_list", "a", bytes(600))
+    cache.put_compressed("debank:token_list", "a", bytes(700))
+    assert cache._total_bytes == 700
+    assert stored_keys(cache) == {"a"}
+
+
+def test_size_is_reloaded_from_the_file(tmp_path, clock):
+    path = str(tmp_path / "responses.sqlite3")
+    ResponseCache(path, max_bytes=1000).put_compressed("debank:token_list", "a", bytes(400))
+
+    reopened = ResponseCache(path, max_bytes=1000)
+    reopened.put_compressed("debank:token_list", "b", bytes(400))
+    reopened.put_compressed("debank:token_list", "c", bytes(400))
+    assert stored_keys(reopened) == {"b", "c"}
+
+
+def test_clear(cache):
+    cache.put("debank:token_list", "a", [1])
+    cache.clear()
+    assert cache.get("debank:token_list", "a") is None
+    assert cache._total_bytes == 0
+
+
+@pytest.fixture
+def shared_cache(cache, monkeypatch):
+    monkeypatch.setattr(response_cache_module, "response_cache", cache)
+    monkeypatch.setattr(response_cache_module, "RESPONSE_CACHE_BYPASS", False)
+    return cache
+
+
+def counting(value):
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return value
+
+    return fetch, calls
+
+
+def test_cached_fetch_miss_then_hit(shared_cache, clock):
+    fetch, calls = counting({"total_usd_value": 3})
+    assert cached_fetch("debank:total_balance", "0xabc", fetch) == {"total_usd_value": 3}
+    assert cached_fetch("debank:total_balance", "0xabc", fetch) == {"total_usd_value": 3}
+    assert len(calls) == 1
+
+    clock.now += ENDPOINT_TTLS["debank:total_balance"] + 1
+    assert cached_fetch("debank:total_balance", "0xabc", fetch) == {"total_usd_value": 3}
+    assert len(calls) == 2
+
+
+def test_cached_fetch_does_not_cache_failures(shared_cache):
+    fetch, calls = counting(None)
+    assert cached_fetch("debank:total_balance", "0xabc", fetch) is None
+    assert cached_fetch("debank:total_balance", "0xabc", fetch) is None
+    assert len(calls) == 2
+
+
+def test_cached_fetch_bypass(shared_cache, monkeypatch):
+    fetch, calls = counting([1])
+    cached_fetch("debank:token_list", "0xabc", fetch, use_cache=False)
+    assert shared_cache.get("debank:token_list", "0xabc") is None
+
+    monkeypatch.setattr(response_cache_module, "RESPONSE_CACHE_BYPASS", True)
+    cached_fetch("debank:token_list", "0xabc", fetch)
+    cached_fetch("debank:token_list", "0xabc", fetch)
+    assert len(calls) == 3